@@ -213,9 +213,9 @@ class QualityCheckAction(InterfaceAction):
         d.exec_()
         if d.result() == d.Accepted:
             selected_ids = self.gui.library_view.get_selected_ids()
+            # Drop any books since deleted from the library while saving the exclusions
             existing_ids = cfg.get_valid_excluded_books(self.gui.current_db, d.menu_key)
-            existing_ids.extend(selected_ids)
-            cfg.set_excluded_books(self.gui.current_db, d.menu_key, list(set(existing_ids)))
+            cfg.set_excluded_books(self.gui.current_db, d.menu_key, set(existing_ids).union(selected_ids))
 
     def exclude_view(self):
         d = ExcludeViewDialog(self.gui, self.gui.current_db, self.last_menu_key)
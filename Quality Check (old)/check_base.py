@@ -7,6 +7,9 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
+import cProfile, hashlib, json, os, pstats, threading, time
+from six import StringIO
+
 from calibre.utils.logging import GUILog
 
 try:
@@ -15,18 +18,45 @@ except NameError:
     pass # load_translations() added in calibre 1.9
 
 import calibre_plugins.quality_check.config as cfg
+from calibre_plugins.quality_check import ActionQualityCheck
+from calibre_plugins.quality_check.common_utils import get_title_authors_text
 from calibre_plugins.quality_check.dialogs import QualityProgressDialog, ResultsSummaryDialog
+from calibre_plugins.quality_check.instrumentation import instrumentation, InstrumentedDb, clock
+from calibre_plugins.quality_check.result_cache import (ResultCache, ResultCacheUnavailable,
+                                                        get_result_cache_path)
+from calibre_plugins.quality_check.workers import BookWorkerPool, ThreadedLog
 
 class BaseCheck(object):
     '''
     Base class for all quality check implementations
     '''
+    # Set to True by checks whose evaluate_book callbacks are safe to run
+    # concurrently on worker threads.
+    supports_parallel = False
+    # The formats read by the checks of this class. When set, the verdict and
+    # log output for each book are cached so that books whose files are
+    # unchanged since the last run are not read again.
+    result_cache_formats = None
+
     def __init__(self, gui, initial_search=''):
         self.gui = gui
-        self.log = GUILog()
+        # When run from the command line there is no gui, the runner sets the db
+        self.db = gui.current_db if gui is not None else None
+        self.log = ThreadedLog(GUILog())
         self.menu_key = None
         self.book_ids = []
         self.initial_search = initial_search
+        # When a list, check_all_files() records each check here instead of
+        # running it, so that several checks can be run in a single pass.
+        self.collected_checks = None
+        self.result_cache = None
+        self.result_cache_failed = False
+        # Overrides the configured number of worker threads when set
+        self.worker_count = None
+        # The outcome of each check run without a gui, for the runner to report
+        self.results = []
+        # The timings recorded for the last run, if enabled in the options
+        self.timings = None
 
     def perform_check(self, menu_key):
         '''
@@ -39,43 +69,353 @@ class BaseCheck(object):
         self.book_ids = book_ids
 
     def check_all_files(self, callback_fn, status_msg_type='books',
-                        no_match_msg=None, show_matches=True, marked_text='true'):
+                        no_match_msg=None, show_matches=True, marked_text='true',
+                        cache_options=None, use_cache=True, max_matches=None,
+                        live_results=False, skip_drm=False, parallel=None):
         '''
         Performs the quality check in a threaded fashion with progress dialog
+
+        :param cache_options: Any settings the result of the check depends upon,
+                              cached results for other settings are not reused
+        :param use_cache: Set to False for checks whose results cannot be cached
+        :param max_matches: Stop checking once this many books have matched
+        :param live_results: Mark the matching books in the library view while
+                             the check is still running
+        :param skip_drm: Skip the books with DRM without evaluating them
+        :param parallel: Whether the books can be evaluated on the worker pool,
+                         if not the same for every callback of this check
+        '''
+        if use_cache and self.menu_key and self.is_result_cache_enabled():
+            callback_fn = self.cached_callback(callback_fn, self.menu_key, cache_options)
+        if skip_drm:
+            callback_fn = self.drm_skipping_callback(callback_fn)
+        if self.collected_checks is not None:
+            self.collected_checks.append({'menu_key': self.menu_key, 'callback_fn': callback_fn,
+                                          'marked_text': marked_text})
+            return 0, [], ''
+        self.select_book_ids()
+
+        if self.gui is None:
+            return self.check_all_files_headless(callback_fn, marked_text, max_matches, parallel)
+
+        profile_mode = cfg.plugin_prefs[cfg.STORE_OPTIONS].get(cfg.KEY_PROFILE_MODE, cfg.PROFILE_MODE_OFF)
+        db = self.db
+        if profile_mode != cfg.PROFILE_MODE_OFF:
+            callback_fn = self.timed_callback(callback_fn)
+            db = InstrumentedDb(db)
+            instrumentation.reset()
+            instrumentation.enable()
+        profiler = worker_pool = None
+        if profile_mode == cfg.PROFILE_MODE_CPROFILE:
+            # cProfile only sees the thread it is enabled on, so check one book at a time
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            worker_pool = self.create_worker_pool(callback_fn, db, parallel)
+        matches_fn = None
+        if live_results and show_matches:
+            matches_fn = lambda result_ids: self.show_invalid_rows(result_ids, marked_text)
+        start = clock()
+        try:
+            d = QualityProgressDialog(self.gui, self.book_ids, callback_fn, db,
+                                      status_msg_type, worker_pool=worker_pool,
+                                      max_matches=max_matches, matches_fn=matches_fn)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            instrumentation.enable(False)
+        if profile_mode != cfg.PROFILE_MODE_OFF:
+            self.timings = self.get_timings(d.i, clock() - start, profiler)
+        self.save_result_cache()
+        self.finish_evaluation()
+        cancelled_msg = ''
+        if d.wasCanceled():
+            cancelled_msg = _(' (cancelled)')
+        elif d.limit_reached:
+            cancelled_msg = _(' (stopped after %d matches)') % max_matches
+        if show_matches:
+            self.show_results(d.total_count, d.result_ids, cancelled_msg, no_match_msg, marked_text)
+        return d.total_count, d.result_ids, cancelled_msg
+
+    def select_book_ids(self):
+        '''
+        Work out the books to check, the selected books or the results of the
+        initial search, less any excluded from this check
         '''
         # If scope is limited to selected book ids this set will have been set.
         if not self.book_ids:
-            self.gui.search.clear()
-            self.book_ids = self.gui.current_db.search(self.initial_search, return_matches=True)
+            if self.gui is not None:
+                self.gui.search.clear()
+            self.book_ids = self.db.search(self.initial_search, return_matches=True)
         # Exclude any books that have exclusions for this check
         if self.menu_key:
-            excluded_ids = cfg.get_valid_excluded_books(self.gui.current_db, self.menu_key)
+            excluded_ids = cfg.get_excluded_book_set(self.db, self.menu_key)
             if excluded_ids:
-                excluded_map = dict((i, True) for i in excluded_ids)
-                self.book_ids = [i for i in self.book_ids if i not in excluded_map]
+                self.book_ids = [i for i in self.book_ids if i not in excluded_ids]
 
-        d = QualityProgressDialog(self.gui, self.book_ids, callback_fn, self.gui.current_db,
-                                  status_msg_type)
-        cancelled_msg = ''
-        if d.wasCanceled():
-            cancelled_msg = _(' (cancelled)')
+    def show_results(self, total_count, result_ids, cancelled_msg, no_match_msg, marked_text):
+        shown_summary = False
+        if len(result_ids) > 0:
+            self.show_invalid_rows(result_ids, marked_text)
+            if self.log.plain_text:
+                sd = ResultsSummaryDialog(self.gui, 'Quality Check',
+                                         _('%d matches found%s, see log for details')%(len(result_ids), cancelled_msg),
+                                         self.log, timings=self.timings)
+                sd.exec_()
+                shown_summary = True
+        msg = _('Checked %d books, found %d matches%s') %(total_count, len(result_ids), cancelled_msg)
+        if no_match_msg:
+            self.gui.status_bar.showMessage(msg)
+            if len(result_ids) == 0:
+                sd = ResultsSummaryDialog(self.gui, _('No Matches'), no_match_msg, self.log,
+                                          timings=self.timings)
+                sd.exec_()
+                shown_summary = True
+        if self.timings and not shown_summary:
+            sd = ResultsSummaryDialog(self.gui, 'Quality Check', msg, self.log, timings=self.timings)
+            sd.exec_()
+
+    def check_all_fields(self, field_names, callback_fn, status_msg_type='books',
+                         no_match_msg=None, show_matches=True, marked_text='true'):
+        '''
+        Performs a check which only needs the metadata of each book, reading
+        each of the named fields for all the books at once rather than going
+        through the progress dialog a book at a time.
+
+        :param callback_fn: Called with the value of each field in turn for a
+                            book, returning True if the book matches
+        '''
+        if self.collected_checks is not None:
+            # The benchmark and multiple check runners evaluate a book at a time
+            def evaluate_book(book_id, db):
+                api = db.new_api
+                return callback_fn(*[api.field_for(f, book_id) for f in field_names])
+            return self.check_all_files(evaluate_book, status_msg_type, no_match_msg,
+                                        show_matches, marked_text)
+        self.select_book_ids()
+
+        profile_mode = cfg.plugin_prefs[cfg.STORE_OPTIONS].get(cfg.KEY_PROFILE_MODE, cfg.PROFILE_MODE_OFF)
+        if self.gui is not None and profile_mode != cfg.PROFILE_MODE_OFF:
+            instrumentation.reset()
+        start = clock()
+        api = self.db.new_api
+        book_ids = self.book_ids
+        columns = [api.all_field_for(f, book_ids) for f in field_names]
+        result_ids = [book_id for book_id in book_ids
+                      if callback_fn(*[column[book_id] for column in columns])]
+        if self.gui is None:
+            if self.menu_key:
+                self.results.append({'menu_key': self.menu_key, 'marked_text': marked_text,
+                                     'total_count': len(book_ids), 'result_ids': result_ids})
+            return len(book_ids), result_ids, ''
+        if profile_mode != cfg.PROFILE_MODE_OFF:
+            self.timings = self.get_timings(len(book_ids), clock() - start)
         if show_matches:
-            if len(d.result_ids) > 0:
-                self.show_invalid_rows(d.result_ids, marked_text)
-                if self.log.plain_text:
-                    sd = ResultsSummaryDialog(self.gui, 'Quality Check',
-                                             _('%d matches found%s, see log for details')%(len(d.result_ids), cancelled_msg),
-                                             self.log)
-                    sd.exec_()
-            if no_match_msg:
-                msg = _('Checked %d books, found %d matches%s') %(d.total_count, len(d.result_ids), cancelled_msg)
-                self.gui.status_bar.showMessage(msg)
-                if len(d.result_ids) == 0:
-                    sd = ResultsSummaryDialog(self.gui, _('No Matches'), no_match_msg, self.log)
-                    sd.exec_()
-        return d.total_count, d.result_ids, cancelled_msg
+            self.show_results(len(book_ids), result_ids, '', no_match_msg, marked_text)
+        return len(book_ids), result_ids, ''
+
+    def timed_callback(self, callback_fn):
+        '''
+        Wraps callback_fn to record the time taken to evaluate each book
+        '''
+        def evaluate_book(book_id, db):
+            start = clock()
+            try:
+                return callback_fn(book_id, db)
+            finally:
+                instrumentation.record_book(book_id, clock() - start)
+
+        return evaluate_book
+
+    def get_timings(self, book_count, elapsed, profiler=None):
+        '''
+        The timings recorded while running this check as a dictionary, which
+        can be exported as json
+        '''
+        timings = instrumentation.snapshot()
+        timings['menu_key'] = self.menu_key
+        timings['books'] = book_count
+        timings['seconds'] = elapsed
+        for book in timings['slowest_books']:
+            book['title'] = get_title_authors_text(self.db, book['book_id'])
+        if profiler is not None:
+            stream = StringIO()
+            stats = pstats.Stats(profiler, stream=stream)
+            stats.sort_stats('cumulative').print_stats(40)
+            timings['profile'] = stream.getvalue()
+        return timings
+
+    def check_all_files_headless(self, callback_fn, marked_text='true', max_matches=None, parallel=None):
+        '''
+        Performs the quality check without any progress dialog, recording the
+        outcome in self.results for the command line runner to report
+        '''
+        result_ids = []
+        worker_pool = self.create_worker_pool(callback_fn, parallel=parallel)
+        if worker_pool is None:
+            for book_id in self.book_ids:
+                if callback_fn(book_id, self.db):
+                    result_ids.append(book_id)
+                    if max_matches and len(result_ids) >= max_matches:
+                        break
+        else:
+            worker_pool.start()
+            while not worker_pool.is_finished:
+                result_ids.extend(book_id for book_id, matched in worker_pool.drain() if matched)
+                if max_matches and len(result_ids) >= max_matches:
+                    worker_pool.cancel()
+                time.sleep(0.05)
+            worker_pool.join()
+            result_ids.extend(book_id for book_id, matched in worker_pool.drain() if matched)
+        self.save_result_cache()
+        self.finish_evaluation()
+        if self.menu_key:
+            self.results.append({'menu_key': self.menu_key, 'marked_text': marked_text,
+                                 'total_count': len(self.book_ids), 'result_ids': result_ids})
+        return len(self.book_ids), result_ids, ''
 
     def show_invalid_rows(self, result_ids, marked_text='true'):
         marked_ids = dict.fromkeys(result_ids, marked_text)
-        self.gui.current_db.set_marked_ids(marked_ids)
+        self.db.set_marked_ids(marked_ids)
         self.gui.search.set_search_string('marked:%s' % marked_text)
+
+    def create_worker_pool(self, callback_fn, db=None, parallel=None):
+        '''
+        Returns a pool to evaluate books concurrently if this check supports it
+        and the user has configured more than one worker thread, otherwise None
+        '''
+        if db is None:
+            db = self.db
+        if parallel is None:
+            parallel = self.supports_parallel
+        if not parallel or len(self.book_ids) < 2:
+            return None
+        worker_count = self.get_worker_count()
+        if worker_count < 2:
+            return None
+        return BookWorkerPool(self.book_ids, callback_fn, db, self.log, worker_count)
+
+    def get_worker_count(self):
+        worker_count = self.worker_count
+        if worker_count is None:
+            c = cfg.plugin_prefs[cfg.STORE_OPTIONS]
+            worker_count = c.get(cfg.KEY_WORKER_THREADS, 1)
+        return worker_count
+
+    def is_result_cache_enabled(self):
+        if not self.result_cache_formats:
+            return False
+        return cfg.plugin_prefs[cfg.STORE_OPTIONS].get(cfg.KEY_CACHE_RESULTS, True)
+
+    def cached_callback(self, callback_fn, menu_key, cache_options=None):
+        '''
+        Wraps callback_fn so that books whose files are unchanged since they
+        were last checked return their cached verdict and log output.
+
+        The wrapper has an is_cached(book_id, db) attribute, for a runner to
+        find out whether the book needs to be read at all before opening it.
+        '''
+        result_cache = self.open_result_cache()
+        if result_cache is None:
+            return callback_fn
+        # Results from an earlier version of the plugin are not reused, as the check may have changed
+        options_hash = hashlib.md5(json.dumps([ActionQualityCheck.version, cache_options],
+                                              sort_keys=True).encode('utf-8')).hexdigest()
+        # The last book looked up on each thread, so that is_cached followed by
+        # evaluating the same book only reads the cache once
+        lookups = threading.local()
+
+        def lookup(book_id, db):
+            found = getattr(lookups, 'found', None)
+            if found is not None and found[0] == book_id:
+                return found[1], found[2]
+            signature = self.get_files_signature(book_id, db)
+            cached = None
+            if signature:
+                cached = result_cache.get_result(menu_key, book_id, signature, options_hash)
+            lookups.found = (book_id, signature, cached)
+            return signature, cached
+
+        def is_cached(book_id, db):
+            return lookup(book_id, db)[1] is not None
+
+        def evaluate_book(book_id, db):
+            signature, cached = lookup(book_id, db)
+            lookups.found = None
+            if cached is not None:
+                matched, log_records = cached
+                for method, args in log_records:
+                    getattr(self.log, method)(*args)
+                return matched
+            self.log.begin_buffer()
+            try:
+                matched = callback_fn(book_id, db)
+            finally:
+                buffered = self.log.end_buffer()
+                buffered.replay(self.log)
+            if signature:
+                result_cache.set_result(menu_key, book_id, signature, options_hash,
+                                        matched, buffered.serializable_records())
+            return matched
+
+        evaluate_book.is_cached = is_cached
+        return evaluate_book
+
+    def open_result_cache(self):
+        '''
+        The result cache of the library, opened when first needed during a run
+        and closed by save_result_cache(), or None if it cannot be opened.
+        Must first be called before the books are evaluated on worker threads.
+        '''
+        if self.result_cache is None and not self.result_cache_failed:
+            try:
+                self.result_cache = ResultCache(get_result_cache_path(self.db))
+            except ResultCacheUnavailable as e:
+                self.result_cache_failed = True
+                self.log.error(_('Unable to open the cache of results, checking every book: %s') % e)
+        return self.result_cache
+
+    def is_result_cached(self, callback_fn, book_id, db):
+        '''
+        Whether callback_fn will return the cached result for this book rather
+        than reading its files
+        '''
+        is_cached = getattr(callback_fn, 'is_cached', None)
+        return is_cached is not None and is_cached(book_id, db)
+
+    def drm_skipping_callback(self, callback_fn):
+        '''
+        Override to wrap callback_fn so that books with DRM are skipped, for
+        checks of formats which can be DRM encrypted
+        '''
+        return callback_fn
+
+    def finish_evaluation(self):
+        '''
+        Override to do anything needed once all the books have been evaluated,
+        before the results are shown
+        '''
+        pass
+
+    def get_files_signature(self, book_id, db):
+        signature = []
+        for fmt in self.result_cache_formats:
+            path_to_book = db.format_abspath(book_id, fmt, index_is_id=True)
+            if not path_to_book:
+                continue
+            try:
+                st = os.stat(path_to_book)
+            except OSError:
+                return None
+            signature.append([fmt, path_to_book, st.st_size, st.st_mtime])
+        return signature
+
+    def save_result_cache(self):
+        result_cache, self.result_cache = self.result_cache, None
+        self.result_cache_failed = False
+        if result_cache is None:
+            return
+        if result_cache.changed:
+            # Drop any books deleted from the library since they were cached
+            result_cache.prune(set(self.db.all_ids()))
+        result_cache.close()
@@ -16,14 +16,20 @@ import os
 from PIL import Image
 from calibre.gui2 import error_dialog
 
+import calibre_plugins.quality_check.config as cfg
 from calibre_plugins.quality_check.check_base import BaseCheck
 from calibre_plugins.quality_check.dialogs import CoverOptionsDialog, ResultsSummaryDialog
+from calibre_plugins.quality_check.helpers import get_image_dimensions
+from calibre_plugins.quality_check.result_cache import (ResultCache, ResultCacheUnavailable,
+                                                        get_result_cache_path)
 
 
 class CoverCheck(BaseCheck):
     '''
     All checks related to working with covers.
     '''
+    supports_parallel = True
+
     def perform_check(self, menu_key):
         if menu_key == 'check_covers':
             self.check_covers()
@@ -53,28 +59,36 @@ class CoverCheck(BaseCheck):
             min_image_width = d.image_width
             min_image_height = d.image_height
 
+        cover_cache = None
+        if not is_file_size_check:
+            cover_cache = self.open_cover_cache()
+        # The (book_id, size, mtime, width, height) of each cover measured on the
+        # worker threads, written to the cover cache once the check is done
+        measured_covers = []
+
         def evaluate_book(book_id, db):
             if not db.has_cover(book_id):
                 return False
             cover_path = os.path.join(db.library_path, db.path(book_id, index_is_id=True), 'cover.jpg')
-            if not os.path.exists(cover_path)or not os.access(cover_path, os.R_OK):
+            try:
+                st = os.stat(cover_path)
+            except OSError:
                 self.log.error('Unable to access cover: ', cover_path)
                 return False
 
             mark_book = False
             if is_file_size_check:
-                cover_size = os.path.getsize(cover_path)
+                cover_size = st.st_size
                 if check_type == 'less than' and cover_size < min_file_size:
                     mark_book = True
                 elif check_type == 'greater than' and cover_size > min_file_size:
                     mark_book = True
             else:
-                try:
-                    im = Image.open(cover_path)
-                except IOError:
+                dimensions = self.get_cover_dimensions(cover_cache, measured_covers, book_id, cover_path, st)
+                if dimensions is None:
                     self.log(_('Failed to identify cover:'), cover_path)
                 else:
-                    (cover_width, cover_height) = im.size
+                    (cover_width, cover_height) = dimensions
                     if check_type == 'less than':
                         if cover_width < min_image_width:
                             mark_book = True
@@ -106,6 +120,8 @@ class CoverCheck(BaseCheck):
         total_count, result_ids, cancelled_msg = self.check_all_files(evaluate_book,
                                                                   marked_text='cover_check',
                                                                   status_msg_type=_('books for covers'))
+        if cover_cache is not None:
+            self.save_cover_cache(cover_cache, measured_covers)
 
         msg = _('Checked %d books, found %d cover matches%s' % (total_count, len(result_ids), cancelled_msg))
         self.gui.status_bar.showMessage(msg)
@@ -118,4 +134,42 @@ class CoverCheck(BaseCheck):
                                      self.log)
             d.exec_()
 
+    def open_cover_cache(self):
+        '''
+        The result cache of the library, which holds the dimensions of each
+        cover, or None if results are not to be reused or it cannot be opened
+        '''
+        if not cfg.plugin_prefs[cfg.STORE_OPTIONS].get(cfg.KEY_CACHE_RESULTS, True):
+            return None
+        try:
+            return ResultCache(get_result_cache_path(self.db))
+        except ResultCacheUnavailable as e:
+            self.log.error(_('Unable to open the cache of cover dimensions, reading every cover: %s') % e)
+            return None
+
+    def get_cover_dimensions(self, cover_cache, measured_covers, book_id, cover_path, st):
+        '''
+        The (width, height) of the cover, from the cache if the cover file is
+        unchanged since last measured, otherwise read from the image header
+        and added to measured_covers
+        '''
+        if cover_cache is not None:
+            dimensions = cover_cache.get_cover_dimensions(book_id, st.st_size, st.st_mtime)
+            if dimensions is not None:
+                return dimensions
+        try:
+            dimensions = get_image_dimensions(cover_path)
+            if dimensions is None:
+                # Not a format we can read the header of, let PIL work it out
+                dimensions = Image.open(cover_path).size
+        except (IOError, OSError):
+            return None
+        measured_covers.append((book_id, st.st_size, st.st_mtime, dimensions[0], dimensions[1]))
+        return dimensions
 
+    def save_cover_cache(self, cover_cache, measured_covers):
+        if measured_covers:
+            cover_cache.set_cover_dimensions(measured_covers)
+            # Drop any books deleted from the library since they were cached
+            cover_cache.prune(set(self.db.all_ids()))
+        cover_cache.close()
@@ -11,8 +11,8 @@ try:
 except NameError:
     pass # load_translations() added in calibre 1.9
 
-from polyglot.builtins import unicode_type, is_py3
-import traceback, os, posixpath, six.moves.urllib.request, six.moves.urllib.parse, six.moves.urllib.error, re
+from polyglot.builtins import unicode_type
+import calendar, threading, time, traceback, os, posixpath, six.moves.urllib.request, six.moves.urllib.parse, six.moves.urllib.error, re
 try:
     from cgi import escape as esc
 except:
@@ -28,11 +28,19 @@ from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
 from calibre.ebooks.metadata.epub import Encryption
 from calibre.ebooks.oeb.base import XPath
 from calibre.ebooks.oeb.parse_utils import RECOVER_PARSER, NotHTML, parse_html
-from calibre.utils.zipfile import ZipFile
 
+import calibre_plugins.quality_check.config as cfg
 from calibre_plugins.quality_check.check_base import BaseCheck
 from calibre_plugins.quality_check.common_utils import get_title_authors_text
-from calibre_plugins.quality_check.dialogs import SearchEpubDialog
+from calibre_plugins.quality_check.dialogs import (SearchEpubDialog, MultipleEpubChecksDialog,
+                                                   CheckProfileDialog, ResultsSummaryDialog)
+from calibre_plugins.quality_check.epub_book import EpubBook, parsed_epub_cache
+from calibre_plugins.quality_check.instrumentation import (instrumentation, PHASE_OPF_PARSE, PHASE_REGEX,
+                                        PHASE_XML_DECODE, PHASE_XML_PARSE)
+from calibre_plugins.quality_check.search_index import (EpubSearchIndex, SearchIndexUnavailable,
+                                        get_search_index_path, get_required_literals,
+                                        SCOPE_PLAINTEXT, SCOPE_HTML, SCOPE_CSS, SCOPE_OPF,
+                                        SCOPE_NCX, SCOPE_ZIP)
 
 META_INF = {
         'container.xml' : True,
@@ -64,9 +72,33 @@ ENCRYPTION_PATH = 'META-INF/encryption.xml'
 RE_HTML_BODY = re.compile(u'<body[^>]*>(.*)</body>', re.UNICODE | re.DOTALL)
 RE_STRIP_MARKUP = re.compile(u'<[^>]+>', re.UNICODE)
 RE_WHITESPACE = re.compile(u'\s+', re.UNICODE | re.DOTALL)
+# For finding the resources referenced from lower cased html content
+RE_IMAGE_TAG = re.compile(r'<(?:[a-z]*?\:)*?ima?ge?\b[^>]*>', re.UNICODE)
+RE_LINK_HREF = re.compile(r'<\s*link\b[^>]*?\shref\s*=\s*"([^"]*)"', re.UNICODE)
+RE_QUOTED_VALUE = re.compile(r'"([^"]*)"', re.UNICODE)
+# The patterns searched for by the individual checks, in the lower cased content
+# unless noted, compiled once rather than each time a check is run
+RE_XPGT_LINK = re.compile(r'<link[^>]+?href\s*=\s*".*?\.xpgt"[^>]*?>', re.UNICODE)
+RE_CSS_IMPORT1 = re.compile(r'@import url\([\'\"]*(.*?)[\'"]*\)', re.UNICODE | re.DOTALL)
+RE_CSS_IMPORT2 = re.compile(r'@import\s+"(.*?)"', re.UNICODE | re.DOTALL)
+RE_IMAGE = re.compile(r'<(?:[a-z]*?\:)*?image[^>]*href=?"([^"]*?)"', re.UNICODE)
+RE_IMG = re.compile(r'<(?:[a-z]*?\:)*?img[^>]*src="([^"]*?)"', re.UNICODE)
+RE_DRM_META = re.compile(r'<meta [^>]*?name="adept\.[expctd\.]*?resource"', re.UNICODE)
+RE_ADDRESS = re.compile(r'</address>', re.UNICODE)
+RE_FONT_FACE = re.compile(r'@font\-face', re.UNICODE)
+RE_TEXT_ALIGN = re.compile(r'text\-align:\s*justify', re.UNICODE)
+# Case sensitive, as the html is searched as is
+RE_JAVASCRIPT = re.compile(r'<script [^>]+?type\s*=\s*"text/javascript"[^>]*?>')
+# The body or @page css declarations which set margins
+RE_BOOK_MGNS = re.compile(r'(#\w+\s+)?(?P<selector>\bbody|@page)\b\s*{(?P<styles>[^}]+margin[^}]+);?\s*\}', re.UNICODE)
+# As above but ignoring any class named body, for comparing with the page setup margins
+RE_BOOK_MGNS_CSS = re.compile(r'(#\w+\s+)?(?P<selector>(?<!\.)\bbody|@page)\b\s*{(?P<styles>[^}]*margin[^}]+);?\s*\}', re.UNICODE)
+RE_TRAILING_SEMICOLONS = re.compile(r'\s*;$', re.UNICODE)
+RE_NON_NUMERIC = re.compile(r'[^\d.]+', re.UNICODE)
 
 OCF_NS = 'urn:oasis:names:tc:opendocument:xmlns:container'
 OPF_NS = 'http://www.idpf.org/2007/opf'
+OEB_PACKAGE_NS = 'http://openebook.org/namespaces/oeb-package/1.0/'
 
 class InvalidEpub(ValueError):
     pass
@@ -75,10 +107,18 @@ class EpubCheck(BaseCheck):
     '''
     All checks related to working with ePub formats.
     '''
+    supports_parallel = True
+    result_cache_formats = ['EPUB']
+
     def __init__(self, gui):
         BaseCheck.__init__(self, gui, 'formats:epub')
-        self.html_preprocessor = HTMLPreProcessor()
         self.input_encoding = 'utf-8'
+        # The book currently open for all checks in a multiple check pass
+        self._shared_book = threading.local()
+        c = cfg.plugin_prefs[cfg.STORE_OPTIONS]
+        parsed_epub_cache.set_max_bytes(c.get(cfg.KEY_PARSED_CACHE_MB, 64) * 1024 * 1024)
+        # The books skipped by the checks which do not evaluate books with DRM
+        self.drm_skipped_ids = set()
 
     def perform_check(self, menu_key):
         if menu_key == 'check_epub_jacket':
@@ -176,6 +216,10 @@ class EpubCheck(BaseCheck):
 
         elif menu_key == 'search_epub':
             self.search_epub()
+        elif menu_key == 'check_epub_multiple':
+            self.check_epub_multiple()
+        elif menu_key == 'check_epub_profile':
+            self.check_epub_profile()
 
         else:
             return error_dialog(self.gui, _('Quality Check failed'),
@@ -183,10 +227,188 @@ class EpubCheck(BaseCheck):
                                 show=True, show_copy_button=False)
 
     def zf_read(self, zf, name):
-        data = zf.read(name)
-        if is_py3:
-            return data.decode('utf-8', errors='replace')
-        return data
+        return zf.read_text(name)
+
+    def check_epub_multiple(self):
+        '''
+        Run the ePub checks chosen by the user in a single pass of the library
+        '''
+        d = MultipleEpubChecksDialog(self.gui)
+        d.exec_()
+        if d.result() != d.Accepted:
+            return
+        self.run_checks_together(d.selected_menu_keys)
+
+    def check_epub_profile(self):
+        '''
+        Run a saved set of ePub checks, reading only the books added or changed
+        since the profile was last run and keeping its results for the rest
+        '''
+        db = self.db
+        d = CheckProfileDialog(self.gui, db)
+        d.exec_()
+        if d.result() != d.Accepted:
+            return
+        profiles = cfg.get_library_check_profiles(db)
+        profile = profiles.get(d.profile_name, {})
+        last_run = profile.get('lastRun')
+        if d.check_all_books or sorted(profile.get('menuKeys', [])) != sorted(d.selected_menu_keys):
+            last_run = None
+
+        # The mark must be taken before reading any book, so a book changed
+        # while the checks are running is read again next time
+        start_time = time.time()
+        self.gui.search.clear()
+        # The whole library rather than any virtual library, as the results
+        # kept for the unchanged books must cover every book
+        book_ids = list(db.all_ids())
+        previous_results = None
+        if last_run:
+            changed_ids = self.get_books_changed_since(book_ids, last_run)
+            changed_ids_set = set(changed_ids)
+            valid_ids = set(book_ids)
+            previous_results = dict((menu_key, [i for i in ids if i in valid_ids and i not in changed_ids_set])
+                                    for menu_key, ids in profile.get('results', {}).items())
+            self.log(_('Profile last run %s, checking %d of %d books changed since then') %
+                     (time.strftime('%Y-%m-%d %H:%M', time.localtime(last_run)), len(changed_ids), len(book_ids)))
+            book_ids = changed_ids
+
+        checks = self.run_checks_together(d.selected_menu_keys, book_ids, previous_results)
+        if checks is None:
+            # Cancelled, so the books not yet read must be read next time
+            return
+        profiles = cfg.get_library_check_profiles(db)
+        profiles[d.profile_name] = {'menuKeys': d.selected_menu_keys, 'lastRun': start_time,
+                                    'results': dict((check['menu_key'], sorted(check['result_ids']))
+                                                    for check in checks)}
+        cfg.set_library_check_profiles(db, profiles)
+
+    def get_books_changed_since(self, book_ids, since):
+        '''
+        The books whose metadata or ePub file has been modified since the
+        given time in seconds since the epoch, which includes any added since
+        '''
+        db = self.db
+        last_modified = db.new_api.all_field_for('last_modified', book_ids)
+        changed_ids = []
+        for book_id in book_ids:
+            modified = last_modified[book_id]
+            if modified is None or calendar.timegm(modified.utctimetuple()) >= since:
+                changed_ids.append(book_id)
+                continue
+            # Replacing a format does not always update the last modified date
+            for fmt in self.result_cache_formats:
+                path_to_book = db.format_abspath(book_id, fmt, index_is_id=True)
+                if not path_to_book:
+                    continue
+                try:
+                    if os.stat(path_to_book).st_mtime >= since:
+                        changed_ids.append(book_id)
+                        break
+                except OSError:
+                    # Leave the checks to report the problem reading this book
+                    changed_ids.append(book_id)
+                    break
+        return changed_ids
+
+    def run_checks_together(self, menu_keys, book_ids=None, previous_results=None):
+        '''
+        Evaluate several checks opening each ePub only once. Every check still
+        honours its own exclusions and marks the books it matches with its
+        own marked text.
+
+        :param book_ids: The books to read, rather than the current search scope
+        :param previous_results: The ids matched by each check in an earlier run
+                                 for the books not being read again this time
+        :return: The checks with the ids each matched, or None if cancelled
+        '''
+        db = self.db
+        self.collected_checks = []
+        try:
+            for menu_key in menu_keys:
+                self.menu_key = menu_key
+                self.perform_check(menu_key)
+        finally:
+            checks, self.collected_checks = self.collected_checks, None
+            self.menu_key = None
+        if not checks:
+            return
+        for check in checks:
+            check['excluded_ids'] = cfg.get_excluded_book_set(db, check['menu_key'])
+            check['result_ids'] = set()
+
+        def evaluate_book(book_id, db):
+            book_checks = [check for check in checks if book_id not in check['excluded_ids']]
+            path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
+            book = None
+            # There is no need to open the book when every check has its result cached
+            if path_to_book and not all(self.is_result_cached(check['callback_fn'], book_id, db)
+                                        for check in book_checks):
+                try:
+                    book = EpubBook(path_to_book, shared=True)
+                except:
+                    # Leave each check to report the problem opening this book
+                    book = None
+            self._shared_book.book = book
+            try:
+                matched = False
+                for check in book_checks:
+                    if check['callback_fn'](book_id, db):
+                        check['result_ids'].add(book_id)
+                        matched = True
+                return matched
+            finally:
+                self._shared_book.book = None
+                if book is not None:
+                    book.close()
+
+        if book_ids is None:
+            total_count, result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
+                                            status_msg_type=_('ePub books for %d checks')%len(checks))
+        elif book_ids:
+            self.book_ids = book_ids
+            total_count, result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
+                                            status_msg_type=_('ePub books for %d checks')%len(checks))
+        else:
+            total_count, result_ids, cancelled_msg = 0, [], ''
+        if previous_results:
+            result_ids = list(result_ids)
+            matched_ids = set(result_ids)
+            for check in checks:
+                for book_id in previous_results.get(check['menu_key'], []):
+                    if book_id in check['excluded_ids']:
+                        continue
+                    check['result_ids'].add(book_id)
+                    if book_id not in matched_ids:
+                        matched_ids.add(book_id)
+                        result_ids.append(book_id)
+
+        if self.gui is None:
+            for check in checks:
+                self.results.append({'menu_key': check['menu_key'], 'marked_text': check['marked_text'],
+                                     'total_count': total_count,
+                                     'result_ids': [i for i in result_ids if i in check['result_ids']]})
+            return None if cancelled_msg else checks
+
+        marked_ids = {}
+        for check in checks:
+            name = cfg.PLUGIN_MENUS[check['menu_key']]['name']
+            self.log(_('<b>%s</b>: %d matches, marked as: %s')%(name, len(check['result_ids']), check['marked_text']))
+            for book_id in result_ids:
+                if book_id in check['result_ids']:
+                    if book_id in marked_ids:
+                        marked_ids[book_id] += ',' + check['marked_text']
+                    else:
+                        marked_ids[book_id] = check['marked_text']
+        if marked_ids:
+            db.set_marked_ids(marked_ids)
+            self.gui.search.set_search_string('marked:true')
+        msg = _('Checked %d books with %d checks, found %d matches%s') % \
+                    (total_count, len(checks), len(result_ids), cancelled_msg)
+        self.gui.status_bar.showMessage(msg)
+        sd = ResultsSummaryDialog(self.gui, 'Quality Check', msg, self.log, timings=self.timings)
+        sd.exec_()
+        return None if cancelled_msg else checks
 
     def search_epub(self):
         '''
@@ -211,6 +433,10 @@ class EpubCheck(BaseCheck):
                 return False
 
             def search_for_match(text, show_all_matches):
+                with instrumentation.phase(PHASE_REGEX):
+                    return find_matches(text, show_all_matches)
+
+            def find_matches(text, show_all_matches):
                 matches = []
                 text = text.replace('&nbsp;', ' ')
                 for m in self.search_expression.finditer(text):
@@ -239,7 +465,7 @@ class EpubCheck(BaseCheck):
 
             try:
                 show_all_matches = self.search_opts['show_all_matches']
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     log_lines = []
                     for resource_name in contents:
@@ -255,7 +481,7 @@ class EpubCheck(BaseCheck):
                         elif extension in NCX_FILES:
                             check_file = self.search_opts['scope_ncx']
                         if check_file:
-                            content = zf.read(resource_name).decode('utf-8',errors='replace')
+                            content = self.zf_read(zf, resource_name)
                             if extract_body_text:
                                 content = self._extract_body_text(content)
                             if search_for_match(content, show_all_matches):
@@ -284,10 +510,113 @@ class EpubCheck(BaseCheck):
                 self.log(traceback.format_exc())
                 return False
 
-        self.check_all_files(evaluate_book,
-                             no_match_msg=_('No searched ePub books have your search text'),
+        check_options = dict(no_match_msg=_('No searched ePub books have your search text'),
                              marked_text='epub_search_text',
-                             status_msg_type=_('ePub books for search text'))
+                             status_msg_type=_('ePub books for search text'),
+                             use_cache=False,
+                             max_matches=self.search_opts.get('max_matches', 0) or None,
+                             live_results=self.search_opts.get('live_results', False))
+        index = None
+        if self.search_opts.get('use_index', False):
+            index = self._open_search_index()
+        if index is None:
+            self.check_all_files(evaluate_book, **check_options)
+            return
+
+        # Only the books the index says could match, or which have changed
+        # since they were indexed, need to be searched
+        literals = get_required_literals(self.search_opts['previous_finds'][0], re_options)
+        candidate_ids = None
+        if literals:
+            try:
+                candidate_ids = index.find_candidates(literals, self._get_search_index_scopes())
+            except Exception:
+                self.log.error(_('Unable to query the search index, searching every book'))
+                self.log(traceback.format_exc())
+        else:
+            self.log(_('The search index cannot be used for this expression, searching every book'))
+
+        def evaluate_indexed_book(book_id, db):
+            path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
+            if not path_to_book:
+                return evaluate_book(book_id, db)
+            signature = index.get_signature(path_to_book)
+            if index.is_current(book_id, signature):
+                if candidate_ids is not None and book_id not in candidate_ids:
+                    return False
+                return evaluate_book(book_id, db)
+            try:
+                book = EpubBook(path_to_book, shared=True)
+            except:
+                # Leave the search to report the problem opening this book
+                return evaluate_book(book_id, db)
+            self._shared_book.book = book
+            try:
+                try:
+                    index.update_book(book_id, signature, self._get_search_index_text(book))
+                except:
+                    self.log.error(_('Unable to index book: '), path_to_book)
+                    self.log(traceback.format_exc())
+                return evaluate_book(book_id, db)
+            finally:
+                self._shared_book.book = None
+                book.close()
+
+        try:
+            self.check_all_files(evaluate_indexed_book, **check_options)
+            index.prune(set(self.db.all_ids()))
+        finally:
+            index.close()
+
+    def _open_search_index(self):
+        try:
+            return EpubSearchIndex(get_search_index_path(self.db))
+        except SearchIndexUnavailable as e:
+            self.log.error(_('The search index is not available, searching every book:'), e)
+        except:
+            self.log.error(_('Unable to open the search index, searching every book'))
+            self.log(traceback.format_exc())
+        return None
+
+    def _get_search_index_scopes(self):
+        '''
+        The columns of the search index to look in for the chosen search options
+        '''
+        scopes = []
+        if self.search_opts['scope_plaintext']:
+            scopes.append(SCOPE_PLAINTEXT)
+        elif self.search_opts['scope_html']:
+            scopes.append(SCOPE_HTML)
+        for scope in [SCOPE_CSS, SCOPE_OPF, SCOPE_NCX, SCOPE_ZIP]:
+            if self.search_opts['scope_' + scope]:
+                scopes.append(scope)
+        return scopes
+
+    def _get_search_index_text(self, zf):
+        '''
+        The text of every scope of the book as searched by search_epub, so the
+        index can be used whatever scopes are chosen for later searches
+        '''
+        scope_text = dict((scope, []) for scope in [SCOPE_PLAINTEXT, SCOPE_HTML, SCOPE_CSS,
+                                                    SCOPE_OPF, SCOPE_NCX, SCOPE_ZIP])
+        for resource_name in zf.namelist():
+            extension = resource_name[resource_name.rfind('.'):].lower()
+            scope = None
+            if extension not in NON_HTML_FILES:
+                scope = SCOPE_HTML
+            elif extension in CSS_FILES:
+                scope = SCOPE_CSS
+            elif extension in OPF_FILES:
+                scope = SCOPE_OPF
+            elif extension in NCX_FILES:
+                scope = SCOPE_NCX
+            if scope is not None:
+                content = self.zf_read(zf, resource_name)
+                if scope == SCOPE_HTML:
+                    scope_text[SCOPE_PLAINTEXT].append(self._extract_body_text(content).replace('&nbsp;', ' '))
+                scope_text[scope].append(content.replace('&nbsp;', ' '))
+            scope_text[SCOPE_ZIP].append(os.path.basename(resource_name))
+        return dict((scope, '\n'.join(text)) for scope, text in scope_text.items())
 
 
     def check_epub_jacket(self, check_has_jacket, check_legacy_only=False):
@@ -298,7 +627,7 @@ class EpubCheck(BaseCheck):
                 self.log.error(_('ERROR: EPUB format is missing: '), get_title_authors_text(db, book_id))
                 return not check_has_jacket
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         if 'jacket' in resource_name and resource_name.endswith('.xhtml'):
                             html = zf.read(resource_name).decode('utf-8')
@@ -339,7 +668,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 jacket_count = 0
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         if 'jacket' in resource_name and resource_name.endswith('.xhtml'):
                             html = self.zf_read(zf, resource_name)
@@ -387,7 +716,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         for mt in TEMPLATE_MIME_TYPES:
@@ -421,10 +750,6 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_inline_xpgt_links(self):
-        RE_LINK = re.compile(r'<link[^>]+?href\s*=\s*".*?\.xpgt"[^>]*?>', re.UNICODE)
-        RE_CSS_IMPORT1 = re.compile(r'@import url\([\'\"]*(.*?)[\'"]*\)', re.UNICODE | re.DOTALL)
-        RE_CSS_IMPORT2 = re.compile(r'@import\s+"(.*?)"', re.UNICODE | re.DOTALL)
-
         def check_for_import_xpgt(data):
             for match in RE_CSS_IMPORT1.finditer(data):
                 self.log('Match1', match.group(0))
@@ -441,7 +766,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', self._get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     for resource_name in contents:
                         extension = resource_name[resource_name.rfind('.'):].lower()
@@ -454,7 +779,7 @@ class EpubCheck(BaseCheck):
                             continue
                         else:
                             data = self.zf_read(zf, resource_name).lower()
-                            if RE_LINK.search(data):
+                            if self._regex_search(RE_XPGT_LINK, data):
                                 return True
                             self.log(_('Checking html import'), resource_name)
                             if check_for_import_xpgt(data):
@@ -485,7 +810,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         manifest_items_map = self._get_opf_items_map(zf, opf_name)
@@ -529,7 +854,6 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_unused_css_files(self):
-        RE_CSS = r'<\s*link.*?\s+href\s*=\s*"[^"]*%s"'
 
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
@@ -537,46 +861,35 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.namelist()
-                    if self._is_drm_encrypted(zf, contents):
-                        self.log.error(_('SKIPPING BOOK (DRM Encrypted): '), get_title_authors_text(db, book_id))
-                        return False
-                    # Build a list of regexes for all the css files in this epub
-                    css_regexes = {}
+                with self._open_epub(path_to_book) as zf:
+                    # Build the names of all the css files in this epub as they may be referenced
+                    css_names = {}
                     html_resource_names = []
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in CSS_FILES:
                             try:
-                                css = os.path.basename(resource_name).lower()
-                                css_enc = six.moves.urllib.request.pathname2url(css).lower()
+                                css_names[resource_name] = self._reference_names(resource_name)
                             except:
                                 self.log.error(_('ERROR parsing book: '), path_to_book)
                                 self.log.error(_('\tIssue with CSS name: '), resource_name)
                                 self.log(traceback.format_exc())
                                 return False
-                            css_regexes[resource_name] = [re.compile(RE_CSS % css, re.UNICODE)]
-                            if css_enc != css:
-                                css_regexes[resource_name].append(re.compile(RE_CSS % css_enc, re.UNICODE))
                         elif extension not in NON_HTML_FILES:
                             html_resource_names.append(resource_name)
 
-                    if css_regexes and html_resource_names:
+                    if css_names and html_resource_names:
+                        css_keys_by_name = self._index_reference_names(css_names)
                         for resource_name in html_resource_names:
-                            data = self.zf_read(zf, resource_name).lower()
-                            css_keys = list(css_regexes.keys())
-                            for css_key in css_keys:
-                                regexes = css_regexes[css_key]
-                                for css_regex in regexes:
-                                    if css_regex.search(data):
-                                        css_regexes.pop(css_key)
-                                        break
-                            if not css_regexes:
+                            for data in zf.iter_text(resource_name):
+                                for name in self._find_link_references(data.lower()):
+                                    for css_key in css_keys_by_name.pop(name, []):
+                                        css_names.pop(css_key, None)
+                            if not css_names:
                                 break
-                    if css_regexes:
+                    if css_names:
                         self.log(get_title_authors_text(db, book_id))
-                        for resource_name in css_regexes.keys():
+                        for resource_name in css_names.keys():
                             self.log(_('\tUnused CSS file: %s')%resource_name)
                         return True
                     return False
@@ -592,11 +905,11 @@ class EpubCheck(BaseCheck):
         self.check_all_files(evaluate_book,
                              no_match_msg=_('No searched ePub books have unused CSS files'),
                              marked_text='epub_unused_css_files',
-                             status_msg_type=_('ePub books for unused CSS files'))
+                             status_msg_type=_('ePub books for unused CSS files'),
+                             skip_drm=True)
 
 
     def check_epub_unused_images(self):
-        RE_IMAGE = r'<(?:[a-z]*?\:)*?ima?ge?[^>]*?"[^"]*?%s"'
 
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
@@ -604,13 +917,9 @@ class EpubCheck(BaseCheck):
                 self.log.error(_('ERROR: EPUB format is missing: '), get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.namelist()
-                    if self._is_drm_encrypted(zf, contents):
-                        self.log.error(_('SKIPPING BOOK (DRM Encrypted): '), get_title_authors_text(db, book_id))
-                        return False
-                    # Build a list of regexes for all the image files in this epub
-                    image_regexes = {}
+                with self._open_epub(path_to_book) as zf:
+                    # Build the names of all the image files in this epub as they may be referenced
+                    image_names = {}
                     html_resource_names = []
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
@@ -618,34 +927,27 @@ class EpubCheck(BaseCheck):
                             # Use the base name for the image since relative path might differ from html
                             # compared to the opf manifest
                             try:
-                                image = os.path.basename(resource_name).lower()
-                                image_enc = six.moves.urllib.request.pathname2url(image).lower()
+                                image_names[resource_name] = self._reference_names(resource_name)
                             except:
                                 self.log.error('ERROR parsing book: ', path_to_book)
                                 self.log.error(_('\tIssue with image name: '), resource_name)
                                 self.log(traceback.format_exc())
                                 return False
-                            image_regexes[resource_name] = [re.compile(RE_IMAGE % image, re.UNICODE)]
-                            if image_enc != image:
-                                image_regexes[resource_name].append(re.compile(RE_IMAGE % image_enc, re.UNICODE))
                         elif extension not in NON_HTML_FILES:
                             html_resource_names.append(resource_name)
 
-                    if image_regexes and html_resource_names:
+                    if image_names and html_resource_names:
+                        image_keys_by_name = self._index_reference_names(image_names)
                         for resource_name in html_resource_names:
-                            data = self.zf_read(zf, resource_name).lower()
-                            image_keys = list(image_regexes.keys())
-                            for image_key in image_keys:
-                                regexes = image_regexes[image_key]
-                                for image_regex in regexes:
-                                    if image_regex.search(data):
-                                        image_regexes.pop(image_key)
-                                        break
-                            if not image_regexes:
+                            for data in zf.iter_text(resource_name):
+                                for name in self._find_image_references(data.lower()):
+                                    for image_key in image_keys_by_name.pop(name, []):
+                                        image_names.pop(image_key, None)
+                            if not image_names:
                                 break
-                    if image_regexes:
+                    if image_names:
                         self.log(get_title_authors_text(db, book_id))
-                        for resource_name in image_regexes.keys():
+                        for resource_name in image_names.keys():
                             self.log(_('\tUnused image file: %s')%resource_name)
                         return True
                     return False
@@ -661,24 +963,18 @@ class EpubCheck(BaseCheck):
         self.check_all_files(evaluate_book,
                              no_match_msg=_('No searched ePub books have unused image files'),
                              marked_text='epub_unused_images',
-                             status_msg_type=_('ePub books for unused image files'))
+                             status_msg_type=_('ePub books for unused image files'),
+                             skip_drm=True)
 
 
     def check_epub_broken_image_links(self):
-        RE_IMAGE = re.compile(r'<(?:[a-z]*?\:)*?image[^>]*href=?"([^"]*?)"', re.UNICODE)
-        RE_IMG = re.compile(r'<(?:[a-z]*?\:)*?img[^>]*src="([^"]*?)"', re.UNICODE)
-
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
             if not path_to_book:
                 self.log.error(_('ERROR: EPUB format is missing: '), get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.namelist()
-                    if self._is_drm_encrypted(zf, contents):
-                        self.log.error(_('SKIPPING BOOK (DRM Encrypted): '), get_title_authors_text(db, book_id))
-                        return False
+                with self._open_epub(path_to_book) as zf:
                     # Build a list of all the image files in this epub
                     image_map = {}
                     html_resource_names = []
@@ -730,7 +1026,8 @@ class EpubCheck(BaseCheck):
         self.check_all_files(evaluate_book,
                              no_match_msg=_('No searched ePub books have broken image links'),
                              marked_text='epub_broken_image_links',
-                             status_msg_type=_('ePub books for broken image links'))
+                             status_msg_type=_('ePub books for broken image links'),
+                             skip_drm=True)
 
 
     def check_epub_files(self, files, text, marked, show_log=True):
@@ -744,7 +1041,7 @@ class EpubCheck(BaseCheck):
             try:
                 match = False
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     for resource_name in contents:
                         found = False
@@ -804,7 +1101,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_has_cover
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if not opf_name:
                         self.log.error(_('No OPF file in:'), get_title_authors_text(db, book_id))
@@ -853,15 +1150,14 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_has_svg_cover
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         cover_name = self._get_opf_item(zf, opf_name,
                                     xpath=r'child::opf:guide/opf:reference'
                                            '[@type="cover"and @href]')
                         if cover_name and cover_name.endswith('.xhtml'):
-                            html = self.zf_read(zf, cover_name)
-                            data = self._parse_xhtml(html, cover_name)
+                            data = self._get_xhtml_tree(zf, cover_name)
                             metas = XPath('//h:meta[@content="true" and @name="calibre:cover"]')(data)
                             if len(metas):
                                 svg = XPath('//svg:svg')(data)
@@ -900,7 +1196,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_has_cover
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         cover_name = self._get_opf_item(zf, opf_name,
@@ -940,7 +1236,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_converted
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         opf_xml = self.zf_read(zf, opf_name)
@@ -976,7 +1272,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         return False
@@ -1003,7 +1299,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if 'META-INF/container.xml' not in contents:
                         # We have no container xml so file is completely knackered
@@ -1043,7 +1339,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         opf = self._get_opf_tree(zf, opf_name)
@@ -1084,13 +1380,12 @@ class EpubCheck(BaseCheck):
             try:
                 displayed_path = False
                 missing = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         manifest_items_map = self._get_opf_items_map(zf, opf_name)
-                        contents = zf.namelist()
                         for resource_name in manifest_items_map:
-                            if resource_name not in contents:
+                            if not zf.has_name(resource_name):
                                 if not displayed_path:
                                     displayed_path = True
                                     self.log(_('Manifest file missing from: <b>%s</b>')%get_title_authors_text(db, book_id))
@@ -1120,15 +1415,11 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.namelist()
-                    if self._is_drm_encrypted(zf, contents):
-                        self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
-                        return False
+                with self._open_epub(path_to_book) as zf:
                     for name in self._manifest_worthy_names(zf):
                         if name.endswith('.ncx'):
                             try:
-                                ncx = self._parse_xml(self.zf_read(zf, name))
+                                ncx = self._get_ncx_tree(zf, name)
                                 nested = ncx.xpath(r'descendant::ncx:navPoint/ncx:navPoint',
                                                    namespaces={'ncx':NCX_NS})
                                 if len(nested) > 0:
@@ -1149,7 +1440,8 @@ class EpubCheck(BaseCheck):
         self.check_all_files(evaluate_book,
                              no_match_msg=_('All searched ePub books have a flattened NCX TOC'),
                              marked_text='epub_ncx_toc_hierarchical',
-                             status_msg_type=_('ePub books for NCX TOC hierarchy'))
+                             status_msg_type=_('ePub books for NCX TOC hierarchy'),
+                             skip_drm=True)
 
 
     def check_epub_toc_size(self):
@@ -1161,11 +1453,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 count = None
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.namelist()
-                    if self._is_drm_encrypted(zf, contents):
-                        self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
-                        return False
+                with self._open_epub(path_to_book) as zf:
                     for name in self._manifest_worthy_names(zf):
                         if name.endswith('.ncx'):
                             try:
@@ -1195,7 +1483,8 @@ class EpubCheck(BaseCheck):
         self.check_all_files(evaluate_book,
                              no_match_msg=_('All searched ePub books have a NCX TOC with at least 3 items'),
                              marked_text='epub_ncx_toc_too_small',
-                             status_msg_type=_('ePub books for NCX TOC count'))
+                             status_msg_type=_('ePub books for NCX TOC count'),
+                             skip_drm=True)
 
 
     def check_epub_toc_broken_links(self):
@@ -1207,11 +1496,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 broken_links = []
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.namelist()
-                    if self._is_drm_encrypted(zf, contents):
-                        self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
-                        return False
+                with self._open_epub(path_to_book) as zf:
                     manifest_names = list(self._manifest_worthy_names(zf))
                     html_names_map = dict((os.path.normpath(six.moves.urllib.request.url2pathname(k)),True) for k in manifest_names
                                           if k[k.rfind('.'):].lower() not in NON_HTML_FILES)
@@ -1221,7 +1506,7 @@ class EpubCheck(BaseCheck):
                             if ncx_dir:
                                 ncx_dir += '/'
                             try:
-                                ncx = self._parse_xml(self.zf_read(zf, name))
+                                ncx = self._get_ncx_tree(zf, name)
                                 src_nodes = ncx.xpath(r'descendant::ncx:content/@src',
                                                    namespaces={'ncx':NCX_NS})
                                 for src_node in src_nodes:
@@ -1252,7 +1537,8 @@ class EpubCheck(BaseCheck):
         self.check_all_files(evaluate_book,
                              no_match_msg=_('All searched ePub books have a NCX TOC with valid links'),
                              marked_text='epub_ncx_toc_broken_links',
-                             status_msg_type=_('ePub books for broken NCX TOC links'))
+                             status_msg_type=_('ePub books for broken NCX TOC links'),
+                             skip_drm=True)
 
 
     def check_epub_guide_broken_links(self):
@@ -1264,7 +1550,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 broken_links = []
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         manifest_items_map = self._get_opf_items_map(zf, opf_name, rebase_href=False)
@@ -1309,7 +1595,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.infolist()
                     for resource in contents:
                         if resource.file_size > MAX_SIZE:
@@ -1344,10 +1630,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.namelist()
-                    return self._is_drm_encrypted(zf, contents)
-                return False
+                return self._is_drm_book(book_id, path_to_book)
 
             except InvalidEpub as e:
                 self.log.error('Invalid epub:', e)
@@ -1357,6 +1640,8 @@ class EpubCheck(BaseCheck):
                 self.log(traceback.format_exc())
                 return False
 
+        # Open the DRM index before the books are evaluated
+        self._open_drm_index()
         self.check_all_files(evaluate_book,
                              no_match_msg=_('No searched ePub books have DRM'),
                              marked_text='epub_drm',
@@ -1364,22 +1649,19 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_drm_meta(self):
-        RE_DRM_META = re.compile(r'<meta [^>]*?name="adept\.[expctd\.]*?resource"', re.UNICODE)
-
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
             if not path_to_book:
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in NON_HTML_FILES:
                             continue
                         else:
-                            data = self.zf_read(zf, resource_name).lower()
-                            if RE_DRM_META.search(data):
+                            if self._search_resource(zf, resource_name, RE_DRM_META):
                                 return True
                     return False
 
@@ -1398,22 +1680,19 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_address(self):
-        RE_ADDRESS = re.compile(r'</address>', re.UNICODE)
-
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
             if not path_to_book:
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in NON_HTML_FILES:
                             continue
                         else:
-                            data = self.zf_read(zf, resource_name).lower()
-                            if RE_ADDRESS.search(data):
+                            if self._search_resource(zf, resource_name, RE_ADDRESS):
                                 return True
                     return False
 
@@ -1441,7 +1720,7 @@ class EpubCheck(BaseCheck):
             try:
                 found = False
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in FONT_FILES:
@@ -1467,26 +1746,22 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_font_faces(self):
-        RE_FONT_FACE = re.compile(r'@font\-face', re.UNICODE)
-
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
             if not path_to_book:
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in CSS_FILES:
-                            css = self.zf_read(zf, resource_name).lower()
-                            if RE_FONT_FACE.search(css):
+                            if self._search_resource(zf, resource_name, RE_FONT_FACE):
                                 self.log(_('CSS file contains @font-face: <b>%s</b>')%get_title_authors_text(db, book_id))
                                 self.log('\t<span style="color:darkgray">%s</span>'%resource_name)
                                 return True
                         elif extension not in NON_HTML_FILES:
-                            data = self.zf_read(zf, resource_name).lower()
-                            if RE_FONT_FACE.search(data):
+                            if self._search_resource(zf, resource_name, RE_FONT_FACE):
                                 self.log(_('At least one html file contains @font-face: <b>%s</b>')%get_title_authors_text(db, book_id))
                                 self.log('\t<span style="color:darkgray">%s</span>'%resource_name)
                                 return True
@@ -1507,19 +1782,16 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_css_justify(self):
-        RE_TEXT_ALIGN = re.compile(r'text\-align:\s*justify', re.UNICODE)
-
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
             if not path_to_book:
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         if resource_name.lower().endswith('css'):
-                            css = self.zf_read(zf, resource_name).lower()
-                            if RE_TEXT_ALIGN.search(css):
+                            if self._search_resource(zf, resource_name, RE_TEXT_ALIGN):
                                 return False
                 return True
 
@@ -1538,16 +1810,13 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_css_margins(self):
-        RE_BOOK_MGNS = re.compile(r'(#\w+\s+)?(?P<selector>(?<!\.)\bbody|@page)\b\s*{(?P<styles>[^}]*margin[^}]+);?\s*\}', re.UNICODE)
-
         def match_margins(data, allow_less=False):
-            self.user_margins = get_user_margins()
             doc_defined_margins = {}
 
-            for match in RE_BOOK_MGNS.finditer(data):
+            for match in RE_BOOK_MGNS_CSS.finditer(data):
                 styles = match.group('styles').lower().strip()
                 # delete trailing semicolons
-                styles = re.sub('\s*;$', '', styles)
+                styles = RE_TRAILING_SEMICOLONS.sub('', styles)
                 if match.group('selector').lower() == 'body' and styles.find('margin') != -1:
                     self.log('\t\tMargins are defined in a body tag')
                     return True
@@ -1556,8 +1825,8 @@ class EpubCheck(BaseCheck):
                 for style in stylelist:
                     if style:
                         style = [s.strip() for s in style.split(':')]
-                        property_type = re.sub('-','_', style[0])
-                        value = float(re.sub('[^\d.]+', '', style[1]))
+                        property_type = style[0].replace('-', '_')
+                        value = float(RE_NON_NUMERIC.sub('', style[1]))
 
                         if property_type == 'margin': # Not a calibre set value, so we will just replace the whole value
                             self.log(_('\t\t\'margin\' property found, so does not match calibre preferences'))
@@ -1577,7 +1846,7 @@ class EpubCheck(BaseCheck):
 
             # If we got to here, then we found "some" margins in the style that are
             # either identical or a subset of our preferred margins
-            for pref, pref_value in self.user_margins.items():
+            for pref, pref_value in user_margins.items():
                 if pref_value < 0.0:  # The user does not want this margin defined
                     if pref in doc_defined_margins:  # Currently is defined, so remove it
                         self.log(_('\t\tMargins are defined in pts but don\'t match calibre preferences'))
@@ -1611,20 +1880,23 @@ class EpubCheck(BaseCheck):
                 prefs_margins = calibre_default_margins
             return prefs_margins
 
+        # Read the page setup preferences once rather than for every file checked
+        user_margins = get_user_margins()
+
         def evaluate_book(book_id, db):
-            self.path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
-            if not self.path_to_book:
+            path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
+            if not path_to_book:
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(self.path_to_book, 'r') as zf:
-                    self.log(_('\tAnalyzing margins in ')+self.path_to_book)
+                with self._open_epub(path_to_book) as zf:
+                    self.log(_('\tAnalyzing margins in ')+path_to_book)
                     contents = list(self._manifest_worthy_names(zf))
                     # Check the CSS files for @page and body declarations
                     for resource_name in contents:
                         if resource_name.lower().endswith('css'):
                             css = self.zf_read(zf, resource_name).lower()
-                            if RE_BOOK_MGNS.search(css):
+                            if self._regex_search(RE_BOOK_MGNS_CSS, css):
                                 return match_margins(css)
                     # Check the xhtml files for inline @page and body declarations
                     for resource_name in contents:
@@ -1634,48 +1906,47 @@ class EpubCheck(BaseCheck):
                         elif resource_name.endswith('titlepage.xhtml'):
                             continue
                         else:
-                            data = self.zf_read(zf, resource_name).lower()
-                            if RE_BOOK_MGNS.search(data[:1000]):
-                                if match_margins(data[:1000], True):
+                            data = zf.read_head(resource_name, 1000).lower()
+                            if self._regex_search(RE_BOOK_MGNS_CSS, data):
+                                if match_margins(data, True):
                                     return True
 
             except InvalidEpub as e:
                 self.log.error('Invalid epub:', e)
                 return False
             except:
-                self.log.error('ERROR parsing book: ', self.path_to_book)
+                self.log.error('ERROR parsing book: ', path_to_book)
                 self.log(traceback.format_exc())
                 return False
 
         self.check_all_files(evaluate_book,
                              no_match_msg=_('All searched ePub books match the calibre page setup preferences'),
                              marked_text='epub_css_margins',
-                             status_msg_type=_('ePub books for body or @page css margins'))
+                             status_msg_type=_('ePub books for body or @page css margins'),
+                             cache_options=user_margins)
 
 
     def check_epub_css_no_margins(self):
-        RE_BOOK_MGNS = re.compile(r'(#\w+\s+)?(?P<selector>\bbody|@page)\b\s*{(?P<styles>[^}]+margin[^}]+);?\s*\}', re.UNICODE)
-
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
             if not path_to_book:
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = list(self._manifest_worthy_names(zf))
                     for resource_name in contents:
                         if resource_name.lower().endswith('css'):
                             css = self.zf_read(zf, resource_name).lower()
-                            if RE_BOOK_MGNS.search(css):
+                            if self._regex_search(RE_BOOK_MGNS, css):
                                 return False
                     for resource_name in contents:
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in NON_HTML_FILES:
                             continue
                         else:
-                            data = self.zf_read(zf, resource_name).lower()
-                            if RE_BOOK_MGNS.search(data[:1000]):
+                            data = zf.read_head(resource_name, 1000).lower()
+                            if self._regex_search(RE_BOOK_MGNS, data):
                                 return False
                     return True
 
@@ -1694,15 +1965,13 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_inline_margins(self):
-        RE_BOOK_MGNS = re.compile(r'(#\w+\s+)?(?P<selector>\bbody|@page)\b\s*{(?P<styles>[^}]+margin[^}]+);?\s*\}', re.UNICODE)
-
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
             if not path_to_book:
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in NON_HTML_FILES:
@@ -1712,8 +1981,8 @@ class EpubCheck(BaseCheck):
                         elif resource_name.lower().find('cover') != -1:
                             continue
                         else:
-                            data = self.zf_read(zf, resource_name).lower()
-                            if RE_BOOK_MGNS.search(data[:1000]):
+                            data = zf.read_head(resource_name, 1000).lower()
+                            if self._regex_search(RE_BOOK_MGNS, data):
                                 return True
                     return False
 
@@ -1732,19 +2001,13 @@ class EpubCheck(BaseCheck):
 
 
     def check_epub_javascript(self):
-        RE_JAVASCRIPT = re.compile(r'<script [^>]+?type\s*=\s*"text/javascript"[^>]*?>')
-
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
             if not path_to_book:
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.namelist()
-                    if self._is_drm_encrypted(zf, contents):
-                        self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
-                        return False
+                with self._open_epub(path_to_book) as zf:
                     reasons = []
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
@@ -1753,8 +2016,7 @@ class EpubCheck(BaseCheck):
                         elif extension in NON_HTML_FILES:
                             continue
                         else:
-                            data = self.zf_read(zf, resource_name)
-                            if RE_JAVASCRIPT.search(data):
+                            if self._search_resource(zf, resource_name, RE_JAVASCRIPT, lower=False):
                                 reasons.append(_('\tContains inline javascript: %s')% resource_name)
                     if reasons:
                         self.log(_('ePub with Javascript: %s')%get_title_authors_text(db, book_id))
@@ -1774,7 +2036,8 @@ class EpubCheck(BaseCheck):
         self.check_all_files(evaluate_book,
                              no_match_msg=_('No searched ePub books have javascript'),
                              marked_text='epub_javascript',
-                             status_msg_type=_('ePub books for javascript'))
+                             status_msg_type=_('ePub books for javascript'),
+                             skip_drm=True)
 
 
     def check_epub_smarten_punctuation(self):
@@ -1785,11 +2048,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
-                    contents = zf.namelist()
-                    if self._is_drm_encrypted(zf, contents):
-                        self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
-                        return False
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in NON_HTML_FILES:
@@ -1814,7 +2073,8 @@ class EpubCheck(BaseCheck):
         self.check_all_files(evaluate_book,
                              no_match_msg=_('No searched ePub books need punctuation smartened'),
                              marked_text='epub_smarten_punctuation',
-                             status_msg_type=_('ePub books for smarten punctuation'))
+                             status_msg_type=_('ePub books for smarten punctuation'),
+                             skip_drm=True)
 
 
     # -----------------------------------------------------------
@@ -1823,18 +2083,28 @@ class EpubCheck(BaseCheck):
     #
     # -----------------------------------------------------------
 
+    def _open_epub(self, path_to_book):
+        book = getattr(self._shared_book, 'book', None)
+        if book is not None and book.path == path_to_book:
+            return book
+        return EpubBook(path_to_book)
+
     def _get_opf_xml(self, path_to_book, zf):
-        contents = zf.namelist()
-        if 'META-INF/container.xml' not in contents:
+        return zf.cached('opf_name', lambda: self._find_opf_name(path_to_book, zf))
+
+    def _find_opf_name(self, path_to_book, zf):
+        if not zf.has_name('META-INF/container.xml'):
             raise InvalidEpub('Missing container.xml from:%s'%path_to_book)
-        container = self._parse_xml(zf.read('META-INF/container.xml'))
-        opf_files = container.xpath((r'child::ocf:rootfiles/ocf:rootfile'
-                                      '[@media-type="%s" and @full-path]'%guess_type('a.opf')[0]
-                                     ), namespaces={'ocf':OCF_NS})
+        data = zf.read('META-INF/container.xml')
+        with instrumentation.phase(PHASE_OPF_PARSE):
+            container = self._parse_xml(data)
+            opf_files = container.xpath((r'child::ocf:rootfiles/ocf:rootfile'
+                                          '[@media-type="%s" and @full-path]'%guess_type('a.opf')[0]
+                                         ), namespaces={'ocf':OCF_NS})
         if not opf_files:
             raise InvalidEpub(_('Could not find OPF in:%s')%path_to_book)
         opf_name = opf_files[0].attrib['full-path']
-        if opf_name not in contents:
+        if not zf.has_name(opf_name):
             raise InvalidEpub(_('OPF file in container.xml not found in:%s')%path_to_book)
         return opf_name
 
@@ -1845,12 +2115,17 @@ class EpubCheck(BaseCheck):
         if len(items):
             opf_dir = posixpath.dirname(opf_name)
             item_name = self._href_to_name(items[0].attrib['href'], opf_dir)
-            if item_name in zf.namelist():
+            if zf.has_name(item_name):
                 return item_name
 
     def _get_opf_items_map(self, zf, opf_name, opf_xml=None, rebase_href=True):
-        if not opf_xml:
-            opf_xml = self._get_opf_tree(zf, opf_name)
+        if opf_xml is None:
+            return zf.cached(('opf_items_map', opf_name, rebase_href),
+                             lambda: self._build_opf_items_map(self._get_opf_tree(zf, opf_name),
+                                                               opf_name, rebase_href))
+        return self._build_opf_items_map(opf_xml, opf_name, rebase_href)
+
+    def _build_opf_items_map(self, opf_xml, opf_name, rebase_href):
         items = opf_xml.xpath(r'child::opf:manifest/opf:item[@href]',
                               namespaces={'opf':OPF_NS})
         items_map = {}
@@ -1864,11 +2139,27 @@ class EpubCheck(BaseCheck):
         return items_map
 
     def _get_opf_tree(self, zf, opf_name):
-        data = zf.read(opf_name)
-        data = data.decode('utf-8')
-        data = re.sub(r'http://openebook.org/namespaces/oeb-package/1.0/',
-                OPF_NS, data)
-        return self._parse_xml(data)
+        def parse_opf():
+            data = zf.read(opf_name)
+            with instrumentation.phase(PHASE_OPF_PARSE):
+                data = data.decode('utf-8')
+                data = data.replace(OEB_PACKAGE_NS, OPF_NS)
+                # An lxml tree takes several times the size of its source
+                zf.add_cost(len(data) * 10)
+                return self._parse_xml(data)
+        return zf.cached(('opf_tree', opf_name), parse_opf)
+
+    def _get_ncx_tree(self, zf, ncx_name):
+        def parse_ncx():
+            data = self.zf_read(zf, ncx_name)
+            return self._parse_xml(data), len(data)
+        return zf.cached_document(('ncx_tree', ncx_name), parse_ncx)
+
+    def _get_xhtml_tree(self, zf, name):
+        def parse_xhtml():
+            data = self.zf_read(zf, name)
+            return self._parse_xhtml(data, name), len(data)
+        return zf.cached_document(('xhtml_tree', name), parse_xhtml)
 
     def _href_to_name(self, href, base=''):
         hash_index = href.find('#')
@@ -1883,6 +2174,10 @@ class EpubCheck(BaseCheck):
         return name
 
     def _manifest_worthy_names(self, zf, suppress_apple_fonts=True):
+        return iter(zf.cached(('manifest_worthy_names', suppress_apple_fonts),
+                    lambda: list(self._find_manifest_worthy_names(zf, suppress_apple_fonts))))
+
+    def _find_manifest_worthy_names(self, zf, suppress_apple_fonts):
         for name in zf.namelist():
             if name == 'mimetype': continue
             if name.endswith('/'): continue
@@ -1894,6 +2189,88 @@ class EpubCheck(BaseCheck):
             yield name
 
     def _is_drm_encrypted(self, zf, contents):
+        return zf.cached('is_drm_encrypted', lambda: self._find_drm_encryption(zf, contents))
+
+    def _open_drm_index(self):
+        '''
+        The result cache holding the DRM index, or None when results are not
+        to be reused, in which case each book is opened to look for DRM
+        '''
+        if not self.is_result_cache_enabled():
+            return None
+        return self.open_result_cache()
+
+    def _get_indexed_drm(self, book_id, st):
+        '''
+        Whether the ePub is DRM encrypted according to the DRM index in the
+        result cache, or None if it has not been classified since it changed
+        '''
+        drm_index = self._open_drm_index()
+        if drm_index is None:
+            return None
+        return drm_index.get_drm(book_id, st.st_size, st.st_mtime)
+
+    def _is_drm_book(self, book_id, path_to_book):
+        '''
+        Whether the ePub is DRM encrypted, from the DRM index while the size
+        and modification time of the file are unchanged, so that the book is
+        only opened the first time it is classified
+        '''
+        st = os.stat(path_to_book)
+        is_drm = self._get_indexed_drm(book_id, st)
+        if is_drm is not None:
+            return is_drm
+        with self._open_epub(path_to_book) as zf:
+            is_drm = bool(self._is_drm_encrypted(zf, zf.namelist()))
+        drm_index = self._open_drm_index()
+        if drm_index is not None:
+            drm_index.set_drm(book_id, st.st_size, st.st_mtime, is_drm)
+        return is_drm
+
+    def drm_skipping_callback(self, callback_fn):
+        '''
+        Wraps callback_fn so that books with DRM are not evaluated, but listed
+        together once the check has finished
+        '''
+        # Open the DRM index before the books are evaluated
+        self._open_drm_index()
+        inner_is_cached = getattr(callback_fn, 'is_cached', None)
+
+        def is_cached(book_id, db):
+            # A book already known to have DRM is skipped without opening it
+            path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
+            if path_to_book:
+                try:
+                    if self._get_indexed_drm(book_id, os.stat(path_to_book)):
+                        return True
+                except OSError:
+                    pass
+            return inner_is_cached is not None and inner_is_cached(book_id, db)
+
+        def evaluate_book(book_id, db):
+            path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
+            if path_to_book:
+                try:
+                    if self._is_drm_book(book_id, path_to_book):
+                        self.drm_skipped_ids.add(book_id)
+                        return False
+                except:
+                    # Leave the check to report the problem opening this book
+                    pass
+            return callback_fn(book_id, db)
+
+        evaluate_book.is_cached = is_cached
+        return evaluate_book
+
+    def finish_evaluation(self):
+        if self.drm_skipped_ids:
+            skipped_ids = [i for i in self.book_ids if i in self.drm_skipped_ids]
+            self.log.error(_('SKIPPED %d BOOKS (DRM Encrypted):') % len(skipped_ids))
+            for book_id in skipped_ids:
+                self.log('\t<span style="color:darkgray">%s</span>' % get_title_authors_text(self.db, book_id))
+            self.drm_skipped_ids.clear()
+
+    def _find_drm_encryption(self, zf, contents):
         for resource_name in contents:
             if resource_name.lower().endswith('encryption.xml'):
                 root = self._parse_xml(self.zf_read(zf, resource_name))
@@ -1905,27 +2282,84 @@ class EpubCheck(BaseCheck):
         return False
 
     def _get_encryption_meta(self, zf):
-        for name in zf.namelist():
-            if name == ENCRYPTION_PATH:
+        def parse_encryption():
+            if zf.has_name(ENCRYPTION_PATH):
                 try:
-                    return Encryption(self.zf_read(zf, name))
+                    return Encryption(self.zf_read(zf, ENCRYPTION_PATH))
                 except:
                     return Encryption(None)
-        return Encryption(None)
+            return Encryption(None)
+        return zf.cached('encryption_meta', parse_encryption)
+
+    def _reference_names(self, resource_name):
+        '''
+        The lower cased base name of a resource, along with its url encoded
+        form if different, as either may appear in the html referencing it
+        '''
+        name = os.path.basename(resource_name).lower()
+        name_enc = six.moves.urllib.request.pathname2url(name).lower()
+        return frozenset([name, name_enc])
+
+    def _index_reference_names(self, resource_names):
+        '''
+        Map each name a resource may be referenced by to the resources, so
+        that the references found in the html can be looked up directly
+        '''
+        keys_by_name = {}
+        for resource_name, names in resource_names.items():
+            for name in names:
+                keys_by_name.setdefault(name, []).append(resource_name)
+        return keys_by_name
+
+    def _find_image_references(self, data):
+        '''
+        The base names of everything referenced by the attributes of the
+        img and svg image tags in a single pass of the html
+        '''
+        referenced = set()
+        with instrumentation.phase(PHASE_REGEX):
+            for tag in RE_IMAGE_TAG.findall(data):
+                for value in RE_QUOTED_VALUE.findall(tag):
+                    referenced.add(value.rpartition('/')[2])
+        return referenced
+
+    def _find_link_references(self, data):
+        '''
+        The base names of the href of every link tag in a single pass of the html
+        '''
+        with instrumentation.phase(PHASE_REGEX):
+            return set(href.rpartition('/')[2] for href in RE_LINK_HREF.findall(data))
+
+    def _regex_search(self, regex, data):
+        with instrumentation.phase(PHASE_REGEX):
+            return regex.search(data)
+
+    def _search_resource(self, zf, resource_name, regex, lower=True):
+        '''
+        Search the named resource for the regular expression, a chunk at a time
+        for a large resource so that neither it nor a lower case copy of it
+        are held in memory whole
+        '''
+        for match in zf.finditer(resource_name, regex, lower):
+            return match
+        return None
 
     def _extract_body_text(self, data):
         '''
         Get the body text of this html content wit any html tags stripped
         '''
-        body = RE_HTML_BODY.findall(data)
-        if body:
-            return RE_STRIP_MARKUP.sub('', body[0])
-        return ''
+        with instrumentation.phase(PHASE_REGEX):
+            body = RE_HTML_BODY.findall(data)
+            if body:
+                return RE_STRIP_MARKUP.sub('', body[0])
+            return ''
 
     def _parse_xml(self, data):
-        data = xml_to_unicode(data, strip_encoding_pats=True, assume_utf8=True,
-                             resolve_entities=True)[0].strip()
-        return etree.fromstring(data, parser=RECOVER_PARSER)
+        with instrumentation.phase(PHASE_XML_DECODE):
+            data = xml_to_unicode(data, strip_encoding_pats=True, assume_utf8=True,
+                                 resolve_entities=True)[0].strip()
+        with instrumentation.phase(PHASE_XML_PARSE):
+            return etree.fromstring(data, parser=RECOVER_PARSER)
 
     def _parse_xhtml(self, data, name):
         orig_data = data
@@ -1933,11 +2367,13 @@ class EpubCheck(BaseCheck):
         # Don't fill our QC log up with errors about html parsing
         from calibre.utils.logging import Log
         log = Log()
+        # A preprocessor for each document, as books are parsed on several threads at once
         try:
-            data = parse_html(data, log=log,
-                    decoder=self._decode,
-                    preprocessor=self.html_preprocessor,
-                    filename=fname, non_html_file_tags={'ncx'})
+            with instrumentation.phase(PHASE_XML_PARSE):
+                data = parse_html(data, log=log,
+                        decoder=self._decode,
+                        preprocessor=HTMLPreProcessor(),
+                        filename=fname, non_html_file_tags={'ncx'})
         except NotHTML:
             return self._parse_xml(orig_data)
         return data
@@ -6,20 +6,24 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import os, shutil, traceback
-
-from calibre.gui2 import info_dialog, choose_dir, error_dialog
-from calibre.ptempfile import TemporaryDirectory
+import os, shutil, threading, traceback
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+from calibre.ebooks.mobi import MobiError
+from calibre.gui2 import info_dialog, choose_dir, error_dialog, question_dialog
 from calibre.utils.config import prefs
 from calibre.utils.localization import get_udc
 
 import calibre_plugins.quality_check.config as cfg
 from calibre_plugins.quality_check.check_base import BaseCheck
 from calibre_plugins.quality_check.common_utils import get_title_authors_text
-from calibre_plugins.quality_check.dialogs import (ResultsSummaryDialog, ApplyFixProgressDialog,
-                                                   QualityProgressDialog)
-from calibre_plugins.quality_check.helpers import get_formatted_author_initials
-from calibre_plugins.quality_check.mobi6 import MinimalMobiUpdater
+from calibre_plugins.quality_check.dialogs import ResultsSummaryDialog, QualityProgressDialog
+from calibre_plugins.quality_check.helpers import get_formatted_author_initials, find_orphaned_opf_files
+from calibre_plugins.quality_check.mobi6 import update_exth_in_place, rewrite_exth
+from calibre_plugins.quality_check.workers import BookWorkerPool
 
 
 class FixCheck(BaseCheck):
@@ -147,23 +151,24 @@ class FixCheck(BaseCheck):
         self.updated_format_count = 0
 
         def evaluate_book(book_id, db):
-            formats = db.formats(book_id, index_is_id=True, verify_formats=False)
-            if not formats:
+            expected_formats = expected_by_book.get(book_id)
+            if not expected_formats:
                 return False
+            book_dir = os.path.join(db.library_path, paths[book_id])
+            try:
+                file_sizes = self._get_file_sizes(book_dir, [name for _fmt, name, _size in expected_formats])
+            except EnvironmentError:
+                file_sizes = {}
             mark_book = False
-            for fmt in formats.split(','):
-                db_size = db.new_api.format_db_size(book_id, fmt)
-                book_path = db.format_abspath(book_id, fmt, index_is_id=True)
-                if not book_path:
+            for fmt, name, db_size in expected_formats:
+                actual_size = file_sizes.get(name.lower())
+                if actual_size is None:
                     self.log.error('Unable to find path to book id:', book_id, db.title(book_id, index_is_id=True))
                     continue
-                if os.path.exists(book_path):
-                    actual_size = os.path.getsize(book_path)
-                    if actual_size != db_size:
-                        mark_book = True
-                        self.updated_format_count += 1
-                        self.log('Format size change for fmt:',fmt,'from:',db_size,'to:',actual_size)
-                        db.format_metadata(book_id, fmt, update_db=True, commit=True)
+                if actual_size != db_size:
+                    mark_book = True
+                    self.log('Format size change for fmt:',fmt,'from:',db_size,'to:',actual_size)
+                    changed_formats.append((book_id, fmt, actual_size))
             return mark_book
         if not (hasattr(self.gui.current_db, 'new_api') and
                 hasattr(self.gui.current_db.new_api, 'format_db_size')):
@@ -171,9 +176,33 @@ class FixCheck(BaseCheck):
                             _('"Check and repair book sizes" requires calibre '
                               'version 5.9 or higher.'),
                             show=True, show_copy_button=False)
+
+        # Read what the database has for every book up front, rather than a
+        # format at a time as each book is checked
+        db = self.gui.current_db
+        api = db.new_api
+        self.select_book_ids()
+        paths = api.all_field_for('path', self.book_ids)
+        all_formats = api.all_field_for('formats', self.book_ids)
+        expected_by_book = {}
+        for book_id in self.book_ids:
+            if not all_formats[book_id]:
+                continue
+            fnames = api.format_files(book_id)
+            expected_by_book[book_id] = [(fmt, '%s.%s' % (fnames[fmt], fmt.lower()), api.format_db_size(book_id, fmt))
+                                         for fmt in all_formats[book_id] if fmt in fnames]
+        changed_formats = []
+
+        # Only the file system is read while checking, so the books can be
+        # checked on the worker pool to overlap the latency of network drives
         total_count, result_ids, cancelled_msg = self.check_all_files(evaluate_book,
                                                                   marked_text='file_size_updated',
-                                                                  status_msg_type='books for invalid file sizes')
+                                                                  status_msg_type='books for invalid file sizes',
+                                                                  parallel=True)
+        # Write all the corrections together once the checking is done
+        if changed_formats:
+            self._update_format_sizes(db, changed_formats)
+        self.updated_format_count = len(changed_formats)
         msg = 'Checked %d books, updated %d format sizes in %d books%s' % \
                     (total_count, self.updated_format_count, len(result_ids), cancelled_msg)
         self.gui.status_bar.showMessage(msg)
@@ -181,30 +210,129 @@ class FixCheck(BaseCheck):
             return info_dialog(self.gui, 'No Matches%s'%cancelled_msg, 'All book format sizes are correct', show=True)
         self.gui.library_view.model().refresh_ids(list(result_ids))
 
+    def _update_format_sizes(self, db, format_sizes):
+        '''
+        Writes the size of each (book_id, fmt, size) to the database in a single
+        transaction, then updates the sizes calibre holds in memory to match.
+        calibre has no api for this, as format_metadata(update_db=True) commits
+        each format on its own, so that is used instead for any version of
+        calibre whose internals are not as expected.
+        '''
+        api = db.new_api
+        formats_table = getattr(api.fields.get('formats'), 'table', None)
+        size_table = getattr(api.fields.get('size'), 'table', None)
+        if not (hasattr(api, 'backend') and hasattr(api, 'format_metadata_cache') and
+                hasattr(formats_table, 'size_map') and hasattr(size_table, 'update_sizes')):
+            for book_id, fmt, _size in format_sizes:
+                db.format_metadata(book_id, fmt, update_db=True, commit=True)
+            return
+        with api.write_lock:
+            api.backend.executemany('UPDATE data SET uncompressed_size=? WHERE book=? AND format=?',
+                                    [(size, book_id, fmt) for book_id, fmt, size in format_sizes])
+            size_map = formats_table.size_map
+            max_sizes = {}
+            for book_id, fmt, size in format_sizes:
+                size_map[book_id][fmt] = size
+                api.format_metadata_cache[book_id].pop(fmt, None)
+                max_sizes[book_id] = max(size_map[book_id].values())
+            size_table.update_sizes(max_sizes)
+
+    def _get_file_sizes(self, dirpath, names):
+        '''
+        The size of each of the named files in the folder keyed by lower cased
+        name, listing the folder once rather than checking each file in turn
+        '''
+        wanted = set(name.lower() for name in names)
+        file_sizes = {}
+        if scandir is None:
+            for name in os.listdir(dirpath):
+                if name.lower() in wanted:
+                    file_sizes[name.lower()] = os.path.getsize(os.path.join(dirpath, name))
+            return file_sizes
+        for entry in scandir(dirpath):
+            if entry.name.lower() in wanted:
+                file_sizes[entry.name.lower()] = entry.stat().st_size
+        return file_sizes
+
 
     def check_and_rename_book_paths(self):
+        db = self.gui.current_db
+        api = db.new_api
 
-        def evaluate_book(book_id, db):
-            existing_path = db.path(book_id, index_is_id=True).replace(os.sep, '/')
-            title = db.title(book_id, index_is_id=True)
-            author = [a.replace('|', ',') for a in (db.authors(book_id, index_is_id=True) or '').split(',')][0]
-            new_path = db.backend.construct_path_name(book_id, title, author).replace(os.sep, '/')
-            if existing_path == new_path:
-                return False
+        plan_ids = cfg.get_library_rename_plan(db)
+        if plan_ids and question_dialog(self.gui, _('Resume renaming'),
+                        _('Renaming the paths of %d books was interrupted. Resume renaming them?') % len(plan_ids)):
+            self.book_ids = [i for i in plan_ids if db.data.has_id(i)]
+        else:
+            self.select_book_ids()
+        renames = self._plan_book_path_renames(db, self.book_ids)
+        if not renames:
+            cfg.set_library_rename_plan(db, [])
+            return info_dialog(self.gui, 'No Matches', 'All books have up to date paths', show=True)
+
+        # Let the user see what would be renamed before anything is changed
+        details = '\n'.join('%s => %s' % (existing_path, new_path) for _book_id, existing_path, new_path in renames)
+        if not question_dialog(self.gui, _('Rename book paths'),
+                        _('%d books have paths which do not match their title and author. '
+                          'Rename them now?') % len(renames), det_msg=details, show_copy_button=True):
+            cfg.set_library_rename_plan(db, [])
+            return
+        new_paths = dict((book_id, (existing_path, new_path)) for book_id, existing_path, new_path in renames)
+        cfg.set_library_rename_plan(db, list(new_paths.keys()))
+
+        c = cfg.plugin_prefs[cfg.STORE_OPTIONS]
+        batch_size = c.get(cfg.KEY_RENAME_BATCH_SIZE, 50)
+        batch = []
+        remaining_ids = set(new_paths)
+
+        def rename_batch():
+            api.update_path(set(batch))
+            # Remember what is left in case renaming is interrupted
+            remaining_ids.difference_update(batch)
+            cfg.set_library_rename_plan(db, sorted(remaining_ids))
+            del batch[:]
+
+        def rename_book(book_id, db):
+            existing_path, new_path = new_paths[book_id]
             self.log('Renaming book: %s => %s' % (existing_path, new_path))
-            db.new_api.update_path(set([book_id]))
+            batch.append(book_id)
+            if len(batch) >= batch_size:
+                rename_batch()
             return True
 
-        total_count, result_ids, cancelled_msg = self.check_all_files(evaluate_book,
-                                                                  marked_text='book_path_updated',
-                                                                  status_msg_type='books with paths missing commas')
+        d = QualityProgressDialog(self.gui, list(new_paths.keys()), rename_book, db,
+                                  'book paths', action_type='Renaming')
+        if batch:
+            rename_batch()
+        result_ids = d.result_ids
+        cancelled_msg = ''
+        if d.wasCanceled():
+            cancelled_msg = _(' (cancelled)')
+        self.show_invalid_rows(result_ids, 'book_path_updated')
         msg = 'Checked %d books, updated %d paths%s' % \
-                    (total_count, len(result_ids), cancelled_msg)
+                    (len(self.book_ids), len(result_ids), cancelled_msg)
         self.gui.status_bar.showMessage(msg)
-        if len(result_ids) == 0:
-            return info_dialog(self.gui, 'No Matches%s'%cancelled_msg, 'All books have up to date paths', show=True)
         self.gui.library_view.model().refresh_ids(list(result_ids))
 
+    def _plan_book_path_renames(self, db, book_ids):
+        '''
+        The (book_id, existing_path, new_path) of every book whose folder does
+        not match its title and first author, reading those for all the books
+        at once
+        '''
+        api = db.new_api
+        paths = api.all_field_for('path', book_ids)
+        titles = api.all_field_for('title', book_ids)
+        authors = api.all_field_for('authors', book_ids)
+        renames = []
+        for book_id in book_ids:
+            existing_path = paths[book_id].replace(os.sep, '/')
+            author = authors[book_id][0] if authors[book_id] else ''
+            new_path = db.backend.construct_path_name(book_id, titles[book_id], author).replace(os.sep, '/')
+            if existing_path != new_path:
+                renames.append((book_id, existing_path, new_path))
+        return renames
+
 
     def cleanup_opf_folders(self):
         '''
@@ -223,15 +351,24 @@ class FixCheck(BaseCheck):
                     'If you do you will remove "Empty book" entries and corrupt your database.',
                     show=True)
 
-        messages = []
-        errors = []
-        # For our very top level folder we will NEVER delete this.
-        self._cleanup_directory_if_needed(path, messages, errors, delete_parent=False)
-
-        if len(messages) == 0 and len(errors) == 0:
+        files_to_delete, folders_to_delete = self._plan_opf_cleanup(path)
+        if len(files_to_delete) == 0 and len(folders_to_delete) == 0:
             return info_dialog(self.gui, 'No files deleted',
                                'No files/folders were found to be deleted', show=True)
 
+        # Nothing is deleted until the user has seen the list of what will be
+        planned = ['Remove file: %s' % f for f in files_to_delete]
+        planned.extend('Remove folder: %s' % f for f in folders_to_delete)
+        if not question_dialog(self.gui, 'Confirm cleanup',
+                'Found %d files and %d folders to delete. See details for the list.<br>'
+                'Are you sure you want to delete them?' % (len(files_to_delete), len(folders_to_delete)),
+                det_msg='\n'.join(planned), show_copy_button=True):
+            return
+
+        messages = []
+        errors = []
+        self._delete_planned_files(files_to_delete, folders_to_delete, messages, errors)
+
         msg = 'Deleted %d files/folders with %d errors. See details for more info.' % \
                 (len(messages), len(errors))
         messages.extend(errors)
@@ -239,61 +376,125 @@ class FixCheck(BaseCheck):
         return info_dialog(self.gui, 'Cleanup completed', msg, det_msg=det_msg, show=True)
 
 
-    def _cleanup_directory_if_needed(self, dirname, messages, errors, delete_parent=True):
+    def _plan_opf_cleanup(self, path):
+        '''
+        Walks the folder to find the orphaned files and the folders which would
+        be left empty, without deleting anything. Each subfolder of the top
+        level folder is a separate tree, so these are walked on the worker
+        threads when more than one is configured.
+        '''
+        files_to_delete = []
+        folders_to_delete = []
+        # For our very top level folder we will NEVER delete this.
+        self.log('Analysing folder', path)
+        listing = self._list_directory(path)
+        if listing is None:
+            return files_to_delete, folders_to_delete
+        subdirs, filenames = listing
+        files_to_delete.extend(os.path.join(path, f) for f in find_orphaned_opf_files(filenames, self.log))
+        subdirs = [os.path.join(path, d) for d in subdirs]
+
+        worker_count = min(self.get_worker_count(), len(subdirs))
+        if worker_count < 2:
+            for subdir in subdirs:
+                self._plan_directory_cleanup(subdir, files_to_delete, folders_to_delete)
+            return files_to_delete, folders_to_delete
+
+        lock = threading.Lock()
+        next_index = [0]
+        subdir_plans = [None] * len(subdirs)
+
+        def plan_subdirs():
+            while True:
+                with lock:
+                    idx = next_index[0]
+                    if idx >= len(subdirs):
+                        return
+                    next_index[0] += 1
+                self.log.begin_buffer()
+                files, folders = [], []
+                try:
+                    self._plan_directory_cleanup(subdirs[idx], files, folders)
+                except:
+                    self.log.error('ERROR analysing folder: ', subdirs[idx])
+                    self.log(traceback.format_exc())
+                    files, folders = [], []
+                subdir_plans[idx] = (files, folders, self.log.end_buffer())
+
+        threads = [threading.Thread(target=plan_subdirs, name='QualityCheckCleanup-%d'%i)
+                   for i in range(worker_count)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        # Combine in folder order so the log reads the same as walking them one at a time
+        for files, folders, buffered in subdir_plans:
+            buffered.replay(self.log)
+            files_to_delete.extend(files)
+            folders_to_delete.extend(folders)
+        return files_to_delete, folders_to_delete
+
+
+    def _plan_directory_cleanup(self, dirname, files_to_delete, folders_to_delete):
+        '''
+        Adds the orphaned files of this folder and its subfolders to be deleted,
+        and the folder itself if nothing else would be left in it. Subfolders
+        are added before their parent. Returns whether this folder can be removed.
+        '''
         self.log('Analysing folder', dirname)
-        self._delete_orphaned_opf_files(dirname, messages, errors)
-
-        files = os.listdir(dirname)
-        safe_to_delete_folder = True
-        for filename in files:
-            full_path = os.path.join(dirname, filename)
-            if os.path.isdir(full_path):
-                if not self._cleanup_directory_if_needed(full_path, messages, errors):
-                    # As we still have a subfolder, cannot delete this parent
-                    self.log('Non empty subfolder', full_path)
-                    safe_to_delete_folder = False
-            else:
-                # Any other file being present in this folder means we should not delete it
+        listing = self._list_directory(dirname)
+        if listing is None:
+            return False
+        subdirs, filenames = listing
+        orphaned_files = set(find_orphaned_opf_files(filenames, self.log))
+        files_to_delete.extend(os.path.join(dirname, f) for f in filenames if f in orphaned_files)
+        # Any other file being present in this folder means we should not delete it
+        safe_to_delete_folder = orphaned_files == set(filenames)
+
+        for subdir in subdirs:
+            full_path = os.path.join(dirname, subdir)
+            if not self._plan_directory_cleanup(full_path, files_to_delete, folders_to_delete):
+                # As we still have a subfolder, cannot delete this parent
+                self.log('Non empty subfolder', full_path)
                 safe_to_delete_folder = False
 
-        if safe_to_delete_folder and delete_parent:
-            self.log('Removing folder', dirname)
-            try:
-                shutil.rmtree(dirname)
-                messages.append('Removed folder: %s' % dirname)
-            except:
-                self.log.error('Unable to remove folder:', dirname)
-                self.log(traceback.format_exc())
-                errors.append('ERROR removing folder: %s' % dirname)
-                safe_to_delete_folder = False
+        if safe_to_delete_folder:
+            self.log('Folder can be removed', dirname)
+            folders_to_delete.append(dirname)
         return safe_to_delete_folder
 
 
-    def _delete_orphaned_opf_files(self, dirname, messages, errors):
-        all_files = os.listdir(dirname)
-        all_opf_files = [f for f in all_files if f.lower().endswith('.opf')]
-        all_non_opf_files = set(all_files) - set(all_opf_files)
-        files_to_delete = []
-
-        for opf_file in all_opf_files:
-            base, _extension = os.path.splitext(opf_file)
-            matching_files = [f for f in all_non_opf_files if f.lower().startswith(base.lower()+'.')]
-            self.log('\tAnalysing opf file: ', opf_file)
-            self.log('\tMatching files: ', matching_files)
-            safe_to_delete = True
-
-            for m in matching_files:
-                matching_extension = os.path.splitext(m)[1]
-                if matching_extension.lower() != '.jpg':
-                    self.log('\tCannot remove .opf because found: ', m)
-                    safe_to_delete = False
-                    break
-            if safe_to_delete:
-                self.log('\tSafe to delete: ', opf_file)
-                files_to_delete.append(os.path.join(dirname, opf_file))
-                for m in matching_files:
-                    files_to_delete.append(os.path.join(dirname, m))
-
+    def _list_directory(self, dirname):
+        '''
+        The names of the subfolders and files in this folder, or None if it
+        cannot be read. Uses scandir where available, which knows whether each
+        entry is a folder without a further call for each one.
+        '''
+        subdirs = []
+        filenames = []
+        try:
+            if scandir is not None:
+                for entry in scandir(dirname):
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    else:
+                        filenames.append(entry.name)
+            else:
+                for name in os.listdir(dirname):
+                    if os.path.isdir(os.path.join(dirname, name)):
+                        subdirs.append(name)
+                    else:
+                        filenames.append(name)
+        except EnvironmentError:
+            self.log.error('Unable to read folder:', dirname)
+            self.log(traceback.format_exc())
+            return None
+        return subdirs, filenames
+
+
+    def _delete_planned_files(self, files_to_delete, folders_to_delete, messages, errors):
+        failed_paths = []
         for f in files_to_delete:
             self.log('\tRemoving file', f)
             try:
@@ -303,6 +504,24 @@ class FixCheck(BaseCheck):
                 self.log.error('Unable to remove file:', f)
                 self.log(traceback.format_exc())
                 errors.append('ERROR removing file: %s'%f)
+                failed_paths.append(f)
+
+        for dirname in folders_to_delete:
+            # A folder still holding something that could not be removed must be kept
+            prefix = dirname + os.sep
+            if [p for p in failed_paths if p.startswith(prefix)]:
+                self.log('Non empty subfolder', dirname)
+                failed_paths.append(dirname)
+                continue
+            self.log('Removing folder', dirname)
+            try:
+                shutil.rmtree(dirname)
+                messages.append('Removed folder: %s' % dirname)
+            except:
+                self.log.error('Unable to remove folder:', dirname)
+                self.log(traceback.format_exc())
+                errors.append('ERROR removing folder: %s' % dirname)
+                failed_paths.append(dirname)
 
     def fix_mobi_asin(self):
 
@@ -322,7 +541,11 @@ class FixCheck(BaseCheck):
             uuid = db.uuid(book_id, index_is_id=True)
             return 'No ASIN found, using uuid', uuid
 
-        def apply_fix(book_id):
+        # The (book_id, fmt, size) of each format which had to be rewritten to fit the
+        # new header, whose size must be updated in the database once they are all done
+        rewritten_formats = []
+
+        def patch_book(book_id, db):
             fmts_to_fix = []
             for fmt in ['MOBI', 'AZW', 'AZW3']:
                 if db.has_format(book_id, fmt, index_is_id=True):
@@ -331,33 +554,49 @@ class FixCheck(BaseCheck):
                 self.log('No MOBI/AZW/AZW3 format for book: <b>%s</b>'% get_title_authors_text(db, book_id))
                 return False
 
+            patched = False
             for fmt in fmts_to_fix:
                 self.log('%s book to update: <b>%s</b>' % (fmt, get_title_authors_text(db, book_id)))
 
                 asin_info, asin = get_asin(book_id)
                 self.log('\t%s: %s' % (asin_info, asin))
 
-                file_src = os.path.join(tdir, u'%d.%s'%(book_id, fmt.lower()))
-                with lopen(file_src, 'wb') as f:
-                    db.copy_format_to(book_id, fmt, f, index_is_id=True)
-
-                with open(file_src, 'r+b') as stream:
-                    mu = MinimalMobiUpdater(stream)
-                    mu.update(asin, b'EBOK')
-                    stream.seek(0)
-
-                    # Add the format back into our library
-                    db.add_format(book_id, fmt, stream, index_is_id=True)
-            return True
+                path_to_book = db.format_abspath(book_id, fmt, index_is_id=True)
+                if not path_to_book:
+                    self.log.error('\tUnable to find the %s file of this book' % fmt)
+                    continue
+                try:
+                    if not update_exth_in_place(path_to_book, asin, b'EBOK'):
+                        # No room for the new header, so stream the book to a new file with it
+                        self.log('\tNo room to update in place, rewriting the book')
+                        size = rewrite_exth(path_to_book, asin, b'EBOK')
+                        rewritten_formats.append((book_id, fmt, size))
+                    patched = True
+                except MobiError as e:
+                    self.log.error('\tUnable to update this book: %s' % e)
+                except:
+                    self.log.error('\tUnable to update this book')
+                    self.log(traceback.format_exc())
+            return patched
 
         db = self.gui.current_db
         book_ids = self.gui.library_view.get_selected_ids()
         if book_ids:
-            with TemporaryDirectory('_qc_asin_fix') as tdir:
-                d = ApplyFixProgressDialog(self.gui, 'Fixing ASIN for %d books', book_ids, tdir, apply_fix)
-                d.exec_()
+            # Updating the header only touches the book files themselves,
+            # so several books can be done at once
+            worker_pool = None
+            worker_count = self.get_worker_count()
+            if worker_count > 1 and len(book_ids) > 1:
+                worker_pool = BookWorkerPool(book_ids, patch_book, db, self.log, worker_count)
+            d = QualityProgressDialog(self.gui, book_ids, patch_book, db,
+                                      action_type='Fixing ASIN for', worker_pool=worker_pool)
+            updated_ids = list(d.result_ids)
+            if rewritten_formats:
+                self._update_format_sizes(db, rewritten_formats)
+            if updated_ids:
+                db.update_last_modified(updated_ids)
 
             sd = ResultsSummaryDialog(self.gui, 'Quality Check',
-                                     '%d books updated, see log for details'%len(d.updated_ids),
+                                     '%d books updated, see log for details'%len(updated_ids),
                                      self.log)
             sd.exec_()
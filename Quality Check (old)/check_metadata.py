@@ -18,6 +18,37 @@ from calibre_plugins.quality_check.check_base import BaseCheck
 from calibre_plugins.quality_check.dialogs import ResultsSummaryDialog
 from calibre_plugins.quality_check.helpers import get_formatted_author_initials
 
+class SeriesIsbnIndex(object):
+    '''
+    The books of the library grouped by series and by ISBN, built from reading
+    each of the fields for every book at once. Each series maps to a list of
+    (series_index, pubdate, book_id) sorted by series index then pubdate.
+    '''
+    def __init__(self, db, key):
+        self.key = key
+        api = db.new_api
+        book_ids = api.all_book_ids()
+        series = api.all_field_for('series', book_ids)
+        series_indexes = api.all_field_for('series_index', book_ids)
+        pubdates = api.all_field_for('pubdate', book_ids)
+        identifiers = api.all_field_for('identifiers', book_ids)
+
+        self.books_by_series = defaultdict(list)
+        self.books_by_isbn = defaultdict(list)
+        for book_id in book_ids:
+            series_name = series[book_id]
+            if series_name:
+                self.books_by_series[series_name].append((series_indexes[book_id], pubdates[book_id], book_id))
+            isbn = identifiers[book_id].get('isbn') if identifiers[book_id] else None
+            if isbn:
+                self.books_by_isbn[isbn].append(book_id)
+        for entries in self.books_by_series.values():
+            entries.sort()
+
+# Reused by the series and ISBN checks until the library is next changed
+_series_isbn_index = None
+
+
 class MetadataCheck(BaseCheck):
     '''
     All checks related to working with book metadata.
@@ -76,18 +107,15 @@ class MetadataCheck(BaseCheck):
                 book_lang = None
             return book_lang
 
-        def evaluate_book(book_id, db):
-            current_title_sort = db.title_sort(book_id, index_is_id=True)
-            current_languages = db.languages(book_id, index_is_id=True)
+        def evaluate_book(title, current_title_sort, current_languages):
             book_lang = None
             if current_languages:
-                book_lang = current_languages.split(',')[0]
-            title = db.title(book_id, index_is_id=True)
+                book_lang = current_languages[0]
             if current_title_sort != title_sort(title, lang=book_lang):
                 return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['title', 'sort', 'languages'], evaluate_book,
                              no_match_msg='All searched books have a valid Title Sort',
                              marked_text='invalid_title_sort',
                              status_msg_type='books for invalid title sort')
@@ -95,17 +123,14 @@ class MetadataCheck(BaseCheck):
 
     def check_author_sort_valid(self):
 
-        def evaluate_book(book_id, db):
-            current_author_sort = db.author_sort(book_id, index_is_id=True)
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(authors, current_author_sort):
             if not authors:
                 return True
-            authors = [a.strip().replace('|', ',') for a in authors.split(',')]
-            if current_author_sort != db.author_sort_from_authors(authors):
+            if current_author_sort != self.db.author_sort_from_authors(list(authors)):
                 return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['authors', 'author_sort'], evaluate_book,
                              no_match_msg='All searched books have a valid Author Sort',
                              marked_text='invalid_author_sort',
                              status_msg_type='books for invalid author sort')
@@ -113,14 +138,14 @@ class MetadataCheck(BaseCheck):
 
     def check_isbn_valid(self):
 
-        def evaluate_book(book_id, db):
-            isbn = db.isbn(book_id, index_is_id=True)
+        def evaluate_book(identifiers):
+            isbn = identifiers.get('isbn') if identifiers else None
             if isbn:
                 if not check_isbn(isbn):
                     return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['identifiers'], evaluate_book,
                              no_match_msg='All searched books have a valid ISBN',
                              marked_text='invalid_isbn',
                              status_msg_type='books for invalid ISBN')
@@ -128,14 +153,12 @@ class MetadataCheck(BaseCheck):
 
     def check_pubdate_valid(self):
 
-        def evaluate_book(book_id, db):
-            pubdate = db.pubdate(book_id, index_is_id=True)
-            timestamp = db.timestamp(book_id, index_is_id=True)
+        def evaluate_book(pubdate, timestamp):
             if pubdate == timestamp:
                 return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['pubdate', 'timestamp'], evaluate_book,
                              no_match_msg='All searched books have a valid pubdate',
                              marked_text='invalid_pubdate',
                              status_msg_type='books for invalid pubdate')
@@ -143,93 +166,65 @@ class MetadataCheck(BaseCheck):
 
     def check_duplicate_isbn(self):
 
-        books_by_isbn = {}
-
-        def evaluate_book(book_id, db):
-            isbn = db.isbn(book_id, index_is_id=True)
-            if isbn:
-                if isbn not in books_by_isbn:
-                    books_by_isbn[isbn] = set()
-                books_by_isbn[isbn].add(book_id)
-            # We will determine the match as a post step, not in this function
-            return False
-
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type='books for duplicate ISBN')
+        index = self.get_series_isbn_index()
+        selected_ids = set(self.book_ids)
         result_ids = list()
-        for values in books_by_isbn.values():
+        for book_ids in index.books_by_isbn.values():
+            values = [i for i in book_ids if i in selected_ids]
             if len(values) > 1:
                 result_ids.extend(values)
         # Time to display the results
         if len(result_ids) > 0:
             self.show_invalid_rows(result_ids, 'duplicate_isbn')
 
-        msg = 'Checked %d books, found %d matches' %(total_count, len(result_ids))
+        msg = 'Checked %d books, found %d matches' %(len(selected_ids), len(result_ids))
         self.gui.status_bar.showMessage(msg)
         if len(result_ids) == 0:
-            info_dialog(self.gui, 'No Matches%s'%cancelled_msg,
+            info_dialog(self.gui, 'No Matches',
                                'All searched books have unique ISBNs', show=True)
 
 
     def check_duplicate_series(self):
 
-        books_by_series = {}
-
-        def evaluate_book(book_id, db):
-            series = db.series(book_id, index_is_id=True)
-            if series:
-                series_index = db.series_index(book_id, index_is_id=True)
-                _hash = '%s%0.4f'%(series, series_index)
-                if _hash not in books_by_series:
-                    books_by_series[_hash] = set()
-                books_by_series[_hash].add(book_id)
-            # We will determine the match as a post step, not in this function
-            return False
-
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type='books for duplicate series')
+        index = self.get_series_isbn_index()
+        selected_ids = set(self.book_ids)
         result_ids = list()
-        for values in books_by_series.values():
-            if len(values) > 1:
-                result_ids.extend(values)
+        for entries in index.books_by_series.values():
+            books_by_series_index = defaultdict(list)
+            for series_index, _pubdate, book_id in entries:
+                if book_id in selected_ids:
+                    books_by_series_index['%0.4f'%series_index].append(book_id)
+            for values in books_by_series_index.values():
+                if len(values) > 1:
+                    result_ids.extend(values)
         # Time to display the results
         if len(result_ids) > 0:
             self.show_invalid_rows(result_ids, 'duplicate_series')
             self.gui.library_view.sort_by_named_field('series', True)
 
-        msg = 'Checked %d books, found %d matches' %(total_count, len(result_ids))
+        msg = 'Checked %d books, found %d matches' %(len(selected_ids), len(result_ids))
         self.gui.status_bar.showMessage(msg)
         if len(result_ids) == 0:
-            info_dialog(self.gui, 'No Matches%s'%cancelled_msg,
+            info_dialog(self.gui, 'No Matches',
                                'All searched books have unique series indexes', show=True)
 
 
     def check_series_gaps(self):
 
-        series_name_book_map = defaultdict(list)
-        series_name_indexes_map = defaultdict(list)
-
-        def evaluate_book(book_id, db):
-            series = db.series(book_id, index_is_id=True)
-            if series:
-                series_index = db.series_index(book_id, index_is_id=True)
-                series_name_book_map[series].append(book_id)
-                if round(series_index) == series_index and series_index > 0:
-                    series_name_indexes_map[series].append(int(series_index))
-            # We will determine the match as a post step, not in this function
-            return False
-
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type='books for series gaps')
+        index = self.get_series_isbn_index()
+        selected_ids = set(self.book_ids)
         result_ids = list()
         series_gap_count = book_gap_count = 0
-        for series_name in sorted(list(series_name_indexes_map.keys()), key=lambda s: s.lower()):
+        for series_name in sorted(list(index.books_by_series.keys()), key=lambda s: s.lower()):
+            entries = [e for e in index.books_by_series[series_name] if e[2] in selected_ids]
+            series_indexes = [int(e[0]) for e in entries if round(e[0]) == e[0] and e[0] > 0]
+            if not series_indexes:
+                continue
             # Identify whether there are any gaps in this series
-            series_indexes = sorted(series_name_indexes_map[series_name])
             max_value = max(series_indexes)
 
-            book_id = series_name_book_map[series_name][0]
-            authors = self.gui.current_db.authors(book_id, index_is_id=True)
+            book_id = entries[0][2]
+            authors = self.db.authors(book_id, index_is_id=True)
             if authors:
                 authors = [x.replace('|', ',') for x in authors.split(',')]
                 header_text = 'Series: <b>%s</b> - Author: <b>%s</b> - Last: #%d' % (series_name, authors_to_string(authors), max_value)
@@ -240,7 +235,6 @@ class MetadataCheck(BaseCheck):
                 continue
 
             series_gap_count += 1
-            series_indexes = sorted(series_indexes)
             idx = 0
             missing_ids = []
             for expected_idx in range(1,max_value):
@@ -251,7 +245,7 @@ class MetadataCheck(BaseCheck):
                     while expected_idx == series_indexes[idx]:
                         idx += 1
             if missing_ids:
-                result_ids.extend(series_name_book_map[series_name])
+                result_ids.extend(e[2] for e in entries)
                 self.log(header_text)
                 self.log('\tMissing#: ', ','.join(map(str, missing_ids)))
 
@@ -259,45 +253,33 @@ class MetadataCheck(BaseCheck):
             self.show_invalid_rows(result_ids, 'series_gaps')
             self.gui.library_view.sort_by_named_field('series', True)
 
-        msg = 'Checked %d books, found %d gaps in %d series' %(total_count, book_gap_count, series_gap_count)
+        msg = 'Checked %d books, found %d gaps in %d series' %(len(selected_ids), book_gap_count, series_gap_count)
         self.gui.status_bar.showMessage(msg)
         if len(result_ids) == 0:
-            info_dialog(self.gui, 'No Matches%s'%cancelled_msg,
+            info_dialog(self.gui, 'No Matches',
                                'No series gaps exist in the books searched', show=True)
         else:
-            ResultsSummaryDialog(self.gui, 'Series Gaps Found%s'%cancelled_msg, msg, self.log).exec_()
+            ResultsSummaryDialog(self.gui, 'Series Gaps Found', msg, self.log).exec_()
 
 
     def check_series_pubdate(self):
 
         from calibre.utils.date import utc_tz
 
-        series_name_book_map = defaultdict(list)
-        series_name_indexes_map = defaultdict(list)
-
-        def evaluate_book(book_id, db):
-            series = db.series(book_id, index_is_id=True)
-            if series:
-                series_index = db.series_index(book_id, index_is_id=True)
-                series_name_book_map[series].append(book_id)
-                # Ignore books with series index < 1 - will assume they are anthologies or unrelated books
-                if series_index >= 1:
-                    # Add a tuple of the series index and the pubdate
-                    pubdate = db.pubdate(book_id, index_is_id=True)
-                    series_name_indexes_map[series].append( (series_index, pubdate) )
-            # We will determine the match as a post step, not in this function
-            return False
-
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type='books for series pubdate order')
+        index = self.get_series_isbn_index()
+        selected_ids = set(self.book_ids)
         result_ids = list()
         series_disorder_count = book_disorder_count = 0
-        for series_name in sorted(series_name_indexes_map.keys()):
+        for series_name in sorted(index.books_by_series.keys()):
+            entries = [e for e in index.books_by_series[series_name] if e[2] in selected_ids]
+            # Ignore books with series index < 1 - will assume they are anthologies or unrelated books
+            series_index_dates = [(sidx, pubdate) for sidx, pubdate, _book_id in entries if sidx >= 1]
+            if not series_index_dates:
+                continue
             # Identify whether there are any ordering issues in this series
-            series_index_dates = sorted(series_name_indexes_map[series_name])
 
-            book_id = series_name_book_map[series_name][0]
-            authors = self.gui.current_db.authors(book_id, index_is_id=True)
+            book_id = entries[0][2]
+            authors = self.db.authors(book_id, index_is_id=True)
             if authors:
                 authors = [x.replace('|', ',') for x in authors.split(',')]
                 self.log('Series: <b>%s</b> - Author: <b>%s</b>'%
@@ -315,37 +297,50 @@ class MetadataCheck(BaseCheck):
                 last_pubdate = pubdate
 
             if is_series_wrong:
-                result_ids.extend(series_name_book_map[series_name])
+                result_ids.extend(e[2] for e in entries)
                 series_disorder_count += 1
 
         if len(result_ids) > 0:
             self.show_invalid_rows(result_ids, 'series_pubdate')
             self.gui.library_view.sort_by_named_field('series', True)
 
-        msg = 'Checked %d books, found %d disordered in %d series' %(total_count, book_disorder_count, series_disorder_count)
+        msg = 'Checked %d books, found %d disordered in %d series' %(len(selected_ids), book_disorder_count, series_disorder_count)
         self.gui.status_bar.showMessage(msg)
         if len(result_ids) == 0:
-            info_dialog(self.gui, 'No Matches%s'%cancelled_msg,
+            info_dialog(self.gui, 'No Matches',
                                'No series pubdate disorders exist in the books searched', show=True)
         else:
             ResultsSummaryDialog(self.gui, 'Series Pubdate Issues Found', msg, self.log).exec_()
 
 
+    def get_series_isbn_index(self):
+        '''
+        Select the books to check, returning the index of the series and ISBNs
+        of the whole library. The index is kept for the rest of the session
+        and only rebuilt once the library has been changed.
+        '''
+        global _series_isbn_index
+        self.select_book_ids()
+        db = self.db
+        key = (db.library_id, db.last_modified())
+        if _series_isbn_index is None or _series_isbn_index.key != key:
+            _series_isbn_index = SeriesIsbnIndex(db, key)
+        return _series_isbn_index
+
+
     def check_tags_count(self):
         c = cfg.plugin_prefs[cfg.STORE_OPTIONS]
         max_tags = c[cfg.KEY_MAX_TAGS]
         excluded_tags_set = set(c[cfg.KEY_MAX_TAG_EXCLUSIONS])
 
-        def evaluate_book(book_id, db):
-            tags = db.tags(book_id, index_is_id=True)
+        def evaluate_book(tags):
             if tags:
-                tags = [t.strip() for t in tags.split(',')]
                 tags_set = set(tags) - excluded_tags_set
                 if len(tags_set) > max_tags:
                     return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['tags'], evaluate_book,
                              no_match_msg='All searched books have a valid tag count',
                              marked_text='excess_tags',
                              status_msg_type='books for invalid tag count')
@@ -368,8 +363,7 @@ class MetadataCheck(BaseCheck):
                 ]
         ]
 
-        def evaluate_book(book_id, db):
-            comments = db.comments(book_id, index_is_id=True)
+        def evaluate_book(comments):
             if comments:
                 has_html = False
                 for pat in html_patterns:
@@ -380,7 +374,7 @@ class MetadataCheck(BaseCheck):
                     return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['comments'], evaluate_book,
                              no_match_msg='All searched books have no HTML in comments',
                              marked_text='html_in_comments',
                              status_msg_type='books for no HTML in comments')
@@ -405,8 +399,7 @@ class MetadataCheck(BaseCheck):
                 ]
         ]
 
-        def evaluate_book(book_id, db):
-            comments = db.comments(book_id, index_is_id=True)
+        def evaluate_book(comments):
             if comments:
                 has_no_html = True
                 for pat in no_html_patterns:
@@ -417,7 +410,7 @@ class MetadataCheck(BaseCheck):
                     return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['comments'], evaluate_book,
                              no_match_msg='All searched books have HTML in comments',
                              marked_text='no_html_in_comments',
                              status_msg_type='books for HTML in comments')
@@ -425,16 +418,14 @@ class MetadataCheck(BaseCheck):
 
     def check_authors_commas(self):
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     if ',' in author:
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['authors'], evaluate_book,
                              no_match_msg='All searched book authors have no commas',
                              marked_text='authors_commas',
                              status_msg_type='books with authors having commas')
@@ -442,16 +433,14 @@ class MetadataCheck(BaseCheck):
 
     def check_authors_no_commas(self):
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     if ',' not in author:
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['authors'], evaluate_book,
                              no_match_msg='All searched book authors have commas',
                              marked_text='authors_no_commas',
                              status_msg_type='books with authors not having commas')
@@ -459,16 +448,14 @@ class MetadataCheck(BaseCheck):
 
     def check_authors_case(self):
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     if author == author.upper() or author == author.lower():
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['authors'], evaluate_book,
                              no_match_msg='All searched authors have a valid casing',
                              marked_text='invalid_author_case',
                              status_msg_type='books for invalid author casing')
@@ -478,17 +465,15 @@ class MetadataCheck(BaseCheck):
         RE_ALPHA = re.compile(r'[^A-Za-z\'\.,\- ]', re.UNICODE)
         handler = get_udc()
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     ascii_author = handler.decode(author)
                     if RE_ALPHA.search(ascii_author):
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['authors'], evaluate_book,
                              no_match_msg='All searched book authors have alphabetic names',
                              marked_text='authors_non_alphabetic',
                              status_msg_type='books with authors having non-alphabetic names')
@@ -497,17 +482,15 @@ class MetadataCheck(BaseCheck):
     def check_authors_non_ascii(self):
         handler = get_udc()
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     ascii_author = handler.decode(author)
                     if ascii_author != author:
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['authors'], evaluate_book,
                              no_match_msg='All searched book authors have ascii names',
                              marked_text='authors_non_ascii',
                              status_msg_type='books with authors having non-ascii names')
@@ -517,17 +500,15 @@ class MetadataCheck(BaseCheck):
         c = cfg.plugin_prefs[cfg.STORE_OPTIONS]
         initials_mode = c.get(cfg.KEY_AUTHOR_INITIALS_MODE, cfg.AUTHOR_INITIALS_MODES[0])
 
-        def evaluate_book(book_id, db):
-            authors = db.authors(book_id, index_is_id=True)
+        def evaluate_book(authors):
             if authors:
-                authors = [a.strip().replace('|', ',') for a in authors.split(',')]
                 for author in authors:
                     expected_author = get_formatted_author_initials(initials_mode, author)
                     if expected_author != author:
                         return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['authors'], evaluate_book,
                              no_match_msg='All searched book authors have correct initials',
                              marked_text='authors_incorrect_initials',
                              status_msg_type='books with authors having incorrect initials')
@@ -535,14 +516,13 @@ class MetadataCheck(BaseCheck):
 
     def check_titles_series(self):
 
-        def evaluate_book(book_id, db):
-            title = db.title(book_id, index_is_id=True)
+        def evaluate_book(title):
             if '-' not in title:
                 if re.match(r'[0-9]', title) is None:
                     return False
             return True
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['title'], evaluate_book,
                              no_match_msg='All searched books do not have titles with series names',
                              marked_text='invalid_titles_series',
                              status_msg_type='book titles with possible series names')
@@ -550,13 +530,12 @@ class MetadataCheck(BaseCheck):
 
     def check_titles_titlecase(self):
 
-        def evaluate_book(book_id, db):
-            title = db.title(book_id, index_is_id=True)
+        def evaluate_book(title):
             if title != titlecase(title):
                 return True
             return False
 
-        self.check_all_files(evaluate_book,
+        self.check_all_fields(['title'], evaluate_book,
                              no_match_msg='All searched titles have a valid title casing',
                              marked_text='invalid_title_case',
                              status_msg_type='books for invalid title casing')
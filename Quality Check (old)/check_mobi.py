@@ -19,7 +19,10 @@ class MobiCheck(BaseCheck):
     '''
     All checks related to working with MOBI formats.
     '''
+    supports_parallel = True
+
     MOBI_FORMATS = ['MOBI', 'AZW', 'AZW3']
+    result_cache_formats = MOBI_FORMATS
 
     def __init__(self, gui):
         BaseCheck.__init__(self, gui, 'formats:=mobi or formats:=azw or formats:=azw3')
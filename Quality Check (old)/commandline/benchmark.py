@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import sys, os, io, json, re, time, traceback
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    clock = time.time
+
+HELP_INFO = '''
+To invoke this script:
+
+  calibre-debug -e benchmark.py "library_path" [menu_keys] args
+
+    library_path      - Mandatory. Path to the calibre library to benchmark against,
+                        such as one created by make_corpus.py
+
+    menu_keys         - Optional. The checks to time, using the menu keys listed by --list.
+                        If not specified, every check which can be timed is run.
+
+    --threads n       - Optional. The number of books to check at the same time, defaults to 1.
+
+    --together        - Also time all the selected ePub checks run together in a single pass.
+
+    --output "path"   - Optional. Also write the results as JSON to this file, for comparing
+                        the timings before and after a change.
+
+    --patterns n      - Instead of timing the checks against a library, time parsing the
+                        margins of a stylesheet n times, the way "Check CSS book margins"
+                        parsed each file before its patterns were compiled once, and now.
+
+    --list, --l       - List the menu keys of the checks that can be timed
+
+    --help, --h       - Display this help
+
+For each check the script reports the number of books checked per second,
+the peak memory used by the process so far, and the time spent in each
+phase of reading the books. Time not spent in any of the phases is
+reported as "other", which is the check logic itself such as lxml queries.
+The phases are only timed separately when checking one book at a time.
+
+Exclusions and cached results are not used, so every book is read.
+
+e.g. To time all the ePub, MOBI and metadata checks with 4 threads
+    calibre-debug -e benchmark.py "/tmp/qc_corpus" --threads 4 --output "before.json"
+
+e.g. To time parsing the css margins 100000 times
+    calibre-debug -e benchmark.py --patterns 100000
+'''
+
+BENCHMARK_CATEGORIES = ['epub', 'mobi', 'metadata']
+# Checks which prompt for their options, or need the gui after evaluating the books
+UNSUPPORTED_CHECKS = ['search_epub', 'check_epub_multiple', 'check_epub_profile',
+                      'check_dup_isbn', 'check_dup_series', 'check_series_gaps', 'check_series_pubdate']
+LIST_OPTIONS = ['l', 'list']
+HELP_OPTIONS = ['h', 'help']
+
+# The number of times to repeat timing the patterns, keeping the fastest
+PATTERN_REPEATS = 5
+# A stylesheet with the kind of @page and body rules the css margins check parses
+SAMPLE_MARGINS_CSS = '''
+@page { margin-top: 5pt; margin-bottom: 5pt; margin-left: 5pt; margin-right: 5pt; }
+body { font-family: serif; line-height: 1.2; }
+.calibre { display: block; font-size: 1em; padding-left: 0; padding-right: 0; }
+@page { margin-top: 0; margin-bottom: 0; margin-left: 0; margin-right: 0; }
+'''
+
+
+def dump_help():
+    print(HELP_INFO)
+
+
+def get_benchmark_checks():
+    import calibre.customize.ui
+    import calibre_plugins.quality_check.config as cfg
+    return [(k, v) for k, v in cfg.PLUGIN_MENUS.items()
+            if v['cat'] in BENCHMARK_CATEGORIES and k not in UNSUPPORTED_CHECKS]
+
+
+def dump_checks():
+    for menu_key, value in get_benchmark_checks():
+        print('  %-30s %s' % (menu_key, value['tooltip']))
+
+
+def make_absolute_path(file_path):
+    if not os.path.isabs(file_path):
+        file_path = os.path.join(os.getcwd(), file_path)
+        file_path = os.path.normpath(file_path)
+    return file_path
+
+
+def parse_args(args):
+    library_path = None
+    menu_keys = []
+    threads = 1
+    together = False
+    output_path = None
+    pattern_iterations = None
+
+    benchmark_checks = get_benchmark_checks()
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg.startswith('--'):
+            option_name = arg[2:].lower()
+            if option_name in HELP_OPTIONS:
+                dump_help()
+                return None
+            if option_name in LIST_OPTIONS:
+                dump_checks()
+                return None
+            if option_name == 'together':
+                together = True
+            elif option_name in ['threads', 'output', 'patterns'] and i < len(args):
+                value = args[i]
+                i += 1
+                if option_name == 'output':
+                    output_path = make_absolute_path(value)
+                else:
+                    try:
+                        number = max(1, int(value))
+                    except ValueError:
+                        print('ERROR: --%s requires a number' % option_name)
+                        return None
+                    if option_name == 'threads':
+                        threads = number
+                    else:
+                        pattern_iterations = number
+            else:
+                print('ERROR: Unknown argument: ', option_name)
+                return None
+        elif library_path is None:
+            library_path = make_absolute_path(arg)
+        elif arg in dict(benchmark_checks):
+            menu_keys.append(arg)
+        else:
+            print('ERROR: Unknown or unsupported check: ', arg)
+            return None
+    if not library_path and not pattern_iterations:
+        dump_help()
+        return None
+    if not menu_keys:
+        menu_keys = [k for k, _v in benchmark_checks]
+    return library_path, menu_keys, threads, together, output_path, pattern_iterations
+
+
+def get_peak_rss():
+    '''
+    The peak memory used by this process in bytes, or None if unknown
+    '''
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in kilobytes on linux but bytes on OS X
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except:
+        return None
+
+
+def create_check(menu_cat, db, threads):
+    from calibre_plugins.quality_check.check_epub import EpubCheck
+    from calibre_plugins.quality_check.check_mobi import MobiCheck
+    from calibre_plugins.quality_check.check_metadata import MetadataCheck
+    from calibre_plugins.quality_check.workers import BufferedLog, ThreadedLog
+    if menu_cat == 'epub':
+        check = EpubCheck(None)
+    elif menu_cat == 'mobi':
+        check = MobiCheck(None)
+    else:
+        check = MetadataCheck(None)
+    check.db = db
+    # Keep the log output of the checks off the console
+    check.log = ThreadedLog(BufferedLog())
+    check.worker_count = threads
+    # Every book must be read for the timings to be comparable between runs
+    check.result_cache_formats = None
+    return check
+
+
+def get_book_ids(check, db):
+    if check.initial_search:
+        return db.search(check.initial_search, return_matches=True)
+    return list(db.all_ids())
+
+
+def evaluate_books(check, callback_fn, book_ids, threads):
+    from calibre_plugins.quality_check.instrumentation import InstrumentedDb
+    from calibre_plugins.quality_check.workers import BookWorkerPool
+    callback_fn = check.timed_callback(callback_fn)
+    db = InstrumentedDb(check.db)
+    match_count = 0
+    if threads < 2 or not check.supports_parallel:
+        for book_id in book_ids:
+            if callback_fn(book_id, db):
+                match_count += 1
+        return match_count
+    worker_pool = BookWorkerPool(book_ids, callback_fn, db, check.log, threads)
+    worker_pool.start()
+    worker_pool.join()
+    for book_id, matched in worker_pool.drain():
+        if matched:
+            match_count += 1
+    return match_count
+
+
+def time_check(name, run_fn, book_count, threads):
+    from calibre_plugins.quality_check.instrumentation import instrumentation
+    instrumentation.reset()
+    instrumentation.enable()
+    start = clock()
+    try:
+        match_count = run_fn()
+    finally:
+        elapsed = clock() - start
+        instrumentation.enable(False)
+    totals = instrumentation.snapshot()
+    phases = totals['times']
+    if threads == 1:
+        phases['other'] = max(0.0, elapsed - sum(phases.values()))
+    return {'name': name, 'books': book_count, 'matches': match_count, 'seconds': elapsed,
+            'books_per_second': book_count / elapsed if elapsed else 0.0,
+            'peak_rss': get_peak_rss(), 'phases': phases, 'counters': totals['counters'],
+            'slowest_books': totals['slowest_books']}
+
+
+def benchmark_check(menu_key, menu_cat, db, threads):
+    check = create_check(menu_cat, db, threads)
+    # Gather the callback for the check rather than running it, so that
+    # only the evaluation of the books is timed
+    check.collected_checks = []
+    check.menu_key = menu_key
+    check.perform_check(menu_key)
+    callback_fn = check.collected_checks[0]['callback_fn']
+    book_ids = get_book_ids(check, db)
+    return time_check(menu_key, lambda: evaluate_books(check, callback_fn, book_ids, threads),
+                      len(book_ids), threads)
+
+
+def benchmark_together(epub_keys, db, threads):
+    check = create_check('epub', db, threads)
+    book_ids = get_book_ids(check, db)
+
+    def run_fn():
+        check.run_checks_together(epub_keys)
+        return sum(len(r['result_ids']) for r in check.results)
+
+    return time_check('(%d ePub checks together)' % len(epub_keys), run_fn, len(book_ids), threads)
+
+
+def parse_margins_before(data):
+    '''
+    The margins of the @page rules in the lower cased css, parsed the way the
+    css margins check did for each file before its patterns were compiled once
+    '''
+    from calibre.ebooks.conversion.config import load_defaults
+    from calibre_plugins.quality_check.check_epub import RE_BOOK_MGNS_CSS
+    # The page setup preferences were read again for every file
+    load_defaults('page_setup')
+    margins = {}
+    for match in RE_BOOK_MGNS_CSS.finditer(data):
+        styles = re.sub(r'\s*;$', '', match.group('styles').strip())
+        for style in styles.split(';'):
+            if style:
+                style = [s.strip() for s in style.split(':')]
+                margins[re.sub('-', '_', style[0])] = float(re.sub(r'[^\d.]+', '', style[1]))
+    return margins
+
+
+def parse_margins_after(data):
+    '''
+    The margins of the @page rules in the lower cased css, parsed the way the
+    css margins check does now
+    '''
+    from calibre_plugins.quality_check.check_epub import (RE_BOOK_MGNS_CSS, RE_TRAILING_SEMICOLONS,
+                                                          RE_NON_NUMERIC)
+    margins = {}
+    for match in RE_BOOK_MGNS_CSS.finditer(data):
+        styles = RE_TRAILING_SEMICOLONS.sub('', match.group('styles').strip())
+        for style in styles.split(';'):
+            if style:
+                style = [s.strip() for s in style.split(':')]
+                margins[style[0].replace('-', '_')] = float(RE_NON_NUMERIC.sub('', style[1]))
+    return margins
+
+
+def benchmark_patterns(iterations):
+    data = SAMPLE_MARGINS_CSS.lower()
+    if parse_margins_before(data) != parse_margins_after(data):
+        raise ValueError('The margins parsed before and after do not match')
+    results = []
+    for name, parse_fn in [('css margins before', parse_margins_before),
+                           ('css margins after', parse_margins_after)]:
+        best = None
+        for _repeat in range(PATTERN_REPEATS):
+            start = clock()
+            for _i in range(iterations):
+                parse_fn(data)
+            elapsed = clock() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({'name': name, 'files': iterations, 'seconds': best,
+                        'files_per_second': iterations / best if best else 0.0})
+    return results
+
+
+def print_pattern_result(result):
+    print('%-32s %8d files %8.3fs %11.1f files/s  (best of %d)' % (
+            result['name'], result['files'], result['seconds'], result['files_per_second'], PATTERN_REPEATS))
+
+
+def format_size(value):
+    if value is None:
+        return 'n/a'
+    return '%.1fMB' % (value / (1024 * 1024))
+
+
+def print_result(result):
+    print('%-32s %6d books %6d matches %8.2fs %9.1f books/s  peak %s' % (
+            result['name'], result['books'], result['matches'], result['seconds'],
+            result['books_per_second'], format_size(result['peak_rss'])))
+    from calibre_plugins.quality_check.instrumentation import ALL_PHASES, COUNTER_BYTES_READ
+    phases = result['phases']
+    for phase in ALL_PHASES + ['other']:
+        if phase in phases:
+            share = 100 * phases[phase] / result['seconds'] if result['seconds'] else 0
+            print('    %-14s %8.3fs %5.1f%%' % (phase, phases[phase], share))
+    if COUNTER_BYTES_READ in result['counters']:
+        print('    %-14s %s' % (COUNTER_BYTES_READ, format_size(result['counters'][COUNTER_BYTES_READ])))
+
+
+def main():
+    args = sys.argv[1:]
+    try:
+        parsed = parse_args(args)
+        if not parsed:
+            return 2
+        library_path, menu_keys, threads, together, output_path, pattern_iterations = parsed
+
+        import calibre.customize.ui
+        import calibre_plugins.quality_check.config as cfg
+
+        if pattern_iterations:
+            results = benchmark_patterns(pattern_iterations)
+            for result in results:
+                print_pattern_result(result)
+            before, after = results
+            if after['seconds']:
+                print('%.1fx faster' % (before['seconds'] / after['seconds']))
+            if output_path:
+                data = {'python': sys.version, 'results': results}
+                with io.open(output_path, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps(data, indent=2, ensure_ascii=False))
+            return 0
+
+        from calibre.library import db as open_library
+        db = open_library(library_path)
+
+        results = []
+        for menu_key in menu_keys:
+            result = benchmark_check(menu_key, cfg.PLUGIN_MENUS[menu_key]['cat'], db, threads)
+            print_result(result)
+            results.append(result)
+        epub_keys = [k for k in menu_keys if cfg.PLUGIN_MENUS[k]['cat'] == 'epub']
+        if together and epub_keys:
+            result = benchmark_together(epub_keys, db, threads)
+            print_result(result)
+            results.append(result)
+
+        if output_path:
+            data = {'library': library_path, 'threads': threads, 'python': sys.version, 'results': results}
+            with io.open(output_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(data, indent=2, ensure_ascii=False))
+    except:
+        print(traceback.format_exc())
+        return 2
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,6 @@
+:: This is an example of how to run the command line version of Quality Check from a batch file
+:: It assumes a single argument of the library folder to be checked, and will run the ePub
+:: checks for unused images and missing jackets against it, writing the results to a csv file
+::
+:: e.g. example.cmd "D:\Books"
+calibre-debug -e qc.py "%1" check_epub_unused_images check_epub_no_jacket --quiet --output "qc_results.csv"
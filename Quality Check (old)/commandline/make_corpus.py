@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import sys, os, random, shutil, struct, tempfile, traceback, zipfile, datetime
+
+HELP_INFO = '''
+To invoke this script:
+
+  calibre-debug -e make_corpus.py "library_path" args
+
+    library_path      - Mandatory. Path to an empty folder to create the calibre library in.
+
+    --books n         - Optional. The number of books to create, defaults to 1000.
+
+    --seed n          - Optional. The seed for the random choices, defaults to 1.
+                        The same seed and number of books always creates the same library.
+
+    --help, --h       - Display this help
+
+Each book has an ePub and, for roughly half of them, a MOBI format. The ePubs
+vary in their number and size of html files, images and stylesheets, and
+some have unused images or css, body margins, jackets, DRM encryption,
+javascript or iTunes artifacts. The MOBIs vary in their ASIN, cdetype and
+clipping limit EXTH records. The metadata has a mix of author name styles,
+series with gaps and duplicates, valid, invalid and duplicate ISBNs.
+
+e.g. To create a library of 5000 books to benchmark against
+    calibre-debug -e make_corpus.py "/tmp/qc_corpus" --books 5000
+'''
+
+HELP_OPTIONS = ['h', 'help']
+BATCH_SIZE = 100
+
+# A 1x1 pixel png image
+PNG_DATA = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00'
+            b'\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa7'
+            b'5\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+
+FIRST_NAMES = ['John', 'Mary', 'Robert', 'Patricia', 'James', 'Jennifer', 'Michael', 'Linda',
+               'William', 'Elizabeth', 'Émile', 'Søren', 'José', 'Zoë']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis',
+              'Wilson', 'Anderson', 'Zola', 'Kierkegaard', 'Saramago', 'MacDonald']
+WORDS = ['the', 'of', 'and', 'a', 'shadow', 'river', 'night', 'garden', 'empire', 'secret',
+         'winter', 'glass', 'storm', 'house', 'silver', 'last', 'king', 'voyage', 'city', 'light']
+TAGS = ['Fiction', 'Fantasy', 'Science Fiction', 'History', 'Mystery', 'Romance', 'Thriller',
+        'Biography', 'Horror', 'Poetry', 'Travel', 'Humour']
+
+CONTAINER_XML = '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+'''
+
+ENCRYPTION_XML = '''<?xml version="1.0"?>
+<encryption xmlns="urn:oasis:names:tc:opendocument:xmlns:container"
+            xmlns:enc="http://www.w3.org/2001/04/xmlenc#">
+  <enc:EncryptedData>
+    <enc:EncryptionMethod Algorithm="http://www.w3.org/2001/04/xmlenc#aes128-cbc"/>
+    <enc:CipherData><enc:CipherReference URI="OEBPS/chapter1.xhtml"/></enc:CipherData>
+  </enc:EncryptedData>
+</encryption>
+'''
+
+CURRENT_JACKET = '''<?xml version='1.0' encoding='utf-8'?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>%s</title>
+<meta content="jacket" name="calibre-content"/></head>
+<body><div class="calibre_rescale_100"><h1 class="title">%s</h1></div></body></html>
+'''
+
+LEGACY_JACKET = '''<?xml version='1.0' encoding='utf-8'?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>%s</title></head>
+<body><h1 class="calibrerescale_180">%s</h1></body></html>
+'''
+
+
+def dump_help():
+    print(HELP_INFO)
+
+
+def make_absolute_path(file_path):
+    if not os.path.isabs(file_path):
+        file_path = os.path.join(os.getcwd(), file_path)
+        file_path = os.path.normpath(file_path)
+    return file_path
+
+
+def parse_args(args):
+    library_path = None
+    book_count = 1000
+    seed = 1
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg.startswith('--'):
+            option_name = arg[2:].lower()
+            if option_name in HELP_OPTIONS:
+                dump_help()
+                return None, None, None
+            if option_name in ['books', 'seed'] and i < len(args):
+                try:
+                    value = int(args[i])
+                except ValueError:
+                    print('ERROR: --%s requires a number' % option_name)
+                    return None, None, None
+                i += 1
+                if option_name == 'books':
+                    book_count = value
+                else:
+                    seed = value
+            else:
+                print('ERROR: Unknown argument: ', option_name)
+                return None, None, None
+        else:
+            library_path = make_absolute_path(arg)
+    return library_path, book_count, seed
+
+
+def random_words(rnd, count):
+    return ' '.join(rnd.choice(WORDS) for i in range(count))
+
+
+def random_paragraphs(rnd, size):
+    paras = []
+    length = 0
+    while length < size:
+        para = '<p class="text">%s.</p>' % random_words(rnd, rnd.randint(20, 80)).capitalize()
+        paras.append(para)
+        length += len(para)
+    return '\n'.join(paras)
+
+
+def make_isbn(rnd):
+    digits = '978' + ''.join(rnd.choice('0123456789') for i in range(9))
+    total = sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(digits))
+    return digits + '%d' % ((10 - total % 10) % 10)
+
+
+def make_book_spec(rnd, index):
+    '''
+    The random choices for a single book, so a given seed always creates the same library
+    '''
+    spec = {}
+    spec['chapters'] = rnd.randint(1, 40)
+    # Most chapters are small, a few are oversize to be found by the html size check
+    spec['chapter_size'] = rnd.choice([2, 8, 20, 50, 120]) * 1024
+    spec['oversize_chapter'] = rnd.random() < 0.05
+    spec['images'] = rnd.randint(0, 30)
+    spec['unused_images'] = rnd.randint(0, 3) if rnd.random() < 0.2 else 0
+    spec['css_files'] = rnd.randint(1, 4)
+    spec['unused_css'] = rnd.random() < 0.1
+    spec['body_margins'] = rnd.random() < 0.3
+    spec['text_align'] = rnd.random() < 0.5
+    spec['jacket'] = rnd.choice([None, None, None, 'current', 'legacy', 'multiple'])
+    spec['drm'] = rnd.random() < 0.03
+    spec['javascript'] = rnd.random() < 0.05
+    spec['itunes'] = rnd.random() < 0.05
+    spec['mobi'] = rnd.random() < 0.5
+    spec['asin'] = rnd.random() < 0.7
+    spec['asin2'] = rnd.random() < 0.8
+    spec['cdetype'] = rnd.choice(['EBOK', 'EBOK', 'EBOK', 'PDOC', None])
+    spec['clipping_limit'] = rnd.choice([None, None, None, 10, 100])
+    spec['mobi_size'] = rnd.choice([4, 64, 512, 2048]) * 1024
+    return spec
+
+
+def build_epub(path, rnd, spec, title):
+    manifest = []
+    spine = []
+    css_names = ['style%d.css' % i for i in range(spec['css_files'])]
+    image_names = ['images/image%d.png' % i for i in range(spec['images'] + spec['unused_images'])]
+    used_images = image_names[:spec['images']]
+    used_css = css_names[:-1] if spec['unused_css'] and len(css_names) > 1 else css_names
+
+    zf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    zf.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', zipfile.ZIP_STORED)
+    zf.writestr('META-INF/container.xml', CONTAINER_XML)
+    if spec['drm']:
+        zf.writestr('META-INF/encryption.xml', ENCRYPTION_XML)
+    if spec['itunes']:
+        zf.writestr('iTunesMetadata.plist', '<plist/>')
+
+    for i, css_name in enumerate(css_names):
+        css = '.text { text-indent: 1.5em; margin: 0 }\n'
+        if spec['text_align']:
+            css += 'p { text-align: justify }\n'
+        if i == 0 and spec['body_margins']:
+            css += 'body { margin-left: %dpt; margin-right: %dpt }\n' % (rnd.randint(0, 20), rnd.randint(0, 20))
+        zf.writestr('OEBPS/' + css_name, css)
+        manifest.append((css_name, 'text/css'))
+    for image_name in image_names:
+        zf.writestr('OEBPS/' + image_name, PNG_DATA)
+        manifest.append((image_name, 'image/png'))
+
+    links = ''.join('<link href="%s" rel="stylesheet" type="text/css"/>' % c for c in used_css)
+    script = '<script type="text/javascript">var x = 1;</script>' if spec['javascript'] else ''
+    for i in range(spec['chapters']):
+        size = spec['chapter_size']
+        if spec['oversize_chapter'] and i == 0:
+            size = 300 * 1024
+        images = ''.join('<img src="%s" alt=""/>' % img for img in used_images[i::spec['chapters']])
+        html = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>%s</title>%s%s</head>\n'
+                '<body><h2>Chapter %d</h2>%s\n%s</body></html>\n') % (
+                    title, links, script, i + 1, images, random_paragraphs(rnd, size))
+        name = 'chapter%d.xhtml' % (i + 1)
+        zf.writestr('OEBPS/' + name, html.encode('utf-8'))
+        manifest.append((name, 'application/xhtml+xml'))
+        spine.append(name)
+
+    jackets = []
+    if spec['jacket'] in ['current', 'multiple']:
+        jackets.append(('jacket.xhtml', CURRENT_JACKET))
+    if spec['jacket'] in ['legacy', 'multiple']:
+        jackets.append(('jacket_legacy.xhtml', LEGACY_JACKET))
+    for name, template in jackets:
+        zf.writestr('OEBPS/' + name, (template % (title, title)).encode('utf-8'))
+        manifest.append((name, 'application/xhtml+xml'))
+        spine.insert(0, name)
+
+    ncx_points = ''.join(('<navPoint id="np%d" playOrder="%d"><navLabel><text>Chapter %d</text></navLabel>'
+                          '<content src="%s"/></navPoint>') % (i, i, i, name)
+                         for i, name in enumerate(spine, start=1))
+    zf.writestr('OEBPS/toc.ncx', ('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+                '<head/><docTitle><text>%s</text></docTitle><navMap>%s</navMap></ncx>\n') % (title, ncx_points))
+    manifest.append(('toc.ncx', 'application/x-dtbncx+xml'))
+
+    items = ''.join('<item href="%s" id="id%d" media-type="%s"/>' % (href, i, media_type)
+                    for i, (href, media_type) in enumerate(manifest))
+    itemrefs = ''.join('<itemref idref="id%d"/>' % i for i, (href, media_type) in enumerate(manifest)
+                       if href in spine)
+    ncx_id = 'id%d' % (len(manifest) - 1)
+    opf = ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uuid_id">'
+           '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">'
+           '<dc:title>%s</dc:title><dc:identifier id="uuid_id">%s</dc:identifier><dc:language>en</dc:language>'
+           '</metadata><manifest>%s</manifest><spine toc="%s">%s</spine></package>\n') % (
+                title, os.path.basename(path), items, ncx_id, itemrefs)
+    zf.writestr('OEBPS/content.opf', opf.encode('utf-8'))
+    zf.close()
+
+
+def build_mobi(path, rnd, spec, title):
+    exth_records = []
+    asin = ('B%09d' % rnd.randint(0, 999999999)).encode('ascii')
+    if spec['asin']:
+        exth_records.append((113, asin))
+    if spec['asin2']:
+        exth_records.append((504, asin))
+    if spec['cdetype']:
+        exth_records.append((501, spec['cdetype'].encode('ascii')))
+    if spec['clipping_limit'] is not None:
+        exth_records.append((401, struct.pack('>B', spec['clipping_limit'])))
+    exth_records.append((503, title.encode('utf-8')))
+    exth = b''.join(struct.pack('>LL', code, len(data) + 8) + data for code, data in exth_records)
+    exth = b'EXTH' + struct.pack('>LL', len(exth) + 12, len(exth_records)) + exth
+    exth += b'\0' * (4 - len(exth) % 4)
+
+    text = random_paragraphs(rnd, spec['mobi_size']).encode('utf-8')
+    text_records = [text[i:i + 4096] for i in range(0, len(text), 4096)]
+    full_name = title.encode('utf-8')
+
+    header_length = 232
+    mobi_header = bytearray(header_length)
+    struct.pack_into('>4sLLLLL', mobi_header, 0, b'MOBI', header_length, 2, 65001,
+                     rnd.randint(0, 0xffffffff), 6)
+    struct.pack_into('>LL', mobi_header, 0x44, 16 + header_length + len(exth), len(full_name))
+    # The EXTH flag is at offset 0x80 of record 0, after the 16 byte PalmDOC header
+    struct.pack_into('>L', mobi_header, 0x80 - 16, 0x40)
+    palmdoc = struct.pack('>HHLHHHH', 1, 0, len(text), len(text_records), 4096, 0, 0)
+    record0 = palmdoc + bytes(mobi_header) + exth + full_name + b'\0\0'
+
+    records = [record0] + text_records
+    header = bytearray(78)
+    struct.pack_into('>32s', header, 0, title.encode('ascii', 'replace')[:31])
+    struct.pack_into('>4s4s', header, 0x3C, b'BOOK', b'MOBI')
+    struct.pack_into('>LH', header, 72, 0, len(records))
+    offset = 78 + 8 * len(records) + 2
+    record_list = b''
+    for i, record in enumerate(records):
+        record_list += struct.pack('>LL', offset, 2 * i)
+        offset += len(record)
+    with open(path, 'wb') as f:
+        f.write(bytes(header) + record_list + b'\0\0' + b''.join(records))
+
+
+def make_metadata(rnd, index, isbns, series_names):
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.utils.date import utc_tz
+    title = random_words(rnd, rnd.randint(2, 6))
+    if rnd.random() < 0.8:
+        title = title.title()
+    first, last = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+    style = rnd.random()
+    if style < 0.1:
+        author = '%s, %s' % (last, first)
+    elif style < 0.2:
+        author = '%s. %s. %s' % (first[0], rnd.choice(FIRST_NAMES)[0], last)
+    elif style < 0.25:
+        author = ('%s %s' % (first, last)).lower()
+    else:
+        author = '%s %s' % (first, last)
+    mi = Metadata(title, [author])
+    mi.tags = rnd.sample(TAGS, rnd.randint(0, 8))
+    if rnd.random() < 0.6:
+        mi.comments = '<p>%s</p>' % random_words(rnd, 30) if rnd.random() < 0.7 else random_words(rnd, 30)
+    if rnd.random() < 0.4:
+        # A few series share an index with another book or skip one
+        series = rnd.choice(series_names)
+        mi.series = series
+        mi.series_index = rnd.randint(1, 12)
+    isbn_choice = rnd.random()
+    if isbn_choice < 0.6:
+        isbn = make_isbn(rnd)
+        isbns.append(isbn)
+        mi.isbn = isbn
+    elif isbn_choice < 0.65:
+        mi.isbn = make_isbn(rnd)[:-1] + 'X'
+    elif isbn_choice < 0.7 and isbns:
+        mi.isbn = rnd.choice(isbns)
+    mi.pubdate = datetime.datetime(rnd.randint(1900, 2012), rnd.randint(1, 12), rnd.randint(1, 28), tzinfo=utc_tz)
+    mi.languages = ['eng']
+    return mi
+
+
+def create_corpus(library_path, book_count, seed):
+    import calibre.customize.ui
+    from calibre.library import db as open_library
+    if os.path.exists(library_path) and os.listdir(library_path):
+        print('ERROR: The library folder must be empty: ', library_path)
+        return False
+    rnd = random.Random(seed)
+    db = open_library(library_path)
+    tdir = tempfile.mkdtemp(prefix='qc_corpus_')
+    series_names = [random_words(rnd, 2).title() for i in range(max(1, book_count // 20))]
+    isbns = []
+    try:
+        for start in range(0, book_count, BATCH_SIZE):
+            books = []
+            for index in range(start, min(start + BATCH_SIZE, book_count)):
+                mi = make_metadata(rnd, index, isbns, series_names)
+                spec = make_book_spec(rnd, index)
+                fmts = {}
+                epub_path = os.path.join(tdir, '%d.epub' % index)
+                build_epub(epub_path, rnd, spec, mi.title)
+                fmts['EPUB'] = epub_path
+                if spec['mobi']:
+                    mobi_path = os.path.join(tdir, '%d.mobi' % index)
+                    build_mobi(mobi_path, rnd, spec, mi.title)
+                    fmts['MOBI'] = mobi_path
+                books.append((mi, fmts))
+            db.new_api.add_books(books, run_hooks=False)
+            for mi, fmts in books:
+                for path in fmts.values():
+                    os.remove(path)
+            print('Created %d of %d books' % (min(start + BATCH_SIZE, book_count), book_count))
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+    return True
+
+
+def main():
+    args = sys.argv[1:]
+    try:
+        library_path, book_count, seed = parse_args(args)
+        if not library_path:
+            return 2
+        if not create_corpus(library_path, book_count, seed):
+            return 2
+    except:
+        print(traceback.format_exc())
+        return 2
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
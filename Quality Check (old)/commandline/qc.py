@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import sys, os, io, csv, json, traceback
+
+from calibre.utils.logging import Log
+
+HELP_INFO = '''
+To invoke this script:
+
+  calibre-debug -e qc.py "library_path" menu_keys args
+
+    library_path      - Mandatory. Path to the calibre library folder to be checked.
+
+    menu_keys         - One or more quality checks to run, using the menu keys
+                        listed by --list. ePub checks are run together in a single
+                        pass opening each ePub only once.
+
+    --search "expr"   - Optional. Only check the books matching this calibre search.
+                        If not specified the whole library is checked.
+
+    --output "path"   - Optional. Write the results to this file, as CSV if the file
+                        name ends with .csv, otherwise as JSON.
+                        If not specified, the JSON results are written to the console.
+
+    --threads n       - Optional. The number of books to check at the same time.
+                        If not specified, uses the worker threads configured in calibre.
+
+    --quiet, --q      - Hide any debug or log output except for errors
+
+    --list, --l       - List the menu keys of the checks that can be run
+
+    --help, --h       - Display this help
+
+e.g. To list the checks which can be run from the command line:
+    calibre-debug -e qc.py --list
+
+e.g. To check an entire library for ePubs with unused images or missing jackets
+    calibre-debug -e qc.py "D:\\Books" check_epub_unused_images check_epub_no_jacket
+
+e.g. To check the MOBI books with a tag of "Kindle" using 4 threads, writing a csv file
+    calibre-debug -e qc.py "D:\\Books" check_mobi_missing_asin --search "tags:=Kindle" --threads 4 --output "results.csv"
+'''
+
+# The checks which prompt for their options in a dialog cannot be run from here
+HEADLESS_CATEGORIES = ['epub', 'mobi']
+UNSUPPORTED_CHECKS = ['search_epub', 'check_epub_multiple', 'check_epub_profile']
+QUIET_OPTIONS = ['q', 'quiet']
+LIST_OPTIONS = ['l', 'list']
+HELP_OPTIONS = ['h', 'help']
+
+
+def dump_help():
+    print(HELP_INFO)
+
+
+def get_headless_checks():
+    import calibre.customize.ui
+    import calibre_plugins.quality_check.config as cfg
+    return [(k, v) for k, v in cfg.PLUGIN_MENUS.items()
+            if v['cat'] in HEADLESS_CATEGORIES and k not in UNSUPPORTED_CHECKS]
+
+
+def dump_checks():
+    for menu_key, value in get_headless_checks():
+        print('  %-30s %s' % (menu_key, value['tooltip']))
+
+
+def make_absolute_path(file_path):
+    if not os.path.isabs(file_path):
+        file_path = os.path.join(os.getcwd(), file_path)
+        file_path = os.path.normpath(file_path)
+    return file_path
+
+
+def parse_args(args):
+    library_path = None
+    menu_keys = []
+    search = None
+    output_path = None
+    threads = None
+    quiet = False
+
+    headless_checks = dict(get_headless_checks())
+    i = 0
+    aborted = False
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg.startswith('--'):
+            option_name = arg[2:].lower()
+            if option_name in HELP_OPTIONS:
+                dump_help()
+                aborted = True
+                break
+            if option_name in LIST_OPTIONS:
+                dump_checks()
+                aborted = True
+                break
+            if option_name in QUIET_OPTIONS:
+                quiet = True
+            elif option_name in ['search', 'output', 'threads']:
+                if i >= len(args) or args[i].startswith('--'):
+                    print('ERROR: --%s requires a value' % option_name)
+                    aborted = True
+                    break
+                value = args[i]
+                i += 1
+                if option_name == 'search':
+                    search = value
+                elif option_name == 'output':
+                    output_path = make_absolute_path(value)
+                else:
+                    try:
+                        threads = max(1, int(value))
+                    except ValueError:
+                        print('ERROR: --threads requires a number')
+                        aborted = True
+                        break
+            else:
+                print('ERROR: Unknown argument: ', option_name)
+                aborted = True
+                break
+        elif library_path is None:
+            library_path = make_absolute_path(arg)
+        elif arg in headless_checks:
+            menu_keys.append(arg)
+        else:
+            print('ERROR: Unknown or unsupported check: ', arg)
+            aborted = True
+            break
+
+    if aborted:
+        return None, None, None, None, None, None
+    if not menu_keys:
+        print('ERROR: You must specify at least one check to run, see --list')
+        return None, None, None, None, None, None
+    return library_path, menu_keys, search, output_path, threads, quiet
+
+
+def pump_debug_output(library_path, menu_keys, search, output_path, threads):
+    print('------------------------------------')
+    print('QUALITY CHECK OPTIONS')
+    print('Library:     ', library_path)
+    print('Checks:      ', ','.join(menu_keys))
+    if search:
+        print('Search:      ', search)
+    if output_path:
+        print('Output:      ', output_path)
+    if threads:
+        print('Threads:     ', threads)
+    print('------------------------------------')
+
+
+def create_check(menu_cat, db, log, search, threads):
+    from calibre_plugins.quality_check.check_epub import EpubCheck
+    from calibre_plugins.quality_check.check_mobi import MobiCheck
+    from calibre_plugins.quality_check.workers import ThreadedLog
+    if menu_cat == 'epub':
+        check = EpubCheck(None)
+    else:
+        check = MobiCheck(None)
+    check.db = db
+    check.log = ThreadedLog(log)
+    check.worker_count = threads
+    if search:
+        check.initial_search = '(%s) and (%s)' % (check.initial_search, search)
+    return check
+
+
+def invoke_quality_check(library_path, menu_keys, search, threads, quiet):
+    import calibre.customize.ui
+    import calibre_plugins.quality_check.config as cfg
+    from calibre.library import db as open_library
+    if quiet:
+        log = Log(Log.ERROR)
+    else:
+        log = Log()
+    db = open_library(library_path)
+
+    results = []
+    epub_keys = [k for k in menu_keys if cfg.PLUGIN_MENUS[k]['cat'] == 'epub']
+    if epub_keys:
+        check = create_check('epub', db, log, search, threads)
+        if len(epub_keys) == 1:
+            check.menu_key = epub_keys[0]
+            check.perform_check(epub_keys[0])
+        else:
+            check.run_checks_together(epub_keys)
+        results.extend(check.results)
+    for menu_key in menu_keys:
+        if menu_key in epub_keys:
+            continue
+        check = create_check(cfg.PLUGIN_MENUS[menu_key]['cat'], db, log, search, threads)
+        check.menu_key = menu_key
+        check.perform_check(menu_key)
+        results.extend(check.results)
+
+    from calibre_plugins.quality_check.common_utils import get_title_authors_text
+    for result in results:
+        result['name'] = cfg.PLUGIN_MENUS[result['menu_key']]['name']
+        result['books'] = [{'book_id': book_id, 'title': get_title_authors_text(db, book_id)}
+                           for book_id in result['result_ids']]
+        del result['result_ids']
+        if not quiet:
+            print('%s: checked %d books, found %d matches' % (result['name'], result['total_count'], len(result['books'])))
+    return results
+
+
+def write_results(results, library_path, output_path):
+    if output_path and output_path.lower().endswith('.csv'):
+        rows = [['menu_key', 'marked_text', 'book_id', 'title']]
+        for result in results:
+            for book in result['books']:
+                rows.append([result['menu_key'], result['marked_text'], book['book_id'], book['title']])
+        if sys.version_info[0] < 3:
+            with open(output_path, 'wb') as f:
+                writer = csv.writer(f)
+                for row in rows:
+                    writer.writerow([('%s' % c).encode('utf-8') for c in row])
+        else:
+            with io.open(output_path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerows(rows)
+        return
+    data = json.dumps({'library': library_path, 'checks': results}, indent=2, ensure_ascii=False)
+    if output_path:
+        with io.open(output_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+def main():
+    retcode = 0
+    # Get all the following command line arguments
+    args = sys.argv[1:]
+    try:
+        # Parse all the input arguments
+        library_path, menu_keys, search, output_path, threads, quiet = parse_args(args)
+
+        if not library_path:
+            return 2
+
+        # Pump some debug output
+        if not quiet:
+            pump_debug_output(library_path, menu_keys, search, output_path, threads)
+
+        results = invoke_quality_check(library_path, menu_keys, search, threads, quiet)
+        write_results(results, library_path, output_path)
+        # Allow a scheduled job to tell whether anything was found
+        if [r for r in results if r['books']]:
+            retcode = 1
+    except:
+        print(traceback.format_exc())
+        return 2
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return retcode
+
+if __name__ == "__main__":
+    sys.exit(main())
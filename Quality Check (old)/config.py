@@ -21,12 +21,12 @@ try:
     from PyQt5 import Qt as QtGui
     from PyQt5.Qt import (QWidget, QVBoxLayout, QLabel,
                           QGroupBox, QGridLayout, QListWidget, QListWidgetItem,
-                          QAbstractItemView, Qt, QPushButton)
+                          QAbstractItemView, Qt, QPushButton, QCheckBox)
 except:
     from PyQt4 import QtGui
     from PyQt4.Qt import (QWidget, QVBoxLayout, QLabel,
                           QGroupBox, QGridLayout, QListWidget, QListWidgetItem,
-                          QAbstractItemView, Qt, QPushButton)
+                          QAbstractItemView, Qt, QPushButton, QCheckBox)
 
 from calibre.gui2.actions import menu_action_unique_name
 from calibre.gui2.complete2 import EditWithComplete
@@ -34,15 +34,29 @@ from calibre.utils.config import JSONConfig
 
 from calibre_plugins.quality_check.common_utils import (get_icon, KeyboardConfigDialog, convert_qvariant,
                                         get_library_uuid, PrefsViewerDialog, KeyValueComboBox)
+from calibre_plugins.quality_check.result_cache import (ResultCache, ResultCacheUnavailable,
+                                                        get_result_cache_path)
 
 KEY_SCHEMA_VERSION = STORE_SCHEMA_VERSION = 'SchemaVersion'
-DEFAULT_SCHEMA_VERSION = 1.9
+DEFAULT_SCHEMA_VERSION = 2.0
 
 STORE_OPTIONS = 'options'
 KEY_MAX_TAGS = 'maxTags'
 KEY_MAX_TAG_EXCLUSIONS = 'maxTagExclusions'
 KEY_HIDDEN_MENUS = 'hiddenMenus'
 KEY_SEARCH_SCOPE = 'searchScope'
+KEY_WORKER_THREADS = 'workerThreads'
+KEY_CACHE_RESULTS = 'cacheResults'
+KEY_PROFILE_MODE = 'profileMode'
+KEY_PARSED_CACHE_MB = 'parsedCacheMB'
+KEY_RENAME_BATCH_SIZE = 'renameBatchSize'
+
+PROFILE_MODE_OFF = 'off'
+PROFILE_MODE_TIMINGS = 'timings'
+PROFILE_MODE_CPROFILE = 'cprofile'
+PROFILE_MODES = OrderedDict([(PROFILE_MODE_OFF, _('Off')),
+                             (PROFILE_MODE_TIMINGS, _('Record timings')),
+                             (PROFILE_MODE_CPROFILE, _('Record timings and profile'))])
 
 SCOPE_LIBRARY = 'Library'
 SCOPE_SELECTION = 'Selection'
@@ -51,22 +65,37 @@ DEFAULT_STORE_VALUES = {
                            KEY_MAX_TAGS: 5,
                            KEY_MAX_TAG_EXCLUSIONS: [],
                            KEY_HIDDEN_MENUS: [],
+                           KEY_WORKER_THREADS: 1,
+                           KEY_CACHE_RESULTS: True,
+                           KEY_PROFILE_MODE: PROFILE_MODE_OFF,
+                           KEY_PARSED_CACHE_MB: 64,
+                           KEY_RENAME_BATCH_SIZE: 50,
                        }
 
-# Per library we store an exclusions map
+# Per library we store the sorted list of book ids excluded from each check
+# under its own key, so changing the exclusions of one check only saves that list.
+# 'exclusions_check_epub_jacket': [1,2,3]
+# Prior to schema 2.0 these were all kept in an exclusions map in the settings
 # 'settings': { 'exclusionsByCheck':  { 'check_epub_jacket':[1,2,3], ... } } }
-# Exclusions map is a dictionary keyed by quality check menu of lists of book ids excluded from check
-# e.g. { 'check_epub_jacket': [1,2,3] }
 PREFS_NAMESPACE = 'QualityCheckPlugin'
 PREFS_KEY_SETTINGS = 'settings'
+PREFS_KEY_EXCLUSIONS_PREFIX = 'exclusions_'
 KEY_EXCLUSIONS_BY_CHECK = 'exclusionsByCheck'
 KEY_AUTHOR_INITIALS_MODE = 'authorInitialsMode'
 AUTHOR_INITIALS_MODES = ['A.B.', 'A. B.', 'A B', 'AB']
 
 DEFAULT_LIBRARY_VALUES = {
-                          KEY_EXCLUSIONS_BY_CHECK: {  },
                          }
 
+# Each check profile is a set of ePub checks which can be re-run against only the
+# books changed since it last ran, keeping its results for the books unchanged.
+# 'checkProfiles': { 'Weekly': { 'menuKeys': ['check_epub_jacket', ...], 'lastRun': 1700000000.0,
+#                                'results': { 'check_epub_jacket': [1,2,3], ... } } }
+PREFS_KEY_CHECK_PROFILES = 'checkProfiles'
+# The ids of the books still to be renamed by "Check and rename book paths",
+# so that a rename which was interrupted can be resumed.
+PREFS_KEY_RENAME_PLAN = 'renamePlan'
+
 PLUGIN_MENUS = OrderedDict([
        ('check_covers',             {'name': _('Check covers...'),                'cat':'covers',   'sub_menu': '',                         'group': 0, 'excludable': True,  'image': 'images/check_cover.png',                'tooltip':_('Find books with book covers matching your criteria')}),
 
@@ -148,10 +177,19 @@ PLUGIN_MENUS = OrderedDict([
        ('check_missing_cover',      {'name': _('Check missing cover'),            'cat':'missing',  'sub_menu': _('Check missing'),  'group': 1, 'excludable': False,  'image': 'images/check_book.png',               'tooltip':_('Find books missing a cover')}),
        ('check_missing_formats',    {'name': _('Check missing formats'),          'cat':'missing',  'sub_menu': _('Check missing'),  'group': 1, 'excludable': False,  'image': 'images/check_book.png',               'tooltip':_('Find books missing formats')}),
 
+       ('check_epub_multiple',      {'name': _('Run multiple ePub checks...'),    'cat':'epub',     'sub_menu': '',               'group': 0, 'excludable': False, 'image': 'images/quality_check.png',             'tooltip':_('Run several ePub checks together, opening each ePub only once')}),
+       ('check_epub_profile',       {'name': _('Run check profile...'),           'cat':'epub',     'sub_menu': '',               'group': 0, 'excludable': False, 'image': 'images/quality_check.png',             'tooltip':_('Re-run a saved set of ePub checks, only reading the books changed since it was last run')}),
        ('search_epub',              {'name': _('Search ePubs...'),                'cat':'epub',     'sub_menu': '',               'group': 0, 'excludable': False, 'image': 'search.png',                           'tooltip':_('Find ePub books with text matching your own regular expression')}),
        ])
 
 
+# The ePub checks of the zip structure, for auditing the library in a single pass.
+# The first four only need the listing of each zip, which is read from its
+# central directory without opening the zip.
+STRUCTURE_CHECKS = ['check_epub_itunes', 'check_epub_bookmark', 'check_epub_os_artifacts',
+                    'check_epub_html_size', 'check_epub_no_container', 'check_epub_unman_files']
+
+
 PLUGIN_FIX_MENUS = OrderedDict([
        ('fix_swap_author_names',    {'name': _('Swap author FN LN <-> LN,FN'),   'cat':'fix',  'group': 0, 'image': 'images/check_comma.png',         'tooltip':_('For the selected book(s) swap author names between FN LN and LN, FN formats')}),
        ('fix_author_initials',      {'name': _('Reformat author initials'),      'cat':'fix',  'group': 0, 'image': 'user_profile.png',               'tooltip':_('For the selected book(s) reformat the author initials to your configured preference')}),
@@ -183,6 +221,12 @@ def migrate_library_config_if_required(db, library_config):
         for excl_key in list(exclusions_map.keys()):
             if excl_key.startswith('check_missing_'):
                 del exclusions_map[excl_key]
+    if schema_version < 2.0:
+        # Move the exclusions for each check out of the settings to their own key
+        exclusions_map = library_config.pop(KEY_EXCLUSIONS_BY_CHECK, {})
+        for menu_key, book_ids in exclusions_map.items():
+            if book_ids:
+                set_excluded_books(db, menu_key, book_ids)
 
     set_library_config(db, library_config)
 
@@ -213,24 +257,63 @@ def get_library_config(db):
 def set_library_config(db, library_config):
     db.prefs.set_namespaced(PREFS_NAMESPACE, PREFS_KEY_SETTINGS, library_config)
 
+# The excluded book ids of each check as a frozenset, keyed by (library_id, menu_key),
+# so that they are only read from the library once per session
+_excluded_books_cache = {}
+
+def get_excluded_book_set(db, menu_key):
+    '''
+    The ids excluded from this check, which may include books since deleted
+    from the library. For testing whether each book is excluded.
+    '''
+    cache_key = (get_library_uuid(db), menu_key)
+    book_ids = _excluded_books_cache.get(cache_key)
+    if book_ids is None:
+        # Make sure any exclusions in an older schema have been moved first
+        get_library_config(db)
+        book_ids = frozenset(db.prefs.get_namespaced(PREFS_NAMESPACE,
+                                        PREFS_KEY_EXCLUSIONS_PREFIX + menu_key, []))
+        _excluded_books_cache[cache_key] = book_ids
+    return book_ids
+
+def clear_excluded_books_cache():
+    _excluded_books_cache.clear()
+
 def get_excluded_books(db, menu_key):
-    library_config = get_library_config(db)
-    exclusions_map = library_config[KEY_EXCLUSIONS_BY_CHECK]
-    exclusions = exclusions_map.get(menu_key, [])
-    return exclusions
+    return sorted(get_excluded_book_set(db, menu_key))
 
 def get_valid_excluded_books(db, menu_key):
     book_ids = get_excluded_books(db, menu_key)
     valid_book_ids = [i for i in book_ids if db.data.has_id(i)]
     if len(book_ids) != len(valid_book_ids):
-        set_excluded_books(db, menu_key, book_ids)
+        set_excluded_books(db, menu_key, valid_book_ids)
     return valid_book_ids
 
 def set_excluded_books(db, menu_key, book_ids):
-    library_config = get_library_config(db)
-    exclusions_map = library_config[KEY_EXCLUSIONS_BY_CHECK]
-    exclusions_map[menu_key] = book_ids
-    set_library_config(db, library_config)
+    book_ids = frozenset(book_ids)
+    db.prefs.set_namespaced(PREFS_NAMESPACE, PREFS_KEY_EXCLUSIONS_PREFIX + menu_key, sorted(book_ids))
+    _excluded_books_cache[(get_library_uuid(db), menu_key)] = book_ids
+
+
+def clear_library_result_cache(db):
+    try:
+        result_cache = ResultCache(get_result_cache_path(db))
+    except ResultCacheUnavailable:
+        return
+    result_cache.clear()
+    result_cache.close()
+
+def get_library_check_profiles(db):
+    return db.prefs.get_namespaced(PREFS_NAMESPACE, PREFS_KEY_CHECK_PROFILES, {})
+
+def set_library_check_profiles(db, profiles):
+    db.prefs.set_namespaced(PREFS_NAMESPACE, PREFS_KEY_CHECK_PROFILES, profiles)
+
+def get_library_rename_plan(db):
+    return db.prefs.get_namespaced(PREFS_NAMESPACE, PREFS_KEY_RENAME_PLAN, [])
+
+def set_library_rename_plan(db, book_ids):
+    db.prefs.set_namespaced(PREFS_NAMESPACE, PREFS_KEY_RENAME_PLAN, book_ids)
 
 
 class VisibleMenuListWidget(QListWidget):
@@ -312,6 +395,56 @@ class ConfigWidget(QWidget):
         initials_mode = c.get(KEY_AUTHOR_INITIALS_MODE, AUTHOR_INITIALS_MODES[0])
         self.initials_combo = KeyValueComboBox(self, initials_map, initials_mode)
         other_layout.addWidget(self.initials_combo, 0, 1, 1, 1)
+
+        workers_label = QLabel(_('Worker threads:'), self)
+        workers_label.setToolTip(_('The number of books to check at the same time for ePub, MOBI and cover checks.\n'
+                                   'A value of 1 checks one book at a time.'))
+        other_layout.addWidget(workers_label, 1, 0, 1, 1)
+        self.worker_threads_spin = QtGui.QSpinBox(self)
+        self.worker_threads_spin.setMinimum(1)
+        self.worker_threads_spin.setMaximum(32)
+        self.worker_threads_spin.setProperty('value', c.get(KEY_WORKER_THREADS, 1))
+        other_layout.addWidget(self.worker_threads_spin, 1, 1, 1, 1)
+
+        self.cache_results_checkbox = QCheckBox(_('Reuse results for unchanged books'), self)
+        self.cache_results_checkbox.setToolTip(_('For ePub and MOBI checks, remember the result for each book in the library,\n'
+                                                 'and for the cover check the dimensions of each cover.\n'
+                                                 'Books whose files have not changed since last checked are not read again.'))
+        self.cache_results_checkbox.setChecked(c.get(KEY_CACHE_RESULTS, True))
+        other_layout.addWidget(self.cache_results_checkbox, 2, 0, 1, 1)
+        clear_cache_button = QPushButton(_('Clear cached results'), self)
+        clear_cache_button.setToolTip(_('Forget the remembered results so every book is read on the next check'))
+        clear_cache_button.clicked.connect(self.clear_result_cache)
+        other_layout.addWidget(clear_cache_button, 2, 1, 1, 1)
+
+        profile_label = QLabel(_('Performance timings:'), self)
+        profile_label.setToolTip(_('Record where the time goes when running a check, such as reading and parsing\n'
+                                   'the files and the slowest books, viewable from the results summary.\n'
+                                   'Profiling with cProfile checks one book at a time and is much slower.'))
+        other_layout.addWidget(profile_label, 3, 0, 1, 1)
+        self.profile_mode_combo = KeyValueComboBox(self, PROFILE_MODES, c.get(KEY_PROFILE_MODE, PROFILE_MODE_OFF))
+        other_layout.addWidget(self.profile_mode_combo, 3, 1, 1, 1)
+
+        parsed_cache_label = QLabel(_('Parsed ePub cache (MB):'), self)
+        parsed_cache_label.setToolTip(_('The memory to use for keeping the zip listing and OPF of recently checked ePubs,\n'
+                                        'so running another check this session does not parse them again.\n'
+                                        'A value of 0 turns this off.'))
+        other_layout.addWidget(parsed_cache_label, 4, 0, 1, 1)
+        self.parsed_cache_spin = QtGui.QSpinBox(self)
+        self.parsed_cache_spin.setMinimum(0)
+        self.parsed_cache_spin.setMaximum(4096)
+        self.parsed_cache_spin.setProperty('value', c.get(KEY_PARSED_CACHE_MB, 64))
+        other_layout.addWidget(self.parsed_cache_spin, 4, 1, 1, 1)
+
+        rename_batch_label = QLabel(_('Book paths renamed at once:'), self)
+        rename_batch_label.setToolTip(_('For the "Check and rename book paths" fix, the number of book folders\n'
+                                        'to rename in each update of the library.'))
+        other_layout.addWidget(rename_batch_label, 5, 0, 1, 1)
+        self.rename_batch_spin = QtGui.QSpinBox(self)
+        self.rename_batch_spin.setMinimum(1)
+        self.rename_batch_spin.setMaximum(10000)
+        self.rename_batch_spin.setProperty('value', c.get(KEY_RENAME_BATCH_SIZE, 50))
+        other_layout.addWidget(self.rename_batch_spin, 5, 1, 1, 1)
         other_layout.setColumnStretch(2, 1)
 
         menus_groupbox = QGroupBox(_('Visible Menus'))
@@ -342,6 +475,11 @@ class ConfigWidget(QWidget):
             exclude_tag_text = exclude_tag_text[:-1]
         new_prefs[KEY_MAX_TAG_EXCLUSIONS] = [t.strip() for t in exclude_tag_text.split(',')]
         new_prefs[KEY_AUTHOR_INITIALS_MODE] = self.initials_combo.selected_key()
+        new_prefs[KEY_WORKER_THREADS] = int(six.text_type(self.worker_threads_spin.value()))
+        new_prefs[KEY_CACHE_RESULTS] = self.cache_results_checkbox.isChecked()
+        new_prefs[KEY_PROFILE_MODE] = self.profile_mode_combo.selected_key()
+        new_prefs[KEY_PARSED_CACHE_MB] = int(six.text_type(self.parsed_cache_spin.value()))
+        new_prefs[KEY_RENAME_BATCH_SIZE] = int(six.text_type(self.rename_batch_spin.value()))
         new_prefs[KEY_SEARCH_SCOPE] = plugin_prefs[STORE_OPTIONS].get(KEY_SEARCH_SCOPE, SCOPE_LIBRARY)
 
         new_prefs[KEY_HIDDEN_MENUS] = self.visible_menus_list.get_hidden_menus()
@@ -365,6 +503,16 @@ class ConfigWidget(QWidget):
         if d.exec_() == d.Accepted:
             self.plugin_action.gui.keyboard.finalize()
 
+    def clear_result_cache(self):
+        clear_library_result_cache(self.plugin_action.gui.current_db)
+        # Without the cached results the next run of each check profile must read every book
+        profiles = get_library_check_profiles(self.plugin_action.gui.current_db)
+        for profile in profiles.values():
+            profile['lastRun'] = None
+        set_library_check_profiles(self.plugin_action.gui.current_db, profiles)
+
     def view_prefs(self):
         d = PrefsViewerDialog(self.plugin_action.gui, PREFS_NAMESPACE)
         d.exec_()
+        # The exclusions may have been edited or cleared
+        clear_excluded_books_cache()
@@ -9,6 +9,12 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
+import json, time
+try:
+    from cgi import escape as esc
+except:
+    from html import escape as esc
+
 try:
     load_translations()
 except NameError:
@@ -19,28 +25,35 @@ try:
                           QGroupBox, QGridLayout, QComboBox, QProgressDialog,
                           QTimer, QIcon, QTableWidget, QHBoxLayout,
                           QAbstractItemView, Qt, QCheckBox, QDialog,
-                          QApplication, QTextBrowser, QSize)
+                          QApplication, QTextBrowser, QSize,
+                          QListWidget, QListWidgetItem, QPushButton)
     from PyQt5 import Qt as QtGui
 except:
     from PyQt4.Qt import (QVBoxLayout, QLabel, QRadioButton, QDialogButtonBox,
                           QGroupBox, QGridLayout, QComboBox, QProgressDialog,
                           QTimer, QIcon, QTableWidget, QHBoxLayout,
                           QAbstractItemView, Qt, QCheckBox, QDialog,
-                          QApplication, QTextBrowser, QSize)
+                          QApplication, QTextBrowser, QSize,
+                          QListWidget, QListWidgetItem, QPushButton)
     from PyQt4 import QtGui
 
 from calibre.ebooks.metadata import authors_to_string, fmt_sidx
-from calibre.gui2 import gprefs, error_dialog
+from calibre.gui2 import gprefs, error_dialog, choose_save_file
 from calibre.gui2.dialogs.message_box import MessageBox
 
 import calibre_plugins.quality_check.config as cfg
+from calibre_plugins.quality_check.instrumentation import ALL_PHASES, COUNTER_BYTES_READ, clock
 from calibre_plugins.quality_check.common_utils import (SizePersistedDialog, ImageTitleLayout, convert_qvariant,
                                                         ReadOnlyTableWidgetItem, get_icon)
 
 
 class QualityProgressDialog(QProgressDialog):
 
-    def __init__(self, gui, book_ids, callback_fn, db, status_msg_type='books', action_type=_('Checking')):
+    # The least number of seconds between showing the matches found so far
+    LIVE_RESULTS_INTERVAL = 1.0
+
+    def __init__(self, gui, book_ids, callback_fn, db, status_msg_type='books', action_type=_('Checking'),
+                 worker_pool=None, max_matches=None, matches_fn=None):
         self.total_count = len(book_ids)
         QProgressDialog.__init__(self, '', _('Cancel'), 0, self.total_count, gui)
         self.setMinimumWidth(500)
@@ -49,13 +62,27 @@ class QualityProgressDialog(QProgressDialog):
         self.gui = gui
         self.setWindowTitle('%s %d %s...' % (self.action_type, self.total_count, self.status_msg_type))
         self.i, self.result_ids = 0, []
-        QTimer.singleShot(0, self.do_book_action)
+        # Stop once this many books have matched, if set
+        self.max_matches = max_matches
+        self.limit_reached = False
+        # Called with the matches so far while still checking, to show them as they are found
+        self.matches_fn = matches_fn
+        self.shown_match_count = 0
+        self.last_shown = clock()
+        self.worker_pool = worker_pool
+        if worker_pool is not None:
+            worker_pool.start()
+            QTimer.singleShot(0, self.do_pool_action)
+        else:
+            QTimer.singleShot(0, self.do_book_action)
         self.exec_()
+        if self.worker_pool is not None:
+            self.finish_pool()
 
     def do_book_action(self):
         if self.wasCanceled():
             return self.do_close()
-        if self.i >= self.total_count:
+        if self.i >= self.total_count or self.limit_reached:
             return self.do_close()
         book_id = self.book_ids[self.i]
         self.i += 1
@@ -64,11 +91,64 @@ class QualityProgressDialog(QProgressDialog):
         self.setWindowTitle(_('%s %d %s  (%d matches)...') % (self.action_type, self.total_count, self.status_msg_type, len(self.result_ids)))
         self.setLabelText('%s: %s'%(self.action_type, dtitle))
         if self.callback_fn(book_id, self.db):
-            self.result_ids.append(book_id)
+            self.add_match(book_id)
         self.setValue(self.i)
+        self.show_matches()
 
         QTimer.singleShot(0, self.do_book_action)
 
+    def do_pool_action(self):
+        if self.worker_pool is None:
+            return
+        if self.wasCanceled():
+            self.worker_pool.cancel()
+        last_book_id = self.drain_pool()
+        if last_book_id is not None:
+            dtitle = self.db.title(last_book_id, index_is_id=True)
+            self.setWindowTitle(_('%s %d %s  (%d matches)...') % (self.action_type, self.total_count, self.status_msg_type, len(self.result_ids)))
+            self.setLabelText('%s: %s'%(self.action_type, dtitle))
+            self.setValue(self.i)
+            self.show_matches()
+        if self.worker_pool.is_finished:
+            return self.do_close()
+        QTimer.singleShot(50, self.do_pool_action)
+
+    def add_match(self, book_id):
+        self.result_ids.append(book_id)
+        if self.max_matches and len(self.result_ids) >= self.max_matches:
+            self.limit_reached = True
+            if self.worker_pool is not None:
+                # Books already being evaluated will still report back
+                self.worker_pool.cancel()
+
+    def show_matches(self):
+        if self.matches_fn is None or len(self.result_ids) == self.shown_match_count:
+            return
+        now = clock()
+        if now - self.last_shown < self.LIVE_RESULTS_INTERVAL:
+            return
+        self.last_shown = now
+        self.shown_match_count = len(self.result_ids)
+        self.matches_fn(list(self.result_ids))
+
+    def drain_pool(self):
+        last_book_id = None
+        for book_id, matched in self.worker_pool.drain():
+            self.i += 1
+            if matched:
+                self.add_match(book_id)
+            last_book_id = book_id
+        return last_book_id
+
+    def finish_pool(self):
+        # The dialog can be closed by the user cancelling while books are
+        # still being evaluated, so wait for those to report back.
+        if self.wasCanceled():
+            self.worker_pool.cancel()
+        self.worker_pool.join()
+        self.drain_pool()
+        self.worker_pool = None
+
     def do_close(self):
         self.hide()
         self.gui = None
@@ -202,7 +282,10 @@ class CoverOptionsDialog(SizePersistedDialog):
 
 class ViewLog(QDialog):
 
-    def __init__(self, title, html, parent=None):
+    def __init__(self, title, html, parent=None, pre_text=None):
+        '''
+        :param pre_text: Any plain text to show after the html as it is, in a <pre> block
+        '''
         QDialog.__init__(self, parent)
         self.l = l = QVBoxLayout()
         self.setLayout(l)
@@ -213,7 +296,10 @@ class ViewLog(QDialog):
         # ViewLog does, instead just format it inside divs to keep style formatting
         html = html.replace('\t','&nbsp;&nbsp;&nbsp;&nbsp;').replace('\n', '<br/>')
         html = html.replace('> ','>&nbsp;')
-        self.tb.setHtml('<div>%s</div>' % html)
+        html = '<div>%s</div>' % html
+        if pre_text:
+            html += '<pre>%s</pre>' % esc(pre_text)
+        self.tb.setHtml(html)
         QApplication.restoreOverrideCursor()
         l.addWidget(self.tb)
 
@@ -238,7 +324,7 @@ class ViewLog(QDialog):
 
 class ResultsSummaryDialog(MessageBox): # {{{
 
-    def __init__(self, parent, title, msg, log=None, det_msg=''):
+    def __init__(self, parent, title, msg, log=None, det_msg='', timings=None):
         '''
         A modal popup that summarises the result of Quality Check with
         opportunity to review the log.
@@ -247,6 +333,7 @@ class ResultsSummaryDialog(MessageBox): # {{{
         :param title: The title for this popup
         :param msg: The msg to display
         :param det_msg: Detailed message
+        :param timings: Performance timings recorded for the check, if any
         '''
         MessageBox.__init__(self, MessageBox.INFO, title, msg,
                 det_msg=det_msg, show_copy_button=False,
@@ -257,11 +344,60 @@ class ResultsSummaryDialog(MessageBox): # {{{
         self.vlb.clicked.connect(self.show_log)
         self.det_msg_toggle.setVisible(bool(det_msg))
         self.vlb.setVisible(bool(log.plain_text))
+        self.timings = timings
+        if timings:
+            self.vtb = self.bb.addButton(_('View timings'), self.bb.ActionRole)
+            self.vtb.clicked.connect(self.show_timings)
 
     def show_log(self):
         self.log_viewer = ViewLog('Quality Check log', self.log.html,
                 parent=self)
 
+    def show_timings(self):
+        self.timings_viewer = ViewTimings(self.timings, parent=self)
+
+
+class ViewTimings(ViewLog):
+
+    def __init__(self, timings, parent=None):
+        self.timings = timings
+        ViewLog.__init__(self, _('Quality Check timings'), self.timings_html(timings), parent=parent,
+                         pre_text=timings.get('profile'))
+        self.export_button = self.bb.addButton(_('Export...'), self.bb.ActionRole)
+        self.export_button.clicked.connect(self.export_timings)
+
+    def timings_html(self, timings):
+        seconds = timings['seconds']
+        lines = []
+        lines.append(_('Checked <b>%d</b> books in <b>%.2f</b> seconds (%.1f books per second)') %
+                     (timings['books'], seconds, timings['books'] / seconds if seconds else 0))
+        bytes_read = timings['counters'].get(COUNTER_BYTES_READ)
+        if bytes_read:
+            lines.append(_('Read %.1f MB from the book files') % (bytes_read / (1024 * 1024)))
+        lines.append('')
+        lines.append(_('<b>Time spent in each phase</b> (summed across worker threads):'))
+        for phase in ALL_PHASES:
+            if phase in timings['times']:
+                lines.append('\t%s: %.3f seconds in %d calls' % (phase, timings['times'][phase],
+                                                                  timings['calls'][phase]))
+        lines.append('')
+        lines.append(_('<b>Slowest books:</b>'))
+        for book in timings['slowest_books']:
+            lines.append('\t%.3f seconds: %s' % (book['seconds'], esc(book['title'])))
+        if timings.get('profile'):
+            lines.append('')
+            lines.append(_('<b>Profile</b> (by cumulative time):'))
+        return '\n'.join(lines)
+
+    def export_timings(self):
+        path = choose_save_file(self, 'quality check plugin:export timings', _('Export timings'),
+                                filters=[(_('JSON files'), ['json'])], all_files=False,
+                                initial_filename='%s_timings.json' % self.timings['menu_key'])
+        if not path:
+            return
+        with open(path, 'wb') as f:
+            f.write(json.dumps(self.timings, indent=2).encode('utf-8'))
+
 
 class ExcludableMenusComboBox(QComboBox):
 
@@ -526,6 +662,9 @@ class SearchEpubDialog(SizePersistedDialog):
         self.scope_opf_checkbox.setChecked(search_opts.get('scope_opf', False))
         self.scope_ncx_checkbox.setChecked(search_opts.get('scope_ncx', False))
         self.scope_zip_checkbox.setChecked(search_opts.get('scope_zip', False))
+        self.use_index_checkbox.setChecked(search_opts.get('use_index', False))
+        self.live_results_checkbox.setChecked(search_opts.get('live_results', False))
+        self.max_matches_spin.setProperty('value', search_opts.get('max_matches', 0))
 
         # Cause our dialog size to be restored from prefs or created on first usage
         self.resize_dialog()
@@ -553,6 +692,19 @@ class SearchEpubDialog(SizePersistedDialog):
         self.show_all_matches_checkbox.setToolTip(_('If unchecked, the search of each ePub is stopped as soon as the first match is found.\n'
                                                   'If checked, all occurrences will be displayed in the log but it will run much slower.'))
         find_layout.addWidget(self.show_all_matches_checkbox, 2, 0, 1, 2)
+        self.live_results_checkbox = QCheckBox(_('Show &matching books as they are found'), self)
+        self.live_results_checkbox.setToolTip(_('Mark the matching books in the library view while the search is still running,\n'
+                                                'so you can cancel the search once you have found what you need.'))
+        find_layout.addWidget(self.live_results_checkbox, 3, 0, 1, 2)
+        max_matches_label = QLabel(_('S&top after this many matching books:'), self)
+        max_matches_label.setToolTip(_('End the search as soon as this many books have matched.\n'
+                                       'A value of 0 searches all the books.'))
+        find_layout.addWidget(max_matches_label, 4, 0, 1, 1)
+        self.max_matches_spin = QtGui.QSpinBox(self)
+        self.max_matches_spin.setMinimum(0)
+        self.max_matches_spin.setMaximum(100000)
+        max_matches_label.setBuddy(self.max_matches_spin)
+        find_layout.addWidget(self.max_matches_spin, 4, 1, 1, 1)
 
         layout.addSpacing(5)
         scope_group = QGroupBox(_('Scope'), self)
@@ -581,6 +733,13 @@ class SearchEpubDialog(SizePersistedDialog):
         scope_layout.addWidget(self.scope_ncx_checkbox, 5, 1, 1, 1)
         scope_layout.addWidget(self.scope_zip_checkbox, 5, 0, 1, 1)
 
+        self.use_index_checkbox = QCheckBox(_('Use a search &index'), self)
+        self.use_index_checkbox.setToolTip(_('Keep an index of the content of every ePub searched, so that later searches\n'
+                                             'only need to read the books which could contain a match.\n'
+                                             'Each book is indexed the first time it is searched or after it is changed,\n'
+                                             'so the first search is slower and the index takes up disk space.'))
+        layout.addWidget(self.use_index_checkbox)
+
         # Dialog buttons
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         button_box.accepted.connect(self.ok_clicked)
@@ -613,6 +772,9 @@ class SearchEpubDialog(SizePersistedDialog):
         if not any_scope_checked:
             return error_dialog(self, _('No search scope'),
                 _('You must specify a scope for the ePub search.'), show=True)
+        search_opts['use_index'] = self.use_index_checkbox.isChecked()
+        search_opts['live_results'] = self.live_results_checkbox.isChecked()
+        search_opts['max_matches'] = int(six.text_type(self.max_matches_spin.value()))
         gprefs[self.unique_pref_name+':search_opts'] = search_opts
         self.search_opts = search_opts
         self.accept()
@@ -622,6 +784,181 @@ class SearchEpubDialog(SizePersistedDialog):
         return self.search_opts
 
 
+class MultipleEpubChecksDialog(SizePersistedDialog):
+
+    def __init__(self, parent):
+        SizePersistedDialog.__init__(self, parent, _('quality check plugin:multiple epub checks dialog'))
+        self.initialize_controls()
+
+        # Set some default values from last time dialog was used.
+        last_checks = gprefs.get(self.unique_pref_name+':selected_checks', [])
+        self.populate(last_checks)
+
+        # Cause our dialog size to be restored from prefs or created on first usage
+        self.resize_dialog()
+
+    def initialize_controls(self):
+        self.setWindowTitle('Quality Check')
+        layout = QVBoxLayout(self)
+        self.setLayout(layout)
+        title_layout = ImageTitleLayout(self, 'images/quality_check.png', _('Run multiple ePub checks'))
+        layout.addLayout(title_layout)
+
+        layout.addWidget(QLabel(_('Each ePub is opened once and all checks ticked below run against it:'), self))
+        self.checks_list = QListWidget(self)
+        self.checks_list.setSelectionMode(QAbstractItemView.SingleSelection)
+        layout.addWidget(self.checks_list)
+
+        # Dialog buttons
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        button_box.accepted.connect(self.ok_clicked)
+        button_box.rejected.connect(self.reject)
+        structure_button = button_box.addButton(_('&Structure checks'), QDialogButtonBox.ResetRole)
+        structure_button.setToolTip(_('Tick only the checks of the zip structure of each ePub, for a quick audit of the library'))
+        structure_button.clicked.connect(self._select_structure_checks)
+        layout.addWidget(button_box)
+
+    def _select_structure_checks(self):
+        self.populate(cfg.STRUCTURE_CHECKS)
+
+    def populate(self, last_checks):
+        self.checks_list.clear()
+        for menu_key, value in cfg.PLUGIN_MENUS.items():
+            if value['cat'] != 'epub' or menu_key in ['search_epub', 'check_epub_multiple', 'check_epub_profile']:
+                continue
+            name = value['name']
+            sub_menu = value['sub_menu']
+            if sub_menu:
+                name = sub_menu + ' -> ' + name
+            item = QListWidgetItem(name, self.checks_list)
+            item.setIcon(get_icon(value['image']))
+            item.setData(Qt.UserRole, menu_key)
+            if menu_key in last_checks:
+                item.setCheckState(Qt.Checked)
+            else:
+                item.setCheckState(Qt.Unchecked)
+            self.checks_list.addItem(item)
+
+    def ok_clicked(self):
+        selected_menu_keys = []
+        for x in range(self.checks_list.count()):
+            item = self.checks_list.item(x)
+            if item.checkState() == Qt.Checked:
+                selected_menu_keys.append(six.text_type(convert_qvariant(item.data(Qt.UserRole))).strip())
+        if not selected_menu_keys:
+            return error_dialog(self, _('No checks selected'),
+                _('You must select at least one check to run.'), show=True)
+        gprefs[self.unique_pref_name+':selected_checks'] = selected_menu_keys
+        self.selected_menu_keys = selected_menu_keys
+        self.accept()
+
+
+class CheckProfileDialog(MultipleEpubChecksDialog):
+    '''
+    Choose or create a saved set of ePub checks to run. Unless told to check
+    all the books again, a profile which has been run before only reads the
+    books changed since then.
+    '''
+    def __init__(self, parent, db):
+        self.db = db
+        self.profiles = cfg.get_library_check_profiles(db)
+        SizePersistedDialog.__init__(self, parent, _('quality check plugin:check profile dialog'))
+        self.initialize_controls()
+
+        # Set some default values from last time dialog was used.
+        self.populate([])
+        self.profile_combo.addItems(sorted(self.profiles.keys()))
+        last_profile = gprefs.get(self.unique_pref_name+':last_profile', '')
+        self.profile_combo.setEditText(last_profile)
+        self._on_profile_changed(last_profile)
+
+        # Cause our dialog size to be restored from prefs or created on first usage
+        self.resize_dialog()
+
+    def initialize_controls(self):
+        self.setWindowTitle('Quality Check')
+        layout = QVBoxLayout(self)
+        self.setLayout(layout)
+        title_layout = ImageTitleLayout(self, 'images/quality_check.png', _('Run check profile'))
+        layout.addLayout(title_layout)
+
+        profile_layout = QHBoxLayout()
+        layout.addLayout(profile_layout)
+        profile_label = QLabel(_('&Profile:'), self)
+        profile_layout.addWidget(profile_label)
+        self.profile_combo = QComboBox(self)
+        self.profile_combo.setEditable(True)
+        self.profile_combo.setCompleter(None)
+        self.profile_combo.setToolTip(_('Choose a saved profile, or type a name to save a new one'))
+        self.profile_combo.editTextChanged.connect(self._on_profile_changed)
+        profile_label.setBuddy(self.profile_combo)
+        profile_layout.addWidget(self.profile_combo, 1)
+        self.delete_button = QPushButton(_('&Delete'), self)
+        self.delete_button.setToolTip(_('Delete this profile and its saved results'))
+        self.delete_button.clicked.connect(self._delete_profile)
+        profile_layout.addWidget(self.delete_button)
+        self.last_run_label = QLabel('', self)
+        layout.addWidget(self.last_run_label)
+
+        layout.addWidget(QLabel(_('Each ePub is opened once and all checks ticked below run against it:'), self))
+        self.checks_list = QListWidget(self)
+        self.checks_list.setSelectionMode(QAbstractItemView.SingleSelection)
+        layout.addWidget(self.checks_list)
+
+        self.check_all_checkbox = QCheckBox(_('Check &all books again'), self)
+        self.check_all_checkbox.setToolTip(_('Read every book rather than only those changed since this profile was last run,\n'
+                                             'such as after changing the options of a check or removing exclusions.'))
+        layout.addWidget(self.check_all_checkbox)
+
+        # Dialog buttons
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        button_box.accepted.connect(self.ok_clicked)
+        button_box.rejected.connect(self.reject)
+        layout.addWidget(button_box)
+
+    def _on_profile_changed(self, name):
+        profile = self.profiles.get(six.text_type(name).strip())
+        self.delete_button.setEnabled(profile is not None)
+        if profile is None:
+            self.last_run_label.setText(_('New profile, every book will be checked'))
+            return
+        self.populate(profile.get('menuKeys', []))
+        last_run = profile.get('lastRun')
+        if last_run:
+            self.last_run_label.setText(_('Last run: %s') %
+                                        time.strftime('%Y-%m-%d %H:%M', time.localtime(last_run)))
+        else:
+            self.last_run_label.setText(_('Not run yet, every book will be checked'))
+
+    def _delete_profile(self):
+        name = six.text_type(self.profile_combo.currentText()).strip()
+        if name not in self.profiles:
+            return
+        del self.profiles[name]
+        cfg.set_library_check_profiles(self.db, self.profiles)
+        self.profile_combo.removeItem(self.profile_combo.findText(name))
+        self.profile_combo.setEditText('')
+
+    def ok_clicked(self):
+        profile_name = six.text_type(self.profile_combo.currentText()).strip()
+        if not profile_name:
+            return error_dialog(self, _('No profile name'),
+                _('You must enter a name to save the profile as.'), show=True)
+        selected_menu_keys = []
+        for x in range(self.checks_list.count()):
+            item = self.checks_list.item(x)
+            if item.checkState() == Qt.Checked:
+                selected_menu_keys.append(six.text_type(convert_qvariant(item.data(Qt.UserRole))).strip())
+        if not selected_menu_keys:
+            return error_dialog(self, _('No checks selected'),
+                _('You must select at least one check to run.'), show=True)
+        gprefs[self.unique_pref_name+':last_profile'] = profile_name
+        self.profile_name = profile_name
+        self.selected_menu_keys = selected_menu_keys
+        self.check_all_books = self.check_all_checkbox.isChecked()
+        self.accept()
+
+
 class ApplyFixProgressDialog(QProgressDialog):
 
     def __init__(self, gui, title, book_ids, tdir, apply_fix_callback):
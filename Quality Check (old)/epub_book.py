@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import codecs, copy, os, struct, threading
+from collections import OrderedDict
+
+from polyglot.builtins import is_py3
+
+from calibre.utils.zipfile import ZipFile
+
+from calibre_plugins.quality_check.instrumentation import (instrumentation, PHASE_ZIP_OPEN,
+                                        PHASE_ZIP_READ, PHASE_HTML_DECODE, PHASE_REGEX, COUNTER_BYTES_READ)
+
+# Rough number of bytes of memory used by each thing kept for a book, used to
+# keep the parsed ePub cache under its ceiling without measuring lxml objects
+NAME_COST = 120
+INFO_COST = 400
+ENTRY_COST = 1024
+# An lxml tree takes several times the size of its source
+TREE_COST_FACTOR = 10
+# The most memory kept for the parsed documents of the book being checked
+# when the parsed ePub cache is turned off
+DOCUMENT_BUDGET = 32 * 1024 * 1024
+
+# The records of the zip format read to list the files of an ePub without
+# opening it as a ZipFile: the end of central directory and the central directory
+EOCD_SIGNATURE = b'PK\x05\x06'
+EOCD_STRUCT = struct.Struct(str('<4s4H2LH'))
+ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+ZIP64_LOCATOR_SIZE = 20
+CENTRAL_DIR_SIGNATURE = b'PK\x01\x02'
+CENTRAL_DIR_STRUCT = struct.Struct(str('<4s6H3L5H2L'))
+MAX_COMMENT_SIZE = 65535
+FLAG_UTF8_NAME = 0x800
+
+# Resources larger than this are read a chunk at a time when being searched,
+# rather than holding all of the resource and a lower case copy in memory
+STREAM_THRESHOLD = 4 * 1024 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+# The text carried over from the end of each chunk to the start of the next,
+# so that a match spanning two chunks is still found if no longer than this
+STREAM_OVERLAP = 64 * 1024
+
+
+class CentralDirectoryEntry(object):
+    '''
+    The name and sizes of a file in a zip as listed in its central directory,
+    standing in for the ZipInfo of the file
+    '''
+    __slots__ = ('filename', 'file_size', 'compress_size')
+
+    def __init__(self, filename, file_size, compress_size):
+        self.filename = filename
+        self.file_size = file_size
+        self.compress_size = compress_size
+
+
+def read_central_directory(path):
+    '''
+    The files in the zip at path as listed in its central directory, reading
+    only the end of the file and the central directory itself. Returns None
+    for any zip this does not handle, such as zip64 or names which are
+    neither ascii nor marked as utf-8, leaving those to ZipFile.
+    '''
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        tail_size = min(size, EOCD_STRUCT.size + MAX_COMMENT_SIZE)
+        f.seek(size - tail_size)
+        tail = f.read(tail_size)
+        idx = tail.rfind(EOCD_SIGNATURE)
+        if idx == -1 or len(tail) - idx < EOCD_STRUCT.size:
+            return None
+        (_signature, disk, cd_disk, disk_entries, total_entries,
+         cd_size, cd_offset, _comment_size) = EOCD_STRUCT.unpack(tail[idx:idx + EOCD_STRUCT.size])
+        if disk or cd_disk or disk_entries != total_entries:
+            return None
+        if total_entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+            return None
+        if idx >= ZIP64_LOCATOR_SIZE and \
+                tail[idx - ZIP64_LOCATOR_SIZE:idx - ZIP64_LOCATOR_SIZE + 4] == ZIP64_LOCATOR_SIGNATURE:
+            return None
+        # Anything prepended to the zip moves the central directory along by as much
+        prepended = size - tail_size + idx - cd_size - cd_offset
+        if prepended < 0:
+            return None
+        f.seek(cd_offset + prepended)
+        data = f.read(cd_size)
+    if len(data) != cd_size:
+        return None
+
+    entries = []
+    pos = 0
+    for _i in range(total_entries):
+        header = data[pos:pos + CENTRAL_DIR_STRUCT.size]
+        if len(header) != CENTRAL_DIR_STRUCT.size:
+            return None
+        fields = CENTRAL_DIR_STRUCT.unpack(header)
+        if fields[0] != CENTRAL_DIR_SIGNATURE:
+            return None
+        flags, compress_size, file_size = fields[3], fields[8], fields[9]
+        name_size, extra_size, comment_size = fields[10], fields[11], fields[12]
+        if compress_size == 0xFFFFFFFF or file_size == 0xFFFFFFFF:
+            return None
+        pos += CENTRAL_DIR_STRUCT.size
+        raw_name = data[pos:pos + name_size]
+        pos += name_size + extra_size + comment_size
+        try:
+            filename = raw_name.decode('utf-8' if flags & FLAG_UTF8_NAME else 'ascii')
+        except UnicodeDecodeError:
+            # The encoding of the name has to be guessed, as ZipFile will do
+            return None
+        # As ZipInfo does with the name
+        null_byte = filename.find('\x00')
+        if null_byte >= 0:
+            filename = filename[:null_byte]
+        if os.sep != '/' and os.sep in filename:
+            filename = filename.replace(os.sep, '/')
+        entries.append(CentralDirectoryEntry(filename, file_size, compress_size))
+    return entries
+
+
+class ParsedEpub(object):
+    '''
+    The structures worked out from an ePub which are worth keeping between
+    checks: the name listing of its zip and anything parsed such as the OPF.
+    '''
+    def __init__(self, key):
+        self.key = key
+        self.names = None
+        self.name_set = None
+        self.infos = None
+        self.parsed = {}
+        self.cost = 0
+
+
+class ParsedEpubCache(object):
+    '''
+    Keeps the parsed structures of the most recently checked ePubs for the
+    rest of the calibre session, so running one check after another does not
+    read and parse each book again. Entries are keyed by path and invalidated
+    when the file's modification time or size changes. The least recently
+    used books are dropped once the estimated memory used exceeds max_bytes,
+    and a ceiling of 0 turns the cache off.
+    '''
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.total_cost = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_entry(self, path):
+        try:
+            st = os.stat(path)
+            key = (st.st_mtime, st.st_size)
+        except EnvironmentError:
+            return ParsedEpub(None)
+        if not self.max_bytes:
+            return ParsedEpub(key)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None and entry.key != key:
+                self.total_cost -= entry.cost
+                entry = None
+            if entry is None:
+                entry = ParsedEpub(key)
+            self._entries[path] = entry
+            return entry
+
+    def update_cost(self, path, entry, cost):
+        if not self.max_bytes or not cost:
+            return
+        with self._lock:
+            entry.cost += cost
+            if self._entries.get(path) is entry:
+                self.total_cost += cost
+                self._evict()
+
+    def _evict(self):
+        while self.total_cost > self.max_bytes and self._entries:
+            _path, entry = self._entries.popitem(last=False)
+            self.total_cost -= entry.cost
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            if not max_bytes:
+                self._entries.clear()
+                self.total_cost = 0
+            else:
+                self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_cost = 0
+
+
+parsed_epub_cache = ParsedEpubCache()
+
+
+class EpubBook(object):
+    '''
+    Wraps the zip file of an ePub so that the checks can share the work of
+    reading it. The name listing and anything parsed from the book (such as
+    the OPF) are worked out at most once, and kept in the parsed ePub cache
+    for later checks while the book is unchanged. The zip itself is only
+    opened if a resource has to be read.
+
+    A shared book is one being evaluated by several checks in the same pass.
+    Resources read from it are also kept, and closing it is left to whoever
+    opened it rather than to each check's "with" block.
+    '''
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self._zf = None
+        self._entry = parsed_epub_cache.get_entry(path)
+        self._added_cost = 0
+        self._raw = {}
+        self._text = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if not self.shared:
+            self.close()
+
+    @property
+    def zf(self):
+        if self._zf is None:
+            with instrumentation.phase(PHASE_ZIP_OPEN):
+                self._zf = ZipFile(self.path, 'r')
+        return self._zf
+
+    def close(self):
+        if self._zf is not None:
+            self._zf.close()
+            self._zf = None
+        self._raw.clear()
+        self._text.clear()
+        if self._added_cost:
+            parsed_epub_cache.update_cost(self.path, self._entry, self._added_cost)
+            self._added_cost = 0
+
+    def add_cost(self, cost):
+        '''
+        Adds to the estimated memory used by what is kept for this book
+        '''
+        self._added_cost += cost
+
+    def namelist(self):
+        entry = self._entry
+        if entry.names is None:
+            self._read_listing()
+        return entry.names
+
+    def has_name(self, name):
+        entry = self._entry
+        if entry.name_set is None:
+            entry.name_set = frozenset(self.namelist())
+        return name in entry.name_set
+
+    def infolist(self):
+        entry = self._entry
+        if entry.infos is None:
+            self._read_listing()
+        return entry.infos
+
+    def _read_listing(self):
+        '''
+        Lists the files in the book from its central directory where possible,
+        so checks needing only the names and sizes never open the zip
+        '''
+        infos = None
+        if self._zf is None:
+            with instrumentation.phase(PHASE_ZIP_OPEN):
+                try:
+                    infos = read_central_directory(self.path)
+                except (EnvironmentError, struct.error):
+                    # Let ZipFile report the problem
+                    infos = None
+        if infos is None:
+            infos = self.zf.infolist()
+        entry = self._entry
+        entry.infos = infos
+        entry.names = [info.filename for info in infos]
+        self.add_cost((NAME_COST + INFO_COST) * len(infos))
+
+    def read(self, name):
+        if not self.shared:
+            return self._read(name)
+        data = self._raw.get(name)
+        if data is None:
+            data = self._raw[name] = self._read(name)
+        return data
+
+    def _read(self, name):
+        with instrumentation.phase(PHASE_ZIP_READ):
+            data = self.zf.read(name)
+        instrumentation.count(COUNTER_BYTES_READ, len(data))
+        return data
+
+    def read_text(self, name):
+        '''
+        The content of the named resource decoded as utf-8
+        '''
+        text = self._text.get(name)
+        if text is None:
+            text = self.read(name)
+            if is_py3:
+                with instrumentation.phase(PHASE_HTML_DECODE):
+                    text = text.decode('utf-8', errors='replace')
+            if self.shared:
+                self._text[name] = text
+        return text
+
+    def read_head(self, name, length):
+        '''
+        The first length characters of the named resource decoded as utf-8,
+        reading no more of the resource than is needed for them
+        '''
+        text = self._text.get(name)
+        if text is not None:
+            return text[:length]
+        data = self._raw.get(name)
+        if data is None:
+            with instrumentation.phase(PHASE_ZIP_READ):
+                f = self.zf.open(name)
+                try:
+                    # Enough bytes for length characters even if every one is multibyte
+                    data = f.read(length * 4)
+                finally:
+                    f.close()
+            instrumentation.count(COUNTER_BYTES_READ, len(data))
+        else:
+            data = data[:length * 4]
+        if is_py3:
+            with instrumentation.phase(PHASE_HTML_DECODE):
+                data = data.decode('utf-8', errors='replace')
+        return data[:length]
+
+    def iter_text(self, name, overlap=STREAM_OVERLAP):
+        '''
+        Yields the content of the named resource decoded as utf-8, in chunks
+        if it is larger than STREAM_THRESHOLD and not already read. Each chunk
+        starts with the last overlap characters of the chunk before, so a
+        regular expression matching no more than that many characters is
+        found even where it spans two chunks. A match within the overlap is
+        in both chunks, use finditer() where each match must be found once.
+        '''
+        for _offset, chunk in self._iter_chunks(name, overlap):
+            yield chunk
+
+    def finditer(self, name, regex, lower=False, overlap=STREAM_OVERLAP):
+        '''
+        Yields each match of the regular expression in the named resource,
+        read a chunk at a time as by iter_text(). The search of each chunk
+        resumes from the end of the last match yielded, so a match within the
+        overlap with the chunk before is not yielded again. The positions of
+        each match are within its chunk, which is the string of the match.
+        '''
+        resume = 0
+        for offset, chunk in self._iter_chunks(name, overlap, lower):
+            pos = max(0, resume - offset)
+            while pos <= len(chunk):
+                with instrumentation.phase(PHASE_REGEX):
+                    match = regex.search(chunk, pos)
+                if match is None:
+                    break
+                yield match
+                resume = offset + match.end()
+                pos = match.end() if match.end() > match.start() else match.end() + 1
+
+    def _iter_chunks(self, name, overlap, lower=False):
+        '''
+        Yields the (offset, chunk) of each chunk of the named resource for
+        iter_text(), where offset is the position of the chunk in the whole
+        resource, lower cased if lower is set
+        '''
+        if name in self._text or name in self._raw or \
+                self.zf.getinfo(name).file_size <= STREAM_THRESHOLD:
+            text = self.read_text(name)
+            yield 0, text.lower() if lower else text
+            return
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace') if is_py3 else None
+        offset = 0
+        tail = None
+        with instrumentation.phase(PHASE_ZIP_READ):
+            f = self.zf.open(name)
+        try:
+            while True:
+                with instrumentation.phase(PHASE_ZIP_READ):
+                    data = f.read(STREAM_CHUNK_SIZE)
+                instrumentation.count(COUNTER_BYTES_READ, len(data))
+                text = data
+                if decoder is not None:
+                    with instrumentation.phase(PHASE_HTML_DECODE):
+                        text = decoder.decode(data, not data)
+                if text:
+                    if lower:
+                        text = text.lower()
+                    chunk = text if tail is None else tail + text
+                    yield offset, chunk
+                    tail = chunk[-overlap:]
+                    offset += len(chunk) - len(tail)
+                if not data:
+                    break
+        finally:
+            f.close()
+
+    def cached(self, key, factory):
+        '''
+        Returns the value for key, calling factory to create it the first time
+        '''
+        parsed = self._entry.parsed
+        try:
+            return parsed[key]
+        except KeyError:
+            value = parsed[key] = factory()
+            self.add_cost(ENTRY_COST)
+            return value
+
+    def cached_document(self, key, factory):
+        '''
+        As cached(), for a document parsed into an lxml tree. The factory returns
+        the tree and the size of its source. A tree is only kept while the
+        trees kept for this book fit within the parsed ePub cache, otherwise
+        it is parsed again the next time it is needed.
+
+        Each caller is given its own copy of a kept tree, as the tree is kept
+        for later checks which may run on other threads, and lxml trees are
+        not to be shared between threads. Copying is still much quicker than
+        parsing the document again.
+        '''
+        parsed = self._entry.parsed
+        value = parsed.get(key)
+        if value is None:
+            value, size = factory()
+            cost = size * TREE_COST_FACTOR
+            budget = parsed_epub_cache.max_bytes or DOCUMENT_BUDGET
+            if self._entry.cost + self._added_cost + cost > budget:
+                return value
+            parsed[key] = value
+            self.add_cost(cost)
+        return copy.deepcopy(value)
@@ -7,6 +7,13 @@ __license__   = 'GPL v3'
 __copyright__ = '2012, Grant Drake <grant.drake@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
+import os, struct
+from collections import defaultdict
+
+# JPEG start of frame markers, which hold the image dimensions. The markers
+# 0xC4, 0xC8 and 0xCC within the range are not frames.
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - frozenset([0xC4, 0xC8, 0xCC])
+
 
 def get_formatted_author_initials(initials_mode, author):
     '''
@@ -80,6 +87,96 @@ def get_formatted_author_initials(initials_mode, author):
     return ' '.join(new_parts)
 
 
+def get_image_dimensions(path):
+    '''
+    Returns the (width, height) of a JPEG, PNG or GIF image read from just
+    the header bytes of the file, or None if it could not be worked out
+    that way. Raises IOError/OSError if the file cannot be read.
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(26)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return struct.unpack(str('>II'), head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack(str('<HH'), head[6:10])
+        if head[:2] != b'\xff\xd8':
+            return None
+        # Walk the JPEG segments until reaching a start of frame
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0:1] != b'\xff':
+                return None
+            code = ord(marker[1:2])
+            if code == 0xFF:
+                # Padding before the marker
+                f.seek(-1, 1)
+                continue
+            if code == 0xD8 or 0xD0 <= code <= 0xD7:
+                continue
+            if code == 0xD9:
+                # End of image without a frame
+                return None
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            length = struct.unpack(str('>H'), length)[0]
+            if code in JPEG_SOF_MARKERS:
+                data = f.read(5)
+                if len(data) < 5:
+                    return None
+                height, width = struct.unpack(str('>HH'), data[1:5])
+                return width, height
+            if length < 2:
+                return None
+            f.seek(length - 2, 1)
+
+
+def find_orphaned_opf_files(filenames, log):
+    '''
+    The .opf files with no book format alongside, together with their
+    .jpg covers, each listed once. The other files are indexed by every name
+    they start with up to a '.', so that those sharing the name of each .opf
+    file are looked up at once rather than comparing against every file.
+    '''
+    opf_files = []
+    files_by_base = defaultdict(list)
+    for filename in filenames:
+        lower_name = filename.lower()
+        if lower_name.endswith('.opf'):
+            opf_files.append(filename)
+            continue
+        dot_index = lower_name.find('.')
+        while dot_index != -1:
+            files_by_base[lower_name[:dot_index]].append(filename)
+            dot_index = lower_name.find('.', dot_index + 1)
+
+    files_to_delete = []
+    # A cover can share the name of more than one .opf file, as a.b.jpg does
+    # with both a.opf and a.b.opf
+    found = set()
+    for opf_file in opf_files:
+        base, _extension = os.path.splitext(opf_file)
+        matching_files = files_by_base.get(base.lower(), [])
+        log('\tAnalysing opf file: ', opf_file)
+        log('\tMatching files: ', matching_files)
+        safe_to_delete = True
+
+        for m in matching_files:
+            matching_extension = os.path.splitext(m)[1]
+            if matching_extension.lower() != '.jpg':
+                log('\tCannot remove .opf because found: ', m)
+                safe_to_delete = False
+                break
+        if safe_to_delete:
+            log('\tSafe to delete: ', opf_file)
+            for f in [opf_file] + matching_files:
+                if f not in found:
+                    found.add(f)
+                    files_to_delete.append(f)
+    return files_to_delete
+
+
 # calibre-debug -e helpers.py
 if __name__ == '__main__':
     def test(initials_mode, author, expected):
@@ -138,4 +235,3 @@ if __name__ == '__main__':
     test('AB','J..A Bloggs','JA Bloggs')
     test('AB','J.A. Bloggs','JA Bloggs')
     test('AB','J. A. Bloggs','JA Bloggs')
-   
\ No newline at end of file
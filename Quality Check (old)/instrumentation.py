@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import heapq, threading, time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    clock = time.time
+
+# Names of the phases timed while reading books, in the order to report them
+PHASE_FORMAT_PATH = 'format path'
+PHASE_ZIP_OPEN = 'zip open'
+PHASE_ZIP_READ = 'zip read'
+PHASE_OPF_PARSE = 'OPF parse'
+PHASE_XML_DECODE = 'XML decode'
+PHASE_XML_PARSE = 'XML parse'
+PHASE_HTML_DECODE = 'HTML decode'
+PHASE_REGEX = 'regex'
+PHASE_MOBI_HEADER = 'MOBI header'
+ALL_PHASES = [PHASE_FORMAT_PATH, PHASE_ZIP_OPEN, PHASE_ZIP_READ, PHASE_OPF_PARSE,
+              PHASE_XML_DECODE, PHASE_XML_PARSE, PHASE_HTML_DECODE, PHASE_REGEX,
+              PHASE_MOBI_HEADER]
+
+COUNTER_BYTES_READ = 'bytes read'
+
+# The number of slowest books to keep the times of
+SLOWEST_BOOKS_COUNT = 20
+
+
+class Instrumentation(object):
+    '''
+    Accumulates the time spent in each phase of reading books and any
+    counters such as bytes read, across all worker threads. Does nothing
+    until enabled, so the hooks cost next to nothing in normal use.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.times = defaultdict(float)
+            self.calls = defaultdict(int)
+            self.counters = defaultdict(int)
+            self.book_times = []
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Times the enclosed block as the named phase. A phase entered while
+        another is already being timed on the same thread, such as parsing
+        the xml of the OPF, counts towards the outer phase only.
+        '''
+        if not self.enabled or getattr(self._local, 'in_phase', False):
+            yield
+            return
+        self._local.in_phase = True
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add_time(name, clock() - start)
+            self._local.in_phase = False
+
+    def add_time(self, name, elapsed):
+        with self._lock:
+            self.times[name] += elapsed
+            self.calls[name] += 1
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+
+    def record_book(self, book_id, elapsed):
+        '''
+        Keeps the time taken to evaluate a book if amongst the slowest so far
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            if len(self.book_times) < SLOWEST_BOOKS_COUNT:
+                heapq.heappush(self.book_times, (elapsed, book_id))
+            else:
+                heapq.heappushpop(self.book_times, (elapsed, book_id))
+
+    def snapshot(self):
+        '''
+        Returns a copy of the totals as a dictionary which can be saved as json
+        '''
+        with self._lock:
+            slowest = sorted(self.book_times, reverse=True)
+            return {'times': dict(self.times), 'calls': dict(self.calls),
+                    'counters': dict(self.counters),
+                    'slowest_books': [{'book_id': book_id, 'seconds': elapsed}
+                                      for elapsed, book_id in slowest]}
+
+
+class InstrumentedDb(object):
+    '''
+    Passed to the check callbacks in place of the database while timings are
+    being recorded, to time looking up the path of each format.
+    '''
+    def __init__(self, db):
+        self.db = db
+
+    def format_abspath(self, *args, **kwargs):
+        with instrumentation.phase(PHASE_FORMAT_PATH):
+            return self.db.format_abspath(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+instrumentation = Instrumentation()
@@ -12,11 +12,19 @@ try:
 except NameError:
     pass # load_translations() added in calibre 1.9
 
-import struct
+import os, shutil, struct, tempfile
 from io import BytesIO
 
-from calibre.ebooks.metadata.mobi import MetadataUpdater
 from calibre.ebooks.mobi import MobiError
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.quality_check.instrumentation import instrumentation, PHASE_MOBI_HEADER, COUNTER_BYTES_READ
+
+# The zero padding left after the name when the header record has to grow, as
+# Kindlegen does, so that later updates to the EXTH header fit in place
+RECORD0_PADDING = 8192
+# The size of each read when copying the sections after the header record
+COPY_CHUNK_SIZE = 1024 * 1024
 
 class TopazError(ValueError):
     pass
@@ -75,7 +83,31 @@ class MinimalMobiHeader(object):
                     self.exth_flag = 0
 
 
+class LazySections(object):
+    '''
+    The (data, section_header) of each section of the book, with the data
+    only read from the file when a section is asked for
+    '''
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return self.reader.num_sections
+
+    def __getitem__(self, section_number):
+        if section_number < 0:
+            section_number += self.reader.num_sections
+        if not 0 <= section_number < self.reader.num_sections:
+            raise IndexError(section_number)
+        return (self.reader.section(section_number), self.reader.section_headers[section_number])
+
+
 class MinimalMobiReader(object):
+    '''
+    Reads just the PDB header, the section table and section 0 of a MOBI,
+    which is all the checks need to get at the MOBI and EXTH headers. Other
+    sections are only read if asked for through section() or sections.
+    '''
 
     def __init__(self, filename, log):
         self.log = log
@@ -83,9 +115,26 @@ class MinimalMobiReader(object):
         stream = open(filename, 'rb')
         self.stream = stream
 
-        raw = stream.read()
+        try:
+            with instrumentation.phase(PHASE_MOBI_HEADER):
+                self._read_header(stream)
+        except:
+            stream.close()
+            self.stream = None
+            raise
+
+    def _read(self, offset, length):
+        self.stream.seek(offset)
+        data = self.stream.read(length)
+        instrumentation.count(COUNTER_BYTES_READ, len(data))
+        return data
+
+    def _read_header(self, stream):
+        raw = self._read(0, 78)
         if raw.startswith(b'TPZ'):
             raise TopazError(_('This is an Amazon Topaz book. It cannot be processed.'))
+        if len(raw) < 78:
+            raise MobiError('File too short to be a MOBI book')
 
         self.header   = raw[0:72]
         self.name     = self.header[:32].replace(b'\x00', b'')
@@ -95,25 +144,24 @@ class MinimalMobiReader(object):
         if self.ident not in [b'BOOKMOBI', b'TEXTREAD']:
             raise MobiError('Unknown book type: %s' % repr(self.ident))
 
-        self.sections = []
+        self.file_size = os.fstat(stream.fileno()).st_size
+        table = self._read(78, self.num_sections * 8)
         self.section_headers = []
         for i in range(self.num_sections):
-            offset, a1, a2, a3, a4 = struct.unpack('>LBBBB', raw[78 + i * 8:78 + i * 8 + 8])
+            offset, a1, a2, a3, a4 = struct.unpack('>LBBBB', table[i * 8:i * 8 + 8])
             flags, val = a1, a2 << 16 | a3 << 8 | a4
             self.section_headers.append((offset, flags, val))
+        self.sections = LazySections(self)
 
-        def section(section_number):
-            if section_number == self.num_sections - 1:
-                end_off = len(raw)
-            else:
-                end_off = self.section_headers[section_number + 1][0]
-            off = self.section_headers[section_number][0]
-            return raw[off:end_off]
-
-        for i in range(self.num_sections):
-            self.sections.append((section(i), self.section_headers[i]))
+        self.book_header = MinimalMobiHeader(self.section(0) if self.num_sections else b'', self.log)
 
-        self.book_header = MinimalMobiHeader(self.sections[0][0], self.log)
+    def section(self, section_number):
+        if section_number == self.num_sections - 1:
+            end_off = self.file_size
+        else:
+            end_off = self.section_headers[section_number + 1][0]
+        off = self.section_headers[section_number][0]
+        return self._read(off, max(0, end_off - off))
 
     def __enter__(self):
         return self
@@ -124,41 +172,221 @@ class MinimalMobiReader(object):
             self.stream = None
 
 
-class MinimalMobiUpdater(MetadataUpdater):
-
-    def update(self, asin=None, cdetype=None):
-        def update_exth_record(rec):
-            recs.append(rec)
-            if rec[0] in self.original_exth_records:
-                self.original_exth_records.pop(rec[0])
-
-        if self.type != b"BOOKMOBI":
-                raise MobiError("Setting ASIN only supported for MOBI files of type 'BOOK'.\n"
-                                "\tThis is a '%s' file of type '%s'" % (self.type[0:4], self.type[4:8]))
-        recs = []
-        if asin is not None:
-            update_exth_record((113, asin.encode(self.codec, 'replace')))
-            update_exth_record((504, asin.encode(self.codec, 'replace')))
-        if cdetype is not None:
-            update_exth_record((501, cdetype))
-
-        # Include remaining original EXTH fields
-        for id_ in sorted(self.original_exth_records):
-            recs.append((id_, self.original_exth_records[id_]))
-        recs = sorted(recs, key=lambda x:(x[0],x[0]))
-
-        exth = BytesIO()
-        for code, data in recs:
-            exth.write(struct.pack('>II', int(code), len(data) + 8))
-            exth.write(data)
-        exth = exth.getvalue()
-        trail = len(exth) % 4
-        pad = b'\0' * (4 - trail) # Always pad w/ at least 1 byte
-        exth = [b'EXTH', struct.pack(b'>II', len(exth) + 12, len(recs)), exth, pad]
-        exth = b''.join(exth)
-
-        if getattr(self, 'exth', None) is None:
-            raise MobiError(_('No existing EXTH record. Cannot update ASIN.'))
-
-        self.create_exth(exth=exth)
+def build_exth(original_exth_records, codec, asin=None, cdetype=None):
+    '''
+    The bytes of an EXTH header holding the original records, with the ASIN
+    and cdetype records replaced by those given
+    '''
+    records = dict(original_exth_records)
+    if asin is not None:
+        records[113] = asin.encode(codec, 'replace')
+        records[504] = asin.encode(codec, 'replace')
+    if cdetype is not None:
+        records[501] = cdetype
+
+    exth = BytesIO()
+    for code in sorted(records):
+        data = records[code]
+        exth.write(struct.pack('>II', int(code), len(data) + 8))
+        exth.write(data)
+    exth = exth.getvalue()
+    trail = len(exth) % 4
+    pad = b'\0' * (4 - trail) # Always pad w/ at least 1 byte
+    exth = [b'EXTH', struct.pack(b'>II', len(exth) + 12, len(records)), exth, pad]
+    return b''.join(exth)
+
+
+def read_exth_records(record0):
+    '''
+    The (exth_offset, exth_length, codec, records) of the EXTH header in the
+    MOBI header record, where records maps each code to its data
+    '''
+    if len(record0) < 0x84:
+        raise MobiError(_('No existing EXTH record. Cannot update ASIN.'))
+    mobi_length, = struct.unpack('>L', record0[20:24])
+    codepage, = struct.unpack('>L', record0[28:32])
+    exth_flag, = struct.unpack('>L', record0[0x80:0x84])
+    exth_offset = 16 + mobi_length
+    if not exth_flag & 0x40 or record0[exth_offset:exth_offset + 4] != b'EXTH':
+        raise MobiError(_('No existing EXTH record. Cannot update ASIN.'))
+    codec = 'utf-8' if codepage == 65001 else 'cp1252'
+
+    exth_length, num_items = struct.unpack('>LL', record0[exth_offset + 4:exth_offset + 12])
+    original_exth_records = {}
+    pos = exth_offset + 12
+    for _i in range(num_items):
+        code, size = struct.unpack('>LL', record0[pos:pos + 8])
+        original_exth_records[code] = record0[pos + 8:pos + size]
+        pos += size
+    return exth_offset, exth_length, codec, original_exth_records
+
+
+def _rebuild_record0(record0, asin=None, cdetype=None):
+    '''
+    The MOBI header record up to the end of the full name with its EXTH
+    records updated, and the remainder of the record after the name. Any
+    data between the EXTH header and the name, such as the DRM key block,
+    is carried across unchanged, with the offsets to it and to the name
+    moved along with it.
+    '''
+    exth_offset, exth_length, codec, original_exth_records = read_exth_records(record0)
+    mobi_length, = struct.unpack('>L', record0[20:24])
+    title_offset, title_length = struct.unpack('>LL', record0[0x54:0x5C])
+    exth_end = exth_offset + exth_length
+    if title_offset < exth_end:
+        raise MobiError(_('The name is not after the EXTH record. Cannot update ASIN.'))
+    drm_offset = None
+    if 16 + mobi_length >= 0xB0:
+        drm_offset, = struct.unpack('>L', record0[0xA8:0xAC])
+        if drm_offset == 0xFFFFFFFF:
+            drm_offset = None
+
+    # The padding of the original EXTH header is replaced by that of the new one
+    data_start = exth_end
+    while data_start < title_offset and record0[data_start:data_start + 1] == b'\0':
+        data_start += 1
+    if drm_offset is not None and exth_end <= drm_offset < data_start:
+        data_start = drm_offset
+
+    exth = build_exth(original_exth_records, codec, asin, cdetype)
+    new_exth_end = exth_offset + len(exth)
+    # Keep whatever follows the EXTH header at the same alignment
+    align = (data_start - new_exth_end) % 4
+    shift = new_exth_end + align - data_start
+    header = bytearray(record0[:exth_offset])
+    struct.pack_into('>L', header, 0x54, title_offset + shift)
+    if drm_offset is not None and drm_offset >= data_start:
+        struct.pack_into('>L', header, 0xA8, drm_offset + shift)
+    title_end = title_offset + title_length
+    return bytes(header) + exth + b'\0' * align + record0[data_start:title_end], record0[title_end:]
+
+
+def patch_record0(record0, asin=None, cdetype=None):
+    '''
+    Returns a copy of the MOBI header record with its EXTH records updated,
+    the same length as the original so it can be written back over it, or
+    None if the new EXTH header does not fit. It fits when the full name
+    following the EXTH header can be moved into the zero padding at the end
+    of the record, which Kindlegen leaves room for.
+    '''
+    new_record0, tail = _rebuild_record0(record0, asin, cdetype)
+    if tail.strip(b'\0'):
+        # Something other than padding follows the name, which cannot be moved
+        return None
+    # Keep the name terminated by at least two nulls, as the Kindle expects
+    if len(new_record0) + 2 > len(record0):
+        return None
+    return new_record0 + b'\0' * (len(record0) - len(new_record0))
+
+
+def grow_record0(record0, asin=None, cdetype=None):
+    '''
+    Returns a copy of the MOBI header record with its EXTH records updated
+    and the full name moved after them, followed by RECORD0_PADDING of zero
+    padding, for when patch_record0() finds the new EXTH header does not fit
+    '''
+    new_record0, tail = _rebuild_record0(record0, asin, cdetype)
+    new_record0 += tail.rstrip(b'\0')
+    # Keep the name terminated by at least two nulls, padded to a multiple of four bytes
+    pad = b'\0' * (2 + (4 - (len(new_record0) + 2) % 4) % 4)
+    return new_record0 + pad + b'\0' * RECORD0_PADDING
+
+
+def check_not_encrypted(record0):
+    '''
+    As with calibre, the metadata of DRM encrypted books is not changed
+    '''
+    encryption_type, = struct.unpack('>H', record0[12:14])
+    if encryption_type != 0:
+        raise MobiError(_('This book is DRM encrypted. Cannot update ASIN.'))
+
 
+def read_book_header(stream):
+    '''
+    The PDB header of a MOBI book opened for updating, checking it is a book
+    whose EXTH header can be updated
+    '''
+    header = stream.read(78)
+    if header.startswith(b'TPZ'):
+        raise TopazError(_('This is an Amazon Topaz book. It cannot be processed.'))
+    book_type = header[0x3C:0x3C + 8]
+    if len(header) < 78 or book_type != b'BOOKMOBI':
+        raise MobiError("Setting ASIN only supported for MOBI files of type 'BOOK'.\n"
+                        "\tThis is a '%s' file of type '%s'" % (book_type[0:4], book_type[4:8]))
+    return header
+
+
+def update_exth_in_place(path, asin=None, cdetype=None):
+    '''
+    Updates the ASIN and cdetype of a MOBI book by rewriting just its header
+    record in place. Returns False without changing the file if the new
+    EXTH header does not fit, for the caller to use rewrite_exth() instead.
+    '''
+    with open(path, 'r+b') as stream:
+        header = read_book_header(stream)
+        num_sections, = struct.unpack('>H', header[76:78])
+        table = stream.read(16)
+        record0_offset, = struct.unpack('>L', table[0:4])
+        if num_sections > 1:
+            record0_end, = struct.unpack('>L', table[8:12])
+        else:
+            record0_end = os.fstat(stream.fileno()).st_size
+        stream.seek(record0_offset)
+        record0 = stream.read(record0_end - record0_offset)
+        check_not_encrypted(record0)
+        new_record0 = patch_record0(record0, asin, cdetype)
+        if new_record0 is None:
+            return False
+        stream.seek(record0_offset)
+        stream.write(new_record0)
+    return True
+
+
+
+def rewrite_exth(path, asin=None, cdetype=None):
+    '''
+    Updates the ASIN and cdetype of a MOBI book whose header record has to
+    grow to hold them. The PDB header, the section table with the offsets
+    after the header record shifted and the new header record are written
+    to a temporary file beside the book, followed by the rest of the book
+    copied a chunk at a time, which then replaces the book. Returns the new
+    size of the book.
+    '''
+    with open(path, 'rb') as stream:
+        header = read_book_header(stream)
+        num_sections, = struct.unpack('>H', header[76:78])
+        table = bytearray(stream.read(num_sections * 8))
+        offsets = [struct.unpack('>L', bytes(table[i * 8:i * 8 + 4]))[0] for i in range(num_sections)]
+        if num_sections > 1:
+            record0_end = offsets[1]
+        else:
+            record0_end = os.fstat(stream.fileno()).st_size
+        # Usually the two bytes of padding between the section table and the first section
+        gap = stream.read(max(0, offsets[0] - stream.tell()))
+        stream.seek(offsets[0])
+        record0 = stream.read(record0_end - offsets[0])
+        check_not_encrypted(record0)
+        new_record0 = grow_record0(record0, asin, cdetype)
+        delta = len(new_record0) - len(record0)
+        for i in range(1, num_sections):
+            struct.pack_into('>L', table, i * 8, offsets[i] + delta)
+
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(header)
+                out.write(bytes(table))
+                out.write(gap)
+                out.write(new_record0)
+                stream.seek(record0_end)
+                shutil.copyfileobj(stream, out, COPY_CHUNK_SIZE)
+            shutil.copymode(path, temp_path)
+        except:
+            os.remove(temp_path)
+            raise
+    try:
+        atomic_rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+    return os.path.getsize(path)
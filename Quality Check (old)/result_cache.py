@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import json, os, sqlite3, threading
+
+from polyglot.builtins import unicode_type
+
+from calibre.utils.config import config_dir
+
+# Write the results gathered so far after this many, so they are not all held
+# in memory on the first run against a large library
+COMMIT_INTERVAL = 200
+
+
+def get_result_cache_path(db):
+    '''
+    Kept in the plugin's folder of the calibre configuration rather than in
+    the library, as the cache can be rebuilt at any time
+    '''
+    folder = os.path.join(config_dir, 'plugins', 'Quality Check')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return os.path.join(folder, 'result_cache_%s.db' % db.library_id)
+
+
+class ResultCacheUnavailable(Exception):
+    pass
+
+
+class ResultCache(object):
+    '''
+    The verdict and log output of each book for the checks which read the
+    book files, so that books unchanged since they were last checked are not
+    read again. Each row is keyed by the check and book, and is only written
+    when a book is evaluated, rather than saving the results of every book
+    at the end of each run.
+
+    The signature is the json of the [format, path, size, mtime] of the files
+    read by the check, and the options hash covers both the settings of the
+    check and the version of the plugin.
+
+    It also holds whether the ePub of each book is DRM encrypted, so books
+    with DRM can be skipped without opening them while the size and
+    modification time of the ePub are unchanged, and the dimensions of each
+    cover while the size and modification time of the cover are unchanged.
+    '''
+    def __init__(self, path):
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._pending_drm = {}
+        self.changed = False
+        try:
+            self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS results '
+                              '(menu_key TEXT, book_id INTEGER, signature TEXT, options_hash TEXT, '
+                              'matched INTEGER, log TEXT, PRIMARY KEY (menu_key, book_id))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS results_book_id ON results (book_id)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS drm_index '
+                              '(book_id INTEGER PRIMARY KEY, size INTEGER, mtime REAL, is_drm INTEGER)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS cover_dimensions '
+                              '(book_id INTEGER PRIMARY KEY, size INTEGER, mtime REAL, width INTEGER, height INTEGER)')
+            self.conn.commit()
+        except sqlite3.Error as e:
+            raise ResultCacheUnavailable(unicode_type(e))
+
+    def get_result(self, menu_key, book_id, signature, options_hash):
+        '''
+        The cached (matched, log_records) of the book if its files and the
+        options are unchanged since it was last checked, otherwise None
+        '''
+        with self._lock:
+            row = self._pending.get((menu_key, book_id))
+            if row is None:
+                row = self.conn.execute('SELECT menu_key, book_id, signature, options_hash, matched, log '
+                                        'FROM results WHERE menu_key=? AND book_id=?',
+                                        (menu_key, book_id)).fetchone()
+        if row is None or row[2] != json.dumps(signature) or row[3] != options_hash:
+            return None
+        return bool(row[4]), json.loads(row[5])
+
+    def set_result(self, menu_key, book_id, signature, options_hash, matched, log_records):
+        with self._lock:
+            self._pending[(menu_key, book_id)] = (menu_key, book_id, json.dumps(signature), options_hash,
+                                                  int(bool(matched)), json.dumps(log_records))
+            self.changed = True
+            if len(self._pending) >= COMMIT_INTERVAL:
+                self.commit()
+
+    def get_drm(self, book_id, size, mtime):
+        '''
+        Whether the ePub of the book is DRM encrypted, or None if it has not
+        been classified since it last changed
+        '''
+        with self._lock:
+            row = self._pending_drm.get(book_id)
+            if row is None:
+                row = self.conn.execute('SELECT book_id, size, mtime, is_drm FROM drm_index WHERE book_id=?',
+                                        (book_id,)).fetchone()
+        if row is None or row[1] != size or row[2] != mtime:
+            return None
+        return bool(row[3])
+
+    def set_drm(self, book_id, size, mtime, is_drm):
+        with self._lock:
+            self._pending_drm[book_id] = (book_id, size, mtime, int(bool(is_drm)))
+            self.changed = True
+            if len(self._pending_drm) >= COMMIT_INTERVAL:
+                self.commit()
+
+    def get_cover_dimensions(self, book_id, size, mtime):
+        '''
+        The (width, height) of the cover of the book, or None if it has not
+        been measured since it last changed
+        '''
+        with self._lock:
+            row = self.conn.execute('SELECT book_id, size, mtime, width, height FROM cover_dimensions '
+                                    'WHERE book_id=?', (book_id,)).fetchone()
+        if row is None or row[1] != size or row[2] != mtime:
+            return None
+        return row[3], row[4]
+
+    def set_cover_dimensions(self, dimensions):
+        '''
+        Writes the (book_id, size, mtime, width, height) of each cover measured
+        '''
+        with self._lock:
+            self.conn.executemany('INSERT OR REPLACE INTO cover_dimensions (book_id, size, mtime, width, height) '
+                                  'VALUES (?, ?, ?, ?, ?)', dimensions)
+            self.conn.commit()
+            self.changed = True
+
+    def prune(self, valid_ids):
+        '''
+        Remove the books which are no longer in the library
+        '''
+        with self._lock:
+            self.commit()
+            deleted = False
+            for table in ('results', 'drm_index', 'cover_dimensions'):
+                book_ids = [row[0] for row in self.conn.execute('SELECT DISTINCT book_id FROM %s' % table)
+                            if row[0] not in valid_ids]
+                if book_ids:
+                    self.conn.executemany('DELETE FROM %s WHERE book_id=?' % table, [(i,) for i in book_ids])
+                    deleted = True
+            if deleted:
+                self.conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._pending_drm.clear()
+            self.conn.execute('DELETE FROM results')
+            self.conn.execute('DELETE FROM drm_index')
+            self.conn.execute('DELETE FROM cover_dimensions')
+            self.conn.commit()
+
+    def commit(self):
+        with self._lock:
+            if not self._pending and not self._pending_drm:
+                return
+            self.conn.executemany('INSERT OR REPLACE INTO results (menu_key, book_id, signature, '
+                                  'options_hash, matched, log) VALUES (?, ?, ?, ?, ?, ?)',
+                                  list(self._pending.values()))
+            self.conn.executemany('INSERT OR REPLACE INTO drm_index (book_id, size, mtime, is_drm) '
+                                  'VALUES (?, ?, ?, ?)', list(self._pending_drm.values()))
+            self.conn.commit()
+            self._pending.clear()
+            self._pending_drm.clear()
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self.conn.close()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, sqlite3, threading
+
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from polyglot.builtins import codepoint_to_chr, unicode_type
+
+from calibre.utils.config import config_dir
+
+# The columns of the index, one for each scope offered when searching ePubs
+SCOPE_PLAINTEXT = 'plaintext'
+SCOPE_HTML = 'html'
+SCOPE_CSS = 'css'
+SCOPE_OPF = 'opf'
+SCOPE_NCX = 'ncx'
+SCOPE_ZIP = 'zip'
+ALL_SCOPES = [SCOPE_PLAINTEXT, SCOPE_HTML, SCOPE_CSS, SCOPE_OPF, SCOPE_NCX, SCOPE_ZIP]
+
+# The trigram tokenizer can only look up text of at least this many characters
+MIN_LITERAL_LENGTH = 3
+# Commit the books indexed so far after this many, so cancelling a search keeps them
+COMMIT_INTERVAL = 50
+
+
+def get_search_index_path(db):
+    '''
+    The index for each library is kept in the plugin's folder of the calibre
+    configuration rather than the library, as it can be rebuilt at any time
+    '''
+    folder = os.path.join(config_dir, 'plugins', 'Quality Check')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return os.path.join(folder, 'search_index_%s.db' % db.library_id)
+
+
+def get_required_literals(pattern, flags=0):
+    '''
+    The runs of literal text which any match of the regular expression must
+    contain, for narrowing down the books to search using the index. Only
+    the top level of the expression is considered, so anything inside groups,
+    alternatives or repeats is ignored and an empty list means the index
+    cannot help with this expression.
+    '''
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return []
+    literals = []
+    run = []
+    for op, av in parsed:
+        if str(op).upper() == 'LITERAL':
+            run.append(codepoint_to_chr(av))
+            continue
+        if len(run) >= MIN_LITERAL_LENGTH:
+            literals.append(''.join(run))
+        run = []
+    if len(run) >= MIN_LITERAL_LENGTH:
+        literals.append(''.join(run))
+    return literals
+
+
+class SearchIndexUnavailable(Exception):
+    pass
+
+
+class EpubSearchIndex(object):
+    '''
+    A full text index of the content of the ePubs in a library, used by the
+    Search ePubs check to skip the books which cannot contain a match. It is
+    an sqlite FTS5 table using the trigram tokenizer, so any text of three
+    or more characters can be looked up regardless of word boundaries, with
+    each matching book then confirmed by the regular expression as before.
+
+    Each book is indexed the first time it is searched, and again whenever
+    the size or modification time of its ePub changes.
+    '''
+    def __init__(self, path):
+        self._lock = threading.RLock()
+        self._pending = 0
+        try:
+            self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS books '
+                              '(book_id INTEGER PRIMARY KEY, path TEXT, size INTEGER, mtime REAL)')
+            self.conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS book_text USING fts5(%s, '
+                              'tokenize="trigram")' % ', '.join(ALL_SCOPES))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            raise SearchIndexUnavailable(unicode_type(e))
+        self._signatures = dict((book_id, (path, size, mtime)) for book_id, path, size, mtime in
+                                self.conn.execute('SELECT book_id, path, size, mtime FROM books'))
+
+    def get_signature(self, path):
+        try:
+            st = os.stat(path)
+        except EnvironmentError:
+            return None
+        return (path, st.st_size, st.st_mtime)
+
+    def is_current(self, book_id, signature):
+        return signature is not None and self._signatures.get(book_id) == signature
+
+    def find_candidates(self, literals, scopes):
+        '''
+        The ids of the indexed books containing every literal in any of the scopes
+        '''
+        phrases = ' AND '.join('"%s"' % l.replace('"', '""') for l in literals)
+        query = '{%s} : (%s)' % (' '.join(scopes), phrases)
+        with self._lock:
+            return set(row[0] for row in
+                       self.conn.execute('SELECT rowid FROM book_text WHERE book_text MATCH ?', (query,)))
+
+    def update_book(self, book_id, signature, scope_text):
+        with self._lock:
+            self.conn.execute('DELETE FROM book_text WHERE rowid=?', (book_id,))
+            self.conn.execute('INSERT INTO book_text (rowid, %s) VALUES (?, %s)' %
+                              (', '.join(ALL_SCOPES), ', '.join('?' * len(ALL_SCOPES))),
+                              [book_id] + [scope_text.get(scope, '') for scope in ALL_SCOPES])
+            self.conn.execute('INSERT OR REPLACE INTO books (book_id, path, size, mtime) VALUES (?, ?, ?, ?)',
+                              (book_id,) + tuple(signature))
+            self._signatures[book_id] = tuple(signature)
+            self._pending += 1
+            if self._pending >= COMMIT_INTERVAL:
+                self.commit()
+
+    def prune(self, valid_ids):
+        '''
+        Remove the books which are no longer in the library
+        '''
+        with self._lock:
+            for book_id in [i for i in self._signatures if i not in valid_ids]:
+                self.conn.execute('DELETE FROM book_text WHERE rowid=?', (book_id,))
+                self.conn.execute('DELETE FROM books WHERE book_id=?', (book_id,))
+                del self._signatures[book_id]
+                self._pending += 1
+
+    def commit(self):
+        with self._lock:
+            if self._pending:
+                self.conn.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self.conn.close()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Unit tests for the parts of the plugin which do not need the calibre gui.
+# To run them from the plugin folder:
+#
+#   python tests/run_tests.py
+#
+# The tests of modules which import calibre itself are skipped unless they
+# are run by the python bundled with calibre:
+#
+#   calibre-debug -e tests/run_tests.py
+
+import os, sys, types
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    from calibre.constants import numeric_version
+except ImportError:
+    numeric_version = None
+HAS_CALIBRE = numeric_version is not None
+NEEDS_CALIBRE = 'needs calibre, run with calibre-debug -e tests/run_tests.py'
+
+
+def mount_plugin():
+    '''
+    Makes the modules in this folder importable as calibre_plugins.quality_check,
+    the name calibre gives the installed plugin, without running the plugin
+    __init__.py which needs the calibre gui
+    '''
+    if 'calibre_plugins' not in sys.modules:
+        calibre_plugins = types.ModuleType(str('calibre_plugins'))
+        calibre_plugins.__path__ = []
+        sys.modules['calibre_plugins'] = calibre_plugins
+    package = types.ModuleType(str('calibre_plugins.quality_check'))
+    package.__path__ = [PLUGIN_DIR]
+    sys.modules['calibre_plugins.quality_check'] = package
+    sys.modules['calibre_plugins'].quality_check = package
+
+mount_plugin()
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, sys, unittest
+
+# python tests/run_tests.py
+# calibre-debug -e tests/run_tests.py
+if __name__ == '__main__':
+    plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, plugin_dir)
+    suite = unittest.defaultTestLoader.discover(os.path.join(plugin_dir, 'tests'),
+                                                top_level_dir=plugin_dir)
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    sys.exit(0 if result.wasSuccessful() else 1)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, re, shutil, tempfile, unittest, zipfile
+
+from tests import HAS_CALIBRE, NEEDS_CALIBRE
+
+if HAS_CALIBRE:
+    from calibre_plugins.quality_check.epub_book import (EpubBook, read_central_directory,
+                                                         STREAM_CHUNK_SIZE, STREAM_THRESHOLD)
+
+FILES = [('mimetype', b'application/epub+zip', zipfile.ZIP_STORED),
+         ('META-INF/container.xml', b'<container/>' * 20, zipfile.ZIP_DEFLATED),
+         ('OEBPS/content.opf', b'<package/>' * 50, zipfile.ZIP_DEFLATED),
+         ('OEBPS/Text/Caf\xe9.xhtml', b'<html/>' * 100, zipfile.ZIP_DEFLATED)]
+
+
+@unittest.skipUnless(HAS_CALIBRE, NEEDS_CALIBRE)
+class TestReadCentralDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tdir, 'book.epub')
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def write_epub(self, prefix=b'', comment=b''):
+        with open(self.path, 'wb') as f:
+            f.write(prefix)
+            with zipfile.ZipFile(f, 'w') as zf:
+                for name, data, compress_type in FILES:
+                    zf.writestr(name, data, compress_type)
+                zf.comment = comment
+
+    def assertEntries(self, entries):
+        with zipfile.ZipFile(self.path) as zf:
+            expected = [(i.filename, i.file_size, i.compress_size) for i in zf.infolist()]
+        self.assertEqual([(e.filename, e.file_size, e.compress_size) for e in entries], expected)
+        self.assertEqual([e.filename for e in entries], [name for name, _data, _type in FILES])
+
+    def test_listing(self):
+        self.write_epub()
+        self.assertEntries(read_central_directory(self.path))
+
+    def test_zip_with_a_comment(self):
+        self.write_epub(comment=b'Written by the test' * 10)
+        self.assertEntries(read_central_directory(self.path))
+
+    def test_data_prepended_to_the_zip(self):
+        self.write_epub(prefix=b'\0' * 1000)
+        self.assertEntries(read_central_directory(self.path))
+
+    def test_not_a_zip(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'<html/>' * 100)
+        self.assertIsNone(read_central_directory(self.path))
+
+    def test_truncated_zip(self):
+        self.write_epub()
+        with open(self.path, 'rb') as f:
+            raw = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(raw[:len(raw) // 2] + raw[-22:])
+        self.assertIsNone(read_central_directory(self.path))
+
+
+@unittest.skipUnless(HAS_CALIBRE, NEEDS_CALIBRE)
+class TestFindIter(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tdir, 'book.epub')
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def write_epub(self, text):
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('text.html', text.encode('utf-8'))
+
+    def find(self, regex, lower=False):
+        with EpubBook(self.path) as book:
+            return [m.group() for m in book.finditer('text.html', regex, lower)]
+
+    def test_each_match_is_found_once(self):
+        # Matches just before the end of the first chunk are in the overlap
+        # carried into the second, and one match spans the two chunks
+        positions = [10, STREAM_CHUNK_SIZE - 1000, STREAM_CHUNK_SIZE - 20, STREAM_CHUNK_SIZE - 4,
+                     STREAM_CHUNK_SIZE + 500, 3 * STREAM_CHUNK_SIZE]
+        text = list('-' * (STREAM_THRESHOLD + STREAM_CHUNK_SIZE))
+        for i, pos in enumerate(positions):
+            text[pos:pos + 8] = 'Needle%02d' % i
+        text = ''.join(text)
+        self.write_epub(text)
+        regex = re.compile(r'needle\d+')
+        self.assertEqual(self.find(regex, lower=True), ['needle%02d' % i for i in range(len(positions))])
+        self.assertEqual(self.find(re.compile(r'Needle\d+')), re.findall(r'Needle\d+', text))
+
+    def test_small_resource(self):
+        self.write_epub('A Needle and another needle')
+        self.assertEqual(self.find(re.compile('needle'), lower=True), ['needle', 'needle'])
+        self.assertEqual(self.find(re.compile('needle')), ['needle'])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, shutil, struct, tempfile, unittest
+
+from calibre_plugins.quality_check.helpers import get_image_dimensions, find_orphaned_opf_files
+
+PNG_HEADER = b'\x89PNG\r\n\x1a\n\0\0\0\rIHDR' + struct.pack(str('>II'), 640, 480) + b'\x08\x02\0\0\0'
+GIF_HEADER = b'GIF89a' + struct.pack(str('<HH'), 320, 200) + b'\0' * 16
+JPEG_HEADER = (b'\xff\xd8' +
+               # An APP0 segment to be skipped before the frame
+               b'\xff\xe0' + struct.pack(str('>H'), 16) + b'JFIF\0' + b'\0' * 9 +
+               b'\xff\xc0' + struct.pack(str('>HBHH'), 17, 8, 32, 64) + b'\0' * 10)
+
+
+class TestGetImageDimensions(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def dimensions(self, data):
+        path = os.path.join(self.tdir, 'cover.img')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return get_image_dimensions(path)
+
+    def test_png(self):
+        self.assertEqual(tuple(self.dimensions(PNG_HEADER)), (640, 480))
+
+    def test_gif(self):
+        self.assertEqual(tuple(self.dimensions(GIF_HEADER)), (320, 200))
+
+    def test_jpeg(self):
+        self.assertEqual(tuple(self.dimensions(JPEG_HEADER)), (64, 32))
+
+    def test_jpeg_ending_before_a_frame(self):
+        self.assertIsNone(self.dimensions(b'\xff\xd8\xff\xd9'))
+
+    def test_truncated_jpeg(self):
+        self.assertIsNone(self.dimensions(JPEG_HEADER[:24]))
+
+    def test_unknown_format(self):
+        self.assertIsNone(self.dimensions(b'not an image'))
+        self.assertIsNone(self.dimensions(b''))
+
+
+class TestFindOrphanedOpfFiles(unittest.TestCase):
+
+    def find(self, filenames):
+        return find_orphaned_opf_files(filenames, lambda *args: None)
+
+    def test_opf_with_its_cover(self):
+        self.assertEqual(self.find(['Book.opf', 'Book.jpg', 'Other.txt']), ['Book.opf', 'Book.jpg'])
+
+    def test_opf_beside_a_book_format(self):
+        self.assertEqual(self.find(['Book.opf', 'Book.jpg', 'Book.epub']), [])
+
+    def test_names_are_matched_up_to_a_dot(self):
+        self.assertEqual(self.find(['Book.opf', 'Book.cover.JPG', 'Bookshelf.epub']),
+                         ['Book.opf', 'Book.cover.JPG'])
+
+    def test_cover_shared_by_two_opf_files_is_listed_once(self):
+        self.assertEqual(sorted(self.find(['a.opf', 'a.b.opf', 'a.b.jpg'])),
+                         ['a.b.jpg', 'a.b.opf', 'a.opf'])
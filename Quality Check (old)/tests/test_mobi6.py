@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, shutil, struct, tempfile, unittest
+
+from tests import HAS_CALIBRE, NEEDS_CALIBRE
+
+if HAS_CALIBRE:
+    from calibre.ebooks.mobi import MobiError
+    from calibre_plugins.quality_check.mobi6 import (build_exth, read_exth_records, patch_record0,
+                                                     grow_record0, update_exth_in_place, rewrite_exth,
+                                                     RECORD0_PADDING)
+
+MOBI_HEADER_LENGTH = 0xE8
+EXTH_OFFSET = 16 + MOBI_HEADER_LENGTH
+DRM_BLOCK = b'DRM\x01' + bytes(bytearray(range(1, 45)))
+TITLE = b'A Book Title'
+
+
+def make_record0(drm=False, padding=1024, encryption_type=0):
+    '''
+    A MOBI header record with an EXTH header, optionally followed by a DRM
+    key block, then the full name and the given zero padding
+    '''
+    exth = build_exth({100: b'An Author', 113: b'OLDASIN'}, 'utf-8')
+    drm_offset = EXTH_OFFSET + len(exth)
+    title_offset = drm_offset + (len(DRM_BLOCK) if drm else 0)
+    header = bytearray(EXTH_OFFSET)
+    struct.pack_into('>HHLHHHH', header, 0, 2, 0, 1000, 1, 4096, encryption_type, 0)
+    header[16:20] = b'MOBI'
+    struct.pack_into('>LLL', header, 20, MOBI_HEADER_LENGTH, 2, 65001)
+    struct.pack_into('>LL', header, 0x54, title_offset, len(TITLE))
+    struct.pack_into('>L', header, 0x80, 0x40)
+    if drm:
+        struct.pack_into('>LLLL', header, 0xA8, drm_offset, 1, len(DRM_BLOCK), 0)
+    else:
+        struct.pack_into('>LLLL', header, 0xA8, 0xFFFFFFFF, 0, 0, 0)
+    return bytes(header) + exth + (DRM_BLOCK if drm else b'') + TITLE + b'\0' * padding
+
+
+def make_book(record0, sections):
+    '''
+    The bytes of a PDB file holding the header record and the other sections
+    '''
+    header = bytearray(78)
+    header[0:9] = b'Test Book'
+    header[0x3C:0x44] = b'BOOKMOBI'
+    struct.pack_into('>H', header, 76, len(sections) + 1)
+    offset = 78 + 8 * (len(sections) + 1) + 2
+    table = b''
+    for i, section in enumerate([record0] + sections):
+        table += struct.pack('>LL', offset, i * 2)
+        offset += len(section)
+    return bytes(header) + table + b'\0\0' + record0 + b''.join(sections)
+
+
+def read_sections(raw):
+    num_sections, = struct.unpack('>H', raw[76:78])
+    offsets = [struct.unpack('>L', raw[78 + i * 8:82 + i * 8])[0] for i in range(num_sections)]
+    offsets.append(len(raw))
+    return [raw[offsets[i]:offsets[i + 1]] for i in range(num_sections)]
+
+
+class MobiTestCase(unittest.TestCase):
+
+    def assertRecord0(self, record0, drm=False):
+        _exth_offset, _exth_length, codec, records = read_exth_records(record0)
+        self.assertEqual(codec, 'utf-8')
+        self.assertEqual(records[100], b'An Author')
+        self.assertEqual(records[113], b'B00ASIN123')
+        self.assertEqual(records[504], b'B00ASIN123')
+        self.assertEqual(records[501], b'EBOK')
+        title_offset, title_length = struct.unpack('>LL', record0[0x54:0x5C])
+        self.assertEqual(record0[title_offset:title_offset + title_length], TITLE)
+        self.assertEqual(record0[title_offset + title_length:title_offset + title_length + 2], b'\0\0')
+        drm_offset, drm_count, drm_size = struct.unpack('>LLL', record0[0xA8:0xB4])
+        if drm:
+            self.assertEqual((drm_count, drm_size), (1, len(DRM_BLOCK)))
+            self.assertEqual(record0[drm_offset:drm_offset + drm_size], DRM_BLOCK)
+        else:
+            self.assertEqual(drm_offset, 0xFFFFFFFF)
+
+
+@unittest.skipUnless(HAS_CALIBRE, NEEDS_CALIBRE)
+class TestMobi6(MobiTestCase):
+
+    def test_build_exth(self):
+        exth = build_exth({100: b'An Author', 113: b'OLDASIN'}, 'utf-8', 'B00ASIN123', b'EBOK')
+        self.assertEqual(exth[:4], b'EXTH')
+        self.assertEqual(len(exth) % 4, 0)
+        exth_length, num_items = struct.unpack('>LL', exth[4:12])
+        self.assertEqual(num_items, 4)
+        self.assertLess(exth_length, len(exth))
+
+    def test_patch_record0(self):
+        record0 = make_record0()
+        new_record0 = patch_record0(record0, 'B00ASIN123', b'EBOK')
+        self.assertEqual(len(new_record0), len(record0))
+        self.assertRecord0(new_record0)
+        # Updating again with the same values leaves the record as it is
+        self.assertEqual(patch_record0(new_record0, 'B00ASIN123', b'EBOK'), new_record0)
+
+    def test_patch_record0_with_drm_block(self):
+        record0 = make_record0(drm=True)
+        new_record0 = patch_record0(record0, 'B00ASIN123', b'EBOK')
+        self.assertEqual(len(new_record0), len(record0))
+        self.assertRecord0(new_record0, drm=True)
+        self.assertEqual(patch_record0(new_record0, 'B00ASIN123', b'EBOK'), new_record0)
+
+    def test_patch_record0_without_room(self):
+        self.assertIsNone(patch_record0(make_record0(drm=True, padding=2), 'B00ASIN123', b'EBOK'))
+
+    def test_grow_record0_with_drm_block(self):
+        record0 = make_record0(drm=True, padding=2)
+        new_record0 = grow_record0(record0, 'B00ASIN123', b'EBOK')
+        self.assertEqual(len(new_record0) % 4, 0)
+        self.assertGreater(len(new_record0), len(record0) + RECORD0_PADDING)
+        self.assertRecord0(new_record0, drm=True)
+        # The padding leaves room for the next update in place
+        self.assertEqual(len(patch_record0(new_record0, 'B00ASIN987', b'PDOC')), len(new_record0))
+
+
+@unittest.skipUnless(HAS_CALIBRE, NEEDS_CALIBRE)
+class TestMobi6Files(MobiTestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tdir, 'book.mobi')
+        self.sections = [b'first section' * 100, b'second section' * 50]
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def write_book(self, record0):
+        with open(self.path, 'wb') as f:
+            f.write(make_book(record0, self.sections))
+
+    def read_book(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_update_exth_in_place(self):
+        self.write_book(make_record0())
+        size = os.path.getsize(self.path)
+        self.assertTrue(update_exth_in_place(self.path, 'B00ASIN123', b'EBOK'))
+        self.assertEqual(os.path.getsize(self.path), size)
+        sections = read_sections(self.read_book())
+        self.assertRecord0(sections[0])
+        self.assertEqual(sections[1:], self.sections)
+
+    def test_rewrite_exth(self):
+        self.write_book(make_record0(padding=2))
+        self.assertFalse(update_exth_in_place(self.path, 'B00ASIN123', b'EBOK'))
+        size = rewrite_exth(self.path, 'B00ASIN123', b'EBOK')
+        raw = self.read_book()
+        self.assertEqual(size, len(raw))
+        sections = read_sections(raw)
+        self.assertEqual(read_exth_records(sections[0])[3][113], b'B00ASIN123')
+        self.assertEqual(sections[1:], self.sections)
+
+    def test_encrypted_book_is_not_changed(self):
+        self.write_book(make_record0(drm=True, padding=2, encryption_type=2))
+        raw = self.read_book()
+        self.assertRaises(MobiError, update_exth_in_place, self.path, 'B00ASIN123', b'EBOK')
+        self.assertRaises(MobiError, rewrite_exth, self.path, 'B00ASIN123', b'EBOK')
+        self.assertEqual(self.read_book(), raw)
+        self.assertEqual(os.listdir(self.tdir), ['book.mobi'])
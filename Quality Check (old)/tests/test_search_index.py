@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from tests import HAS_CALIBRE, NEEDS_CALIBRE
+
+if HAS_CALIBRE:
+    from calibre_plugins.quality_check.search_index import get_required_literals
+
+
+@unittest.skipUnless(HAS_CALIBRE, NEEDS_CALIBRE)
+class TestGetRequiredLiterals(unittest.TestCase):
+
+    def test_plain_text(self):
+        self.assertEqual(get_required_literals('hello world'), ['hello world'])
+
+    def test_runs_split_by_other_terms(self):
+        self.assertEqual(get_required_literals(r'chapter\s+\d+ of the'), ['chapter', ' of the'])
+
+    def test_escaped_characters_are_literal(self):
+        self.assertEqual(get_required_literals(r'a\.b\.c'), ['a.b.c'])
+
+    def test_groups_and_alternatives_are_ignored(self):
+        self.assertEqual(get_required_literals('(foo|bar)baz'), ['baz'])
+        self.assertEqual(get_required_literals('foo|bar'), [])
+
+    def test_repeated_characters_end_a_run(self):
+        self.assertEqual(get_required_literals('colou?r'), ['colo'])
+
+    def test_short_runs_are_dropped(self):
+        self.assertEqual(get_required_literals('ab.cd'), [])
+
+    def test_invalid_expression(self):
+        self.assertEqual(get_required_literals('unclosed('), [])
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import threading, time, unittest
+
+from calibre_plugins.quality_check.workers import BookWorkerPool, BufferedLog, ThreadedLog
+
+
+class TestBookWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.main_log = BufferedLog()
+        self.log = ThreadedLog(self.main_log)
+
+    def drain_all(self, pool):
+        results = []
+        while not pool.is_finished:
+            results.extend(pool.drain())
+            time.sleep(0.001)
+        pool.join()
+        results.extend(pool.drain())
+        return results
+
+    def test_results_are_in_book_order(self):
+        book_ids = list(range(1, 41))
+
+        def callback_fn(book_id, db):
+            # The earlier books take longest, so they finish out of order
+            time.sleep(0.0005 * (len(book_ids) - book_id))
+            self.log('Checked', book_id)
+            return book_id % 3 == 0
+
+        pool = BookWorkerPool(book_ids, callback_fn, None, self.log, 4)
+        pool.start()
+        results = self.drain_all(pool)
+        self.assertEqual(results, [(book_id, book_id % 3 == 0) for book_id in book_ids])
+        self.assertEqual([args for _method, args, _kw in self.main_log.records],
+                         [('Checked', book_id) for book_id in book_ids])
+
+    def test_error_is_logged_and_not_matched(self):
+
+        def callback_fn(book_id, db):
+            if book_id == 2:
+                raise ValueError('Unreadable book')
+            return True
+
+        pool = BookWorkerPool([1, 2, 3], callback_fn, None, self.log, 2)
+        pool.start()
+        self.assertEqual(self.drain_all(pool), [(1, True), (2, False), (3, True)])
+        self.assertEqual(self.main_log.records[0][:2], ('error', ('ERROR evaluating book id: ', 2)))
+
+    def test_cancel_stops_taking_books(self):
+        started = []
+        release = threading.Event()
+
+        def callback_fn(book_id, db):
+            started.append(book_id)
+            release.wait(5)
+            return True
+
+        book_ids = list(range(1, 101))
+        pool = BookWorkerPool(book_ids, callback_fn, None, self.log, 2)
+        pool.start()
+        while len(started) < 2:
+            time.sleep(0.001)
+        pool.cancel()
+        release.set()
+        results = self.drain_all(pool)
+        # Only the books already being evaluated complete
+        self.assertEqual(sorted(started), [1, 2])
+        self.assertEqual(results, [(1, True), (2, True)])
+        self.assertTrue(pool.is_finished)
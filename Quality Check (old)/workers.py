@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import threading, traceback
+
+
+class BufferedLog(object):
+    '''
+    Stand-in for a GUILog that records each call made against it, so that
+    the output for a book evaluated on a worker thread can be replayed into
+    the real log later on the GUI thread.
+    '''
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, *args, **kwargs):
+        self.records.append(('info', args, kwargs))
+
+    def debug(self, *args, **kwargs):
+        self.records.append(('debug', args, kwargs))
+
+    def info(self, *args, **kwargs):
+        self.records.append(('info', args, kwargs))
+
+    def warn(self, *args, **kwargs):
+        self.records.append(('warn', args, kwargs))
+    warning = warn
+
+    def error(self, *args, **kwargs):
+        self.records.append(('error', args, kwargs))
+
+    def exception(self, *args, **kwargs):
+        # The traceback must be captured now, it will be gone by replay time
+        kwargs.pop('limit', None)
+        self.records.append(('error', args, kwargs))
+        self.records.append(('debug', (traceback.format_exc(),), {}))
+
+    def serializable_records(self):
+        '''
+        The recorded calls reduced to text, for storing in the result cache
+        '''
+        return [[method, ['%s'%a for a in args]] for method, args, _kw in self.records]
+
+    @property
+    def plain_text(self):
+        return '\n'.join(' '.join('%s'%a for a in args) for _m, args, _kw in self.records)
+
+    def replay(self, log):
+        for method, args, kwargs in self.records:
+            getattr(log, method)(*args, **kwargs)
+
+
+class ThreadedLog(object):
+    '''
+    Wraps the GUILog of a check. On the GUI thread all calls go straight
+    through to the wrapped log. Between begin_buffer() and end_buffer() the
+    calling thread instead writes into its own BufferedLog. Buffers can be
+    nested, the innermost one receiving the output.
+    '''
+    def __init__(self, log):
+        self.main_log = log
+        self._local = threading.local()
+
+    @property
+    def current(self):
+        buffers = getattr(self._local, 'buffers', None)
+        if not buffers:
+            return self.main_log
+        return buffers[-1]
+
+    def begin_buffer(self):
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = []
+        buffers.append(BufferedLog())
+
+    def end_buffer(self):
+        buffers = getattr(self._local, 'buffers', None)
+        if not buffers:
+            return None
+        return buffers.pop()
+
+    def __call__(self, *args, **kwargs):
+        self.current(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.current, name)
+
+
+class BookWorkerPool(object):
+    '''
+    Evaluates the quality check callback for each book on a pool of worker
+    threads. Results are handed back by drain() in the same order as the
+    book ids were supplied, so the log and result ids read exactly as they
+    would have for a serial run of the check.
+    '''
+    def __init__(self, book_ids, callback_fn, db, log, worker_count):
+        self.book_ids, self.callback_fn, self.db, self.log = book_ids, callback_fn, db, log
+        self.worker_count = max(1, min(worker_count, len(book_ids)))
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        self._next_index = 0
+        self._drain_index = 0
+        self._completed = {}
+        self._threads = []
+
+    def start(self):
+        for i in range(self.worker_count):
+            t = threading.Thread(target=self._run, name='QualityCheckWorker-%d'%i)
+            t.daemon = True
+            self._threads.append(t)
+            t.start()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+    @property
+    def is_finished(self):
+        for t in self._threads:
+            if t.is_alive():
+                return False
+        with self._lock:
+            return self._drain_index not in self._completed
+
+    def _take_next_index(self):
+        with self._lock:
+            if self._cancel_event.is_set() or self._next_index >= len(self.book_ids):
+                return None
+            idx = self._next_index
+            self._next_index += 1
+            return idx
+
+    def _run(self):
+        while True:
+            idx = self._take_next_index()
+            if idx is None:
+                break
+            book_id = self.book_ids[idx]
+            self.log.begin_buffer()
+            try:
+                matched = bool(self.callback_fn(book_id, self.db))
+            except:
+                self.log.error('ERROR evaluating book id: ', book_id)
+                self.log(traceback.format_exc())
+                matched = False
+            buffered = self.log.end_buffer()
+            with self._lock:
+                self._completed[idx] = (book_id, matched, buffered)
+
+    def drain(self):
+        '''
+        Returns a list of (book_id, matched) for every book completed since
+        the last call that can be released in order, replaying its log output.
+        '''
+        ready = []
+        with self._lock:
+            while self._drain_index in self._completed:
+                ready.append(self._completed.pop(self._drain_index))
+                self._drain_index += 1
+        results = []
+        for book_id, matched, buffered in ready:
+            if buffered is not None:
+                buffered.replay(self.log.main_log)
+            results.append((book_id, matched))
+        return results